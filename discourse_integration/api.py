@@ -1,17 +1,34 @@
 # discourse_integration/api.py
-import requests # Keep this import if you're suppressing warnings, but it's not used directly for client init
+import hashlib
+import requests
 import logging
 import secrets
 import string
+import threading
+import time
+from contextlib import nullcontext
+from requests.adapters import HTTPAdapter
 from django.conf import settings
 from django.contrib.auth import get_user_model # Import get_user_model
-from django.utils import timezone # Import timezone for last_synced_at
+from .conf import get_setting
+from .index import find_indexed_user, forget_indexed_user
+from .lookup_cache import MISSING, get_lookup_cache
+from .metrics import record_rejected, record_retry, track_request
+from .ratelimit import RateLimitTimeout, cap_wait, current_max_wait, get_rate_limiter
+from .resilience import IDEMPOTENT_METHODS, backoff_delay, get_circuit_breaker
+from .sso import build_user_payload, get_sso_codec
 
 logger = logging.getLogger(__name__)
 
 # Get the User model
 User = get_user_model() # Define User here
 
+# Process-wide HTTP sessions and API clients, keyed by Discourse instance.
+_sessions = {}
+_clients = {}
+_sessions_lock = threading.Lock()
+_clients_lock = threading.Lock()
+
 def generate_random_password(length=12):
     """
     Generates a cryptographically secure random password.
@@ -22,22 +39,251 @@ def generate_random_password(length=12):
 
 class DiscourseAPIError(Exception):
     """Custom exception for Discourse API errors."""
-    pass
+    def __init__(self, message='', retryable=False, retry_after=None, status_code=None):
+        super().__init__(message)
+        # Whether repeating the call may succeed (timeouts, 5xx, 429), and the
+        # delay in seconds the server asked for before doing so, if any.
+        self.retryable = retryable
+        self.retry_after = retry_after
+        self.status_code = status_code
+
+class DiscourseRateLimited(DiscourseAPIError):
+    """Raised when Discourse answers 429; retry_after is the server's requested delay in seconds."""
+    def __init__(self, message, retry_after=None):
+        super().__init__(message, retryable=True, retry_after=retry_after)
+
+class DiscourseUnavailable(DiscourseAPIError):
+    """Raised without contacting Discourse while its circuit breaker is open."""
+    def __init__(self, message, retry_after=None):
+        super().__init__(message, retryable=False, retry_after=retry_after)
+
+class DiscourseConflict(DiscourseAPIError):
+    """
+    Raised instead of creating a user whose username or email is already taken
+    by a Discourse account with another external_id. That account is left alone.
+    """
+    def __init__(self, message, discourse_user_id=None):
+        super().__init__(message)
+        self.discourse_user_id = discourse_user_id
+
+def index_conflict(user, discourse_user_id):
+    """
+    Logs and returns the DiscourseConflict for a user whose username or email
+    the indexed Discourse account ``discourse_user_id`` already uses.
+    """
+    logger.warning(
+        "Discourse account %s already uses the username or email of Django user %s (ID %s); not linking it.",
+        discourse_user_id, user.username, user.pk,
+    )
+    return DiscourseConflict(
+        f"Discourse account {discourse_user_id} already uses the username or email of {user.username}.",
+        discourse_user_id=discourse_user_id,
+    )
+
+# Discourse REST endpoints, relative to DISCOURSE_BASE_URL.
+USERS_ENDPOINT = 'users.json'
+ADMIN_USER_ENDPOINT = 'admin/users/{id}.json'
+EXTERNAL_USER_ENDPOINT = 'u/by-external/{external_id}.json'
+USERNAME_ENDPOINT = 'u/{username}.json'
+ADMIN_USERS_LIST_ENDPOINT = 'admin/users/list/{flag}.json'
+
+# Keys kept from Discourse user lookups: enough to link a profile while
+# keeping cached entries small.
+LOOKUP_FIELDS = ('id', 'username', 'name', 'active')
+
+def compact_user(data):
+    return {key: data.get(key) for key in LOOKUP_FIELDS}
+
+# User fields whose changes must reach Discourse. Saves that touch none of
+# these (e.g. the last_login update on every sign-in) need no sync.
+SYNCED_USER_FIELDS = frozenset({'username', 'email', 'first_name', 'last_name', 'is_active'})
+
+def user_payload_hash(user):
+    """
+    Fingerprint of exactly the fields build_update_payload sends.
+    Stored on DiscourseProfile after each sync so unchanged users can be skipped;
+    a change the update would not carry (e.g. a bare username rename) must not
+    mark the profile synced.
+    """
+    payload = build_update_payload(user)
+    values = [f"{key}={payload[key]}" for key in sorted(payload)]
+    return hashlib.sha256('\x1f'.join(values).encode('utf-8')).hexdigest()
+
+def build_create_payload(user):
+    """
+    Builds the POST users.json body for a Django user.
+    Shared by the sync and async clients so both send identical payloads.
+    """
+    # IMPORTANT: This 'password' field must be the plaintext password.
+    # Discourse requires one even though SSO users never log in with it.
+    return {
+        'username': user.username,
+        # Provide a placeholder email if the Django user's email is empty
+        'email': user.email if user.email else f"{user.username}@example.com",
+        'name': user.get_full_name() or user.username,
+        'password': generate_random_password(),
+        'active': True,
+    }
+
+def build_update_payload(user):
+    """
+    Builds the PUT admin/users/{id}.json body for a Django user.
+    Passwords are not updated through this endpoint for SSO users.
+    """
+    return {
+        'email': user.email,
+        'name': user.get_full_name() or user.username,
+    }
+
+def build_delete_params(block_email=True, block_urls=True, delete_posts=False):
+    """
+    Builds the query parameters for DELETE admin/users/{id}.json.
+    """
+    return {
+        'block_email': block_email,
+        'block_urls': block_urls,
+        'delete_posts': delete_posts,
+    }
+
+def parse_create_response(username, response):
+    """
+    Interprets a users.json response.
+    Returns the new Discourse user ID, or True when Discourse reports success
+    without one. Raises DiscourseAPIError when Discourse reports failure.
+    """
+    # Check if Discourse API reported overall success
+    if response.get('success') is True:
+        if 'id' in response:
+            logger.info("Discourse user %s created with ID: %s", username, response['id'])
+            return response['id']
+        logger.warning("Discourse user creation successful for %s but no ID returned in direct response. Full response: %s", username, response)
+        return True
+    error_message = response.get('message', 'Discourse API reported an unknown error during user creation.')
+    logger.error("Discourse user creation failed for %s: %s. Full response: %s", username, error_message, response)
+    raise DiscourseAPIError(f"Discourse user creation failed: {error_message}")
+
+def should_retry(method, path, attempt, error):
+    """
+    Decides whether a failed call is retried. Idempotent methods are retried on
+    timeouts, 5xx and 429 with jittered exponential backoff; POSTs never are.
+    Returns the delay to sleep before the next attempt, or None to raise ``error``.
+    ``attempt`` counts the retries already made.
+    """
+    retries = get_setting('DISCOURSE_RETRIES') if method in IDEMPOTENT_METHODS else 0
+    if attempt >= retries or not error.retryable:
+        return None
+    delay = backoff_delay(attempt, error.retry_after)
+    if delay > cap_wait(get_setting('DISCOURSE_RETRY_MAX_BACKOFF')):
+        return None # Longer than we are willing to block; let the caller defer the work
+    record_retry(method, path)
+    logger.warning("Retrying Discourse %s %s in %.2fs (retry %s of %s): %s", method, path, delay, attempt + 1, retries, error)
+    return delay
+
+def admit_request(base_url, method, path):
+    """
+    Returns the circuit breaker for ``base_url`` once it lets a request through.
+    Raises DiscourseUnavailable without contacting Discourse while it is open.
+    """
+    breaker = get_circuit_breaker(base_url)
+    if not breaker.allow_request():
+        record_rejected(method, path)
+        raise DiscourseUnavailable(f"Discourse is unavailable; not sending {method} {path}", retry_after=breaker.retry_after())
+    return breaker
+
+def rate_limit_timeout(breaker, method, path, error):
+    """
+    Returns the DiscourseRateLimited for a request the rate limiter would not
+    admit within the allowed wait. The request was never sent, so a half-open
+    probe is handed back to the breaker.
+    """
+    breaker.release()
+    return DiscourseRateLimited(f"Not waiting for the Discourse rate limit to send {method} {path}", retry_after=error.retry_after)
+
+def handle_rate_limited(response, breaker, limiter, path):
+    """
+    Feeds a response's rate-limit headers to the limiter and raises
+    DiscourseRateLimited if Discourse answered 429.
+    """
+    retry_after = limiter.observe(response.status_code, response.headers) if limiter is not None else None
+    if response.status_code == 429:
+        breaker.record_success() # Discourse is up, just busy
+        raise DiscourseRateLimited(f"Discourse API rate limit exceeded for {path}", retry_after=retry_after)
+
+def classify_failure(status, transport_error):
+    """
+    Whether a failed request points at Discourse itself: timeouts, refused
+    connections and 5xx do; a 4xx means it answered and rejected this request.
+    """
+    return transport_error or (status is not None and status >= 500)
+
+def request_failed(breaker, method, path, error, status=None, transport_error=False, body=None):
+    """
+    Records a failed request on the circuit breaker, logs it and returns the
+    DiscourseAPIError to raise. ``status`` is the HTTP status, if any answer
+    came back, and ``body`` the response text.
+    """
+    server_fault = classify_failure(status, transport_error)
+    if server_fault:
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+    if status == 404:
+        logger.debug("Discourse API returned 404 for %s %s", method, path) # Expected for lookups of unknown users
+    else:
+        logger.error("Discourse API request failed: %s", error)
+        if body is not None:
+            logger.error("Discourse API error response: %s", body)
+    return DiscourseAPIError(f"Discourse API communication error: {error}", retryable=server_fault, status_code=status)
+
+def decode_response(breaker, method, path, response):
+    """
+    Records a successful request and returns its decoded JSON body.
+    """
+    breaker.record_success()
+    try:
+        return response.json()
+    except ValueError as e: # An HTML maintenance or proxy page instead of JSON
+        logger.error("Discourse API returned a non-JSON body for %s %s: %s", method, path, e)
+        raise DiscourseAPIError(f"Discourse API returned an invalid JSON response: {e}", status_code=response.status_code)
+
+def get_session(base_url):
+    """
+    Returns the process-wide keep-alive session for a Discourse base URL.
+    The session is created on first use and shared by every DiscourseAPI
+    instance in the process, so repeated calls reuse pooled connections.
+    """
+    session = _sessions.get(base_url)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(base_url)
+            if session is None:
+                pool_size = get_setting('DISCOURSE_HTTP_POOL_SIZE')
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+                session = requests.Session()
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _sessions[base_url] = session
+                logger.debug("Created Discourse HTTP session for %s (pool size %s)", base_url, pool_size)
+    return session
+
+def get_discourse_api():
+    """
+    Returns the shared DiscourseAPI for the currently configured Discourse instance.
+    Use this instead of DiscourseAPI() on hot paths such as signal handlers.
+    """
+    key = (settings.DISCOURSE_BASE_URL, settings.DISCOURSE_API_KEY, settings.DISCOURSE_API_USERNAME)
+    api = _clients.get(key)
+    if api is None:
+        with _clients_lock:
+            api = _clients.get(key)
+            if api is None:
+                api = _clients[key] = DiscourseAPI()
+    return api
 
 class DiscourseAPI:
     def __init__(self):
-        print(f"DEBUG: Loading api.py from: {__file__}")
-        print("DEBUG: DiscourseAPI __init__ called.")
-        print(f"DEBUG: DiscourseAPI instance created from: {__file__}")
-
         self.base_url = settings.DISCOURSE_BASE_URL.rstrip('/')
-
-        # --- ADD THESE DEBUG LINES ---
-        print(f"DEBUG: DISCOURSE_BASE_URL (raw from settings): '{settings.DISCOURSE_BASE_URL}'")
-        print(f"DEBUG: self.base_url (after rstrip): '{self.base_url}'")
-        print(f"DEBUG: Length of self.base_url: {len(self.base_url)}")
-        print(f"DEBUG: Hex representation of self.base_url: {[hex(ord(c)) for c in self.base_url]}")
-        # -----------------------------
+        logger.debug("DiscourseAPI created for %r", self.base_url)
 
         self.api_key = settings.DISCOURSE_API_KEY
         self.api_username = settings.DISCOURSE_API_USERNAME
@@ -48,71 +294,82 @@ class DiscourseAPI:
             'Accept': 'application/json'
         }
         self.verify_ssl = not settings.DEBUG
+        # (connect, read): fail fast when Discourse is unreachable, but give slow
+        # endpoints such as user creation time to answer.
+        self.timeout = (get_setting('DISCOURSE_CONNECT_TIMEOUT'), get_setting('DISCOURSE_READ_TIMEOUT'))
+        self.session = get_session(self.base_url)
 
     def _make_request(self, method, path, data=None, params=None):
-        # ... (your existing _make_request method content) ...
+        """
+        Sends a request to Discourse and returns the decoded JSON body,
+        retrying as should_retry decides.
+        """
+        attempt = 0
+        while True:
+            try:
+                return self._send(method, path, data=data, params=params)
+            except DiscourseAPIError as e:
+                delay = should_retry(method, path, attempt, e)
+                if delay is None:
+                    raise
+                attempt += 1
+                time.sleep(delay)
+
+    def _send(self, method, path, data=None, params=None):
         url = f"{self.base_url}/{path}"
+        breaker = admit_request(self.base_url, method, path)
+        limiter = get_rate_limiter()
         try:
-            response = requests.request(
-                method,
-                url,
-                json=data,
-                params=params,
-                headers=self.headers,
-                verify=self.verify_ssl,
-                timeout=10
-            )
+            with limiter.slot(current_max_wait()) if limiter is not None else nullcontext():
+                with track_request(method, path) as tracked:
+                    response = self.session.request(
+                        method,
+                        url,
+                        json=data,
+                        params=params,
+                        headers=self.headers,
+                        verify=self.verify_ssl,
+                        timeout=self.timeout
+                    )
+                    tracked.status = response.status_code
+            handle_rate_limited(response, breaker, limiter, path)
             response.raise_for_status()  # Raise an exception for HTTP errors (4xx or 5xx)
-            return response.json()
+        except RateLimitTimeout as e:
+            raise rate_limit_timeout(breaker, method, path, e)
         except requests.exceptions.RequestException as e:
-            logger.error("Discourse API request failed: %s", e) # Use lazy formatting for logging
-            if hasattr(e, 'response') and e.response is not None:
-                logger.error("Discourse API error response: %s", e.response.text) # Use lazy formatting for logging
-            # Ensure this raises DiscourseAPIError
-            raise DiscourseAPIError(f"Discourse API communication error: {e}")
+            status = getattr(e.response, 'status_code', None)
+            raise request_failed(
+                breaker, method, path, e,
+                status=status if isinstance(status, int) else None,
+                transport_error=isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)),
+                body=e.response.text if e.response is not None else None,
+            )
+        return decode_response(breaker, method, path, response)
 
     def create_user(self, user):
         """
         Creates a user in Discourse.
         Handles the case where Discourse API might not return user ID in the initial success response.
+        When the local user index already knows a matching Discourse account, that
+        account is updated instead of sending a create Discourse would reject.
         """
-        # IMPORTANT: This 'password' field must be the plaintext password.
-        # Use the generate_random_password function defined above.
-        generated_password = generate_random_password() # Correctly call the function
-        active_user = True
+        discourse_user_id = self._update_indexed_user(user)
+        if discourse_user_id is not None:
+            return discourse_user_id
 
-        # Provide a placeholder email if the Django user's email is empty
-        user_email = user.email if user.email else f"{user.username}@example.com"
-        # --- MODIFICATION ENDS HERE ---
-
-        data = {
-            'username': user.username,
-            'email': user_email,
-            'name': user.get_full_name() or user.username,
-            'password': generated_password, # <<< YOU MUST ENSURE THIS IS A REAL PLAINTEXT PASSWORD
-            'active':active_user,
-        }
-
-        # Corrected endpoint based on your documentation
-        endpoint = 'users.json'
+        data = build_create_payload(user)
 
         try:
-            response = self._make_request('POST', endpoint, data=data)
-
-            # Check if Discourse API reported overall success
-            if response.get('success') is True:
-                if 'id' in response:
-                    discourse_user_id = response['id']
-                    logger.info("Discourse user %s created with ID: %s", user.username, response['id']) # Use lazy formatting
-                    return discourse_user_id 
-                else:
-                    logger.warning("Discourse user creation successful for %s but no ID returned in direct response. Full response: %s", user.username, response) # Use lazy formatting
-                    return True 
-            else:
-                error_message = response.get('message', 'Discourse API reported an unknown error during user creation.')
-                logger.error("Discourse user creation failed for %s: %s. Full response: %s", user.username, error_message, response) # Use lazy formatting
-                raise DiscourseAPIError(f"Discourse user creation failed: {error_message}")
+            response = self._make_request('POST', USERS_ENDPOINT, data=data)
+            discourse_user_id = parse_create_response(user.username, response)
+            # Forget any cached "no such user" answers for the new account
+            cache = get_lookup_cache(self.base_url)
+            cache.delete(('external_id', str(user.pk)))
+            cache.delete(('username', user.username))
+            return discourse_user_id
 
+        except DiscourseAPIError:
+            raise
         except requests.exceptions.RequestException as e:
             logger.error("Discourse API request failed during creation for %s: %s", user.username, e)
             # Ensure this re-raises DiscourseAPIError
@@ -122,6 +379,29 @@ class DiscourseAPI:
             # Ensure this re-raises DiscourseAPIError
             raise DiscourseAPIError(f"Unexpected error during user creation: {e}")        
 
+    def _update_indexed_user(self, user):
+        """
+        Returns the indexed Discourse ID for a user after pushing their details to it,
+        or None when the index has no match or the indexed account no longer exists.
+        Only an account whose external_id is the user's is adopted; one that merely
+        shares their username or email raises DiscourseConflict.
+        """
+        discourse_user_id, conflict_id = find_indexed_user(user)
+        if conflict_id is not None:
+            raise index_conflict(user, conflict_id)
+        if discourse_user_id is None:
+            return None
+        try:
+            self._make_request('PUT', ADMIN_USER_ENDPOINT.format(id=discourse_user_id), data=build_update_payload(user))
+        except DiscourseAPIError as e:
+            if e.status_code != 404:
+                raise
+            logger.info("Indexed Discourse user %s no longer exists; creating %s.", discourse_user_id, user.username)
+            forget_indexed_user(discourse_user_id)
+            return None
+        logger.info("Discourse user %s already exists with ID %s; updated instead of creating.", user.username, discourse_user_id)
+        return discourse_user_id
+
     def update_user(self, user):
         """
         Updates an existing user in Discourse.
@@ -136,21 +416,15 @@ class DiscourseAPI:
                 logger.warning("Discourse user ID is null for Django user %s. Cannot update.", user.username)
                 return False # Indicate failure without erroring out
 
-            data = {
-                'email': user.email,
-                'name': user.get_full_name() or user.username,
-                # Passwords are not typically updated via general user update API for SSO users.
-            }
-            # Endpoint for updating a user by ID (based on your previous use)
-            endpoint = f'admin/users/{discourse_user_id}.json' 
-            
+            data = build_update_payload(user)
+            endpoint = ADMIN_USER_ENDPOINT.format(id=discourse_user_id)
+
             # Make the API request
             response = self._make_request('PUT', endpoint, data=data)
             logger.info("Successfully updated Discourse user ID %s.", discourse_user_id)
             
-            # Update last_synced_at timestamp if successful
-            profile.last_synced_at = timezone.now()
-            profile.save()
+            # Record what was synced and when
+            profile.save(update_fields=profile.set_synced(user_payload_hash(user)))
             
             return response # Return the API response on success
 
@@ -164,36 +438,89 @@ class DiscourseAPI:
             logger.error("An unexpected error occurred during Discourse update_user for %s: %s", user.username, e)
             raise # Re-raise for higher-level handling
 
-    def get_user_by_external_id(self, external_id):
-        pass
+    def get_user_by_external_id(self, external_id, use_cache=True):
+        """
+        Returns a compact dict (id, username, name, active) for the Discourse user
+        whose SSO external_id is ``external_id``, or None if there is none.
+        Answers, including misses, are cached per process for DISCOURSE_LOOKUP_CACHE_TTL
+        (DISCOURSE_LOOKUP_NEGATIVE_TTL for misses).
+        """
+        endpoint = EXTERNAL_USER_ENDPOINT.format(external_id=external_id)
+        return self._lookup_user(endpoint, ('external_id', str(external_id)), use_cache)
+
+    def get_user_by_username(self, username, use_cache=True):
+        """
+        Returns a compact dict for the Discourse user called ``username``, or None. Cached like get_user_by_external_id.
+        """
+        return self._lookup_user(USERNAME_ENDPOINT.format(username=username), ('username', username), use_cache)
+
+    def resolve_user_id(self, user):
+        """
+        Finds the Discourse user ID for a Django user. Accounts created through
+        users.json have no external_id until their first SSO login, so the
+        username is tried as a fallback.
+        """
+        found = self.get_user_by_external_id(user.pk) or self.get_user_by_username(user.username)
+        return found['id'] if found else None
+
+    def iter_admin_user_pages(self, flag='active', order='created', asc=False):
+        """
+        Yields pages (lists of user dicts, emails included) from admin/users/list,
+        requesting the next page only after the previous one has been consumed.
+        """
+        endpoint = ADMIN_USERS_LIST_ENDPOINT.format(flag=flag)
+        page = 1
+        while True:
+            params = {'page': page, 'show_emails': 'true', 'order': order}
+            if asc:
+                params['asc'] = 'true'
+            users = self._make_request('GET', endpoint, params=params)
+            if not users:
+                return
+            yield users
+            page += 1
+
+    def _lookup_user(self, endpoint, cache_key, use_cache):
+        cache = get_lookup_cache(self.base_url)
+        if use_cache:
+            cached = cache.get(cache_key)
+            if cached is MISSING:
+                return None
+            if cached is not None:
+                return cached
+        try:
+            response = self._make_request('GET', endpoint)
+        except DiscourseAPIError as e:
+            if e.status_code != 404:
+                raise
+            cache.set(cache_key, MISSING)
+            return None
+        user_data = compact_user(response.get('user') or {})
+        cache.set(cache_key, user_data)
+        return user_data
 
     def delete_user(self, discourse_user_id, **kwargs):
+        """
+        Deletes a user in Discourse. Accepts block_email, block_urls and delete_posts.
+        """
+        endpoint = ADMIN_USER_ENDPOINT.format(id=discourse_user_id)
         try:
-            response = self.client.delete_user(
-                discourse_user_id,
-                block_email=kwargs.get('block_email', True),
-                block_urls=kwargs.get('block_urls', True),
-                delete_posts=kwargs.get('delete_posts', False)
-            )
-            logger.info(f"Successfully deleted Discourse user ID {discourse_user_id}.")
-            return response
-        except DiscourseClientError as e:
-            logger.error(f"pydiscourse delete_user failed for ID {discourse_user_id}: {e.response.text if hasattr(e, 'response') else e}")
-            raise DiscourseAPIError(f"Discourse API error during user deletion: {e}")
-        except Exception as e:
-            logger.error(f"An unexpected error occurred during pydiscourse delete_user for ID {discourse_user_id}: {e}")
-            raise DiscourseAPIError(f"Unexpected error during user deletion: {e}")
-
-    def get_sso_login_url(self, return_path='/'):
-        """
-        Generates the DiscourseConnect SSO login URL.
-        NOTE: This is a simplified placeholder. Actual SSO payload generation
-        is complex, involving nonce, external_id, email, username, etc.,
-        base64 encoding, and HMAC-SHA256 signature.
-        You would typically use a library like `discourse_sso` for this.
-        """
-        sso_secret = settings.DISCOURSE_SSO_SECRET
-        # Placeholder for actual SSO payload and signature logic
-        sso_payload_base64 = "YOUR_SSO_PAYLOAD_BASE64_ENCODED"
-        signature = "YOUR_HMAC_SHA256_SIGNATURE"
-        return f"{settings.DISCOURSE_SSO_LOGIN_URL}?sso={sso_payload_base64}&sig={signature}"
+            response = self._make_request('DELETE', endpoint, params=build_delete_params(**kwargs))
+        except DiscourseAPIError as e:
+            raise DiscourseAPIError(
+                f"Discourse API error during user deletion: {e}",
+                retryable=e.retryable,
+                retry_after=e.retry_after,
+                status_code=e.status_code,
+            ) from e
+        forget_indexed_user(discourse_user_id)
+        logger.info("Successfully deleted Discourse user ID %s.", discourse_user_id)
+        return response
+
+    def get_sso_login_url(self, user, nonce, return_sso_url=None):
+        """
+        Generates the signed DiscourseConnect SSO login URL for a Django user.
+        The caller is responsible for remembering ``nonce`` to check the callback.
+        """
+        payload = build_user_payload(user, nonce, return_sso_url)
+        return get_sso_codec().login_url(payload)
@@ -0,0 +1,221 @@
+# discourse_integration/async_api.py
+import asyncio
+import logging
+import weakref
+from contextlib import nullcontext
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from .api import (
+    ADMIN_USER_ENDPOINT,
+    EXTERNAL_USER_ENDPOINT,
+    USERNAME_ENDPOINT,
+    USERS_ENDPOINT,
+    DiscourseAPIError,
+    admit_request,
+    build_create_payload,
+    build_delete_params,
+    build_update_payload,
+    compact_user,
+    decode_response,
+    handle_rate_limited,
+    index_conflict,
+    parse_create_response,
+    rate_limit_timeout,
+    request_failed,
+    should_retry,
+    user_payload_hash,
+)
+from .conf import get_setting
+from .index import afind_indexed_user, aforget_indexed_user
+from .lookup_cache import MISSING, get_lookup_cache
+from .metrics import track_request
+from .ratelimit import RateLimitTimeout, current_max_wait, get_rate_limiter
+
+try:
+    import httpx
+except ImportError: # httpx is only needed for the async client
+    httpx = None
+
+logger = logging.getLogger(__name__)
+
+# One connection pool per (event loop, base URL). httpx pools are bound to the
+# loop that opened their connections, so they cannot be shared across loops.
+_clients = weakref.WeakKeyDictionary()
+
+def get_async_client(base_url):
+    """
+    Returns the shared httpx.AsyncClient for ``base_url`` on the running event loop.
+    """
+    if httpx is None:
+        raise ImproperlyConfigured("The async Discourse client requires the 'httpx' package.")
+    loop_clients = _clients.setdefault(asyncio.get_running_loop(), {})
+    client = loop_clients.get(base_url)
+    if client is None or client.is_closed:
+        pool_size = get_setting('DISCOURSE_ASYNC_POOL_SIZE')
+        client = httpx.AsyncClient(
+            base_url=base_url,
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            timeout=httpx.Timeout(get_setting('DISCOURSE_READ_TIMEOUT'), connect=get_setting('DISCOURSE_CONNECT_TIMEOUT')),
+            verify=not settings.DEBUG,
+        )
+        loop_clients[base_url] = client
+        logger.debug("Created async Discourse client for %s (pool size %s)", base_url, pool_size)
+    return client
+
+async def gather_bounded(aws, limit=None, return_exceptions=True):
+    """
+    Awaits many Discourse calls with at most ``limit`` in flight at once.
+    Results are returned in input order; with return_exceptions=True failures
+    are returned in place instead of cancelling the remaining calls.
+    """
+    semaphore = asyncio.Semaphore(limit or get_setting('DISCOURSE_ASYNC_CONCURRENCY'))
+
+    async def run(aw):
+        async with semaphore:
+            return await aw
+
+    return await asyncio.gather(*(run(aw) for aw in aws), return_exceptions=return_exceptions)
+
+class AsyncDiscourseAPI:
+    """
+    asyncio counterpart to DiscourseAPI for ASGI views and async workers.
+    Builds the same payloads as the sync client and shares one connection
+    pool per event loop, so hundreds of calls can be in flight without threads.
+    """
+
+    def __init__(self, client=None):
+        self.base_url = settings.DISCOURSE_BASE_URL.rstrip('/')
+        self.headers = {
+            'Api-Key': settings.DISCOURSE_API_KEY,
+            'Api-Username': settings.DISCOURSE_API_USERNAME,
+            'Content-Type': 'application/json',
+            'Accept': 'application/json'
+        }
+        self._client = client
+
+    @property
+    def client(self):
+        return self._client or get_async_client(self.base_url)
+
+    async def _make_request(self, method, path, data=None, params=None):
+        """
+        Sends a request to Discourse and returns the decoded JSON body.
+        Retries and circuit breaking follow DiscourseAPI._make_request.
+        """
+        attempt = 0
+        while True:
+            try:
+                return await self._send(method, path, data=data, params=params)
+            except DiscourseAPIError as e:
+                delay = should_retry(method, path, attempt, e)
+                if delay is None:
+                    raise
+                attempt += 1
+                await asyncio.sleep(delay)
+
+    async def _send(self, method, path, data=None, params=None):
+        url = f"{self.base_url}/{path}"
+        breaker = admit_request(self.base_url, method, path)
+        limiter = get_rate_limiter()
+        try:
+            async with limiter.aslot(current_max_wait()) if limiter is not None else nullcontext():
+                with track_request(method, path) as tracked:
+                    response = await self.client.request(method, url, json=data, params=params, headers=self.headers)
+                    tracked.status = response.status_code
+            handle_rate_limited(response, breaker, limiter, path)
+            response.raise_for_status()
+        except RateLimitTimeout as e:
+            raise rate_limit_timeout(breaker, method, path, e)
+        except httpx.HTTPError as e:
+            answered = isinstance(e, httpx.HTTPStatusError)
+            raise request_failed(
+                breaker, method, path, e,
+                status=e.response.status_code if answered else None,
+                transport_error=isinstance(e, httpx.TransportError),
+                body=e.response.text if answered else None,
+            )
+        return decode_response(breaker, method, path, response)
+
+    async def create_user(self, user):
+        """
+        Creates a user in Discourse. See DiscourseAPI.create_user.
+        """
+        discourse_user_id, conflict_id = await afind_indexed_user(user)
+        if conflict_id is not None:
+            raise index_conflict(user, conflict_id)
+        if discourse_user_id is not None:
+            try:
+                await self._make_request('PUT', ADMIN_USER_ENDPOINT.format(id=discourse_user_id), data=build_update_payload(user))
+                return discourse_user_id
+            except DiscourseAPIError as e:
+                if e.status_code != 404:
+                    raise
+                await aforget_indexed_user(discourse_user_id)
+        response = await self._make_request('POST', USERS_ENDPOINT, data=build_create_payload(user))
+        discourse_user_id = parse_create_response(user.username, response)
+        # Forget any cached "no such user" answers for the new account
+        cache = get_lookup_cache(self.base_url)
+        cache.delete(('external_id', str(user.pk)))
+        cache.delete(('username', user.username))
+        return discourse_user_id
+
+    async def update_user(self, user):
+        """
+        Updates an existing user in Discourse. See DiscourseAPI.update_user.
+        Returns False when the user has no linked Discourse ID.
+        """
+        from .models import DiscourseProfile
+
+        profile = await DiscourseProfile.objects.filter(user=user).afirst()
+        if profile is None or not profile.discourse_user_id:
+            logger.warning("No linked Discourse user for Django user %s. Cannot update.", user.username)
+            return False
+
+        endpoint = ADMIN_USER_ENDPOINT.format(id=profile.discourse_user_id)
+        response = await self._make_request('PUT', endpoint, data=build_update_payload(user))
+        logger.info("Successfully updated Discourse user ID %s.", profile.discourse_user_id)
+
+        await profile.asave(update_fields=profile.set_synced(user_payload_hash(user)))
+        return response
+
+    async def delete_user(self, discourse_user_id, **kwargs):
+        """
+        Deletes a user in Discourse. Accepts block_email, block_urls and delete_posts.
+        """
+        endpoint = ADMIN_USER_ENDPOINT.format(id=discourse_user_id)
+        response = await self._make_request('DELETE', endpoint, params=build_delete_params(**kwargs))
+        await aforget_indexed_user(discourse_user_id)
+        logger.info("Successfully deleted Discourse user ID %s.", discourse_user_id)
+        return response
+
+    async def get_user_by_external_id(self, external_id):
+        """
+        Returns a compact dict for the Discourse user with this SSO external_id, or None.
+        Shares the process-wide lookup cache with DiscourseAPI.
+        """
+        endpoint = EXTERNAL_USER_ENDPOINT.format(external_id=external_id)
+        return await self._lookup_user(endpoint, ('external_id', str(external_id)))
+
+    async def get_user_by_username(self, username):
+        """
+        Returns a compact dict for the Discourse user called ``username``, or None.
+        """
+        return await self._lookup_user(USERNAME_ENDPOINT.format(username=username), ('username', username))
+
+    async def _lookup_user(self, endpoint, cache_key):
+        cache = get_lookup_cache(self.base_url)
+        cached = cache.get(cache_key)
+        if cached is MISSING:
+            return None
+        if cached is not None:
+            return cached
+        try:
+            response = await self._make_request('GET', endpoint)
+        except DiscourseAPIError as e:
+            if e.status_code != 404:
+                raise
+            cache.set(cache_key, MISSING)
+            return None
+        user_data = compact_user(response.get('user') or {})
+        cache.set(cache_key, user_data)
+        return user_data
@@ -0,0 +1,125 @@
+# discourse_integration/async_views.py
+import logging
+from django.shortcuts import redirect
+from django.conf import settings
+from django.contrib.auth import alogin
+from django.contrib.auth import get_user_model
+from django.http import HttpResponseBadRequest
+from django.urls import reverse
+from django.utils.crypto import get_random_string
+from django.views.decorators.csrf import csrf_exempt
+from django.contrib.auth.decorators import login_required
+from .conf import get_setting
+from .metrics import timed_view
+from .sso import SSOError, build_user_payload, consume_nonce, get_sso_codec, is_sso_fresh, issue_nonce, mark_sso_fresh
+from .tasks import aensure_provisioned, provisions_on_first_visit
+
+logger = logging.getLogger(__name__)
+User = get_user_model()
+
+# Async counterparts of the views in views.py, for ASGI deployments. They use
+# the async ORM, session and auth APIs, so an SSO handshake never leaves the
+# event loop. Both sets are routed in urls.py; point DISCOURSE_SSO_CALLBACK_URL
+# at the callback of the set you serve.
+
+@timed_view('sso_login')
+@login_required
+async def discourse_sso_login(request):
+    """
+    Initiates the DiscourseConnect SSO process for a logged-in Django user.
+    """
+    user = await request.auser()
+    if user.is_staff or user.is_superuser:
+        return HttpResponseBadRequest("Admin users cannot use this SSO flow.")
+
+    if provisions_on_first_visit():
+        await aensure_provisioned(user)
+
+    if get_setting('DISCOURSE_SSO_STATELESS_NONCES'):
+        nonce = issue_nonce(user.id, forum=request.GET.get('forum') == '1')
+    else:
+        nonce = get_random_string(32)
+        await request.session.aset('discourse_sso_nonce', nonce)
+        await request.session.aset('discourse_sso_user_id', user.id)
+
+    return redirect(get_sso_codec().login_url(build_user_payload(user, nonce)))
+
+@csrf_exempt # Necessary as Discourse posts to this URL
+@timed_view('sso_callback')
+async def discourse_sso_callback(request):
+    """
+    Handles the callback from Discourse after SSO. See views.discourse_sso_callback.
+    """
+    sso_payload = request.POST.get('sso')
+    signature = request.POST.get('sig')
+
+    if not sso_payload or not signature:
+        return HttpResponseBadRequest("Missing SSO payload or signature.")
+
+    try:
+        payload_params = get_sso_codec().decode(sso_payload, signature)
+    except SSOError as e:
+        logger.warning("Rejected DiscourseConnect callback: %s", e)
+        return HttpResponseBadRequest("Invalid SSO signature.")
+
+    try:
+        nonce = payload_params.get('nonce')
+        external_id = payload_params.get('external_id')
+
+        redirect_url_after_sso = None
+        if get_setting('DISCOURSE_SSO_STATELESS_NONCES'):
+            try:
+                stored_user_id, forum = consume_nonce(nonce)
+            except SSOError as e:
+                logger.warning("Rejected SSO nonce: %s", e)
+                return HttpResponseBadRequest("Invalid or expired SSO request or user mismatch.")
+            # Never logs anyone in; see views.discourse_sso_callback
+            current_user = await request.auser()
+            if not current_user.is_authenticated or current_user.id != stored_user_id:
+                logger.warning("Stateless SSO callback for user ID %s without that user's session.", stored_user_id)
+                return HttpResponseBadRequest("Invalid or expired SSO request or user mismatch.")
+            stored_nonce = nonce
+            redirect_url_after_sso = settings.DISCOURSE_BASE_URL if forum else settings.LOGIN_REDIRECT_URL
+        else:
+            stored_nonce = await request.session.apop('discourse_sso_nonce', None)
+            stored_user_id = await request.session.apop('discourse_sso_user_id', None)
+
+        if not stored_nonce or nonce != stored_nonce or not stored_user_id or external_id != str(stored_user_id):
+            logger.warning("SSO nonce/user ID mismatch: stored user ID %s, received external_id %s", stored_user_id, external_id)
+            return HttpResponseBadRequest("Invalid or expired SSO request or user mismatch.")
+
+        current_user = await request.auser()
+        if not current_user.is_authenticated or current_user.id != stored_user_id:
+            try:
+                user = await User.objects.aget(id=stored_user_id)
+                await alogin(request, user)
+            except User.DoesNotExist:
+                logger.warning("Django user with ID %s not found during SSO callback.", stored_user_id)
+                return HttpResponseBadRequest("User not found.")
+
+        if redirect_url_after_sso is None:
+            redirect_url_after_sso = await request.session.apop('redirect_url_after_sso', settings.LOGIN_REDIRECT_URL)
+        response = redirect(redirect_url_after_sso)
+        mark_sso_fresh(request, response, stored_user_id)
+        return response
+
+    except Exception as e:
+        logger.exception("Error processing Discourse SSO callback: %s", e)
+        return HttpResponseBadRequest("An error occurred during SSO processing.")
+
+@timed_view('forum_link')
+@login_required
+async def discourse_forum_link(request):
+    """
+    Redirects the logged-in user to the Discourse forum through the async SSO login view.
+    """
+    user = await request.auser()
+    if is_sso_fresh(request, user.id):
+        return redirect(settings.DISCOURSE_BASE_URL)
+
+    login_url = reverse('discourse:discourse_sso_login_async')
+    if get_setting('DISCOURSE_SSO_STATELESS_NONCES'):
+        return redirect(login_url + '?forum=1')
+
+    await request.session.aset('redirect_url_after_sso', settings.DISCOURSE_BASE_URL)
+    return redirect(login_url)
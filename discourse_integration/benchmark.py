@@ -0,0 +1,339 @@
+# discourse_integration/benchmark.py
+import json
+import logging
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+from django.contrib.auth import get_user_model
+from django.db import close_old_connections
+from django.test import Client
+from django.urls import reverse
+from .api import get_discourse_api
+from .bulk import sync_users
+from .sso import get_sso_codec
+
+logger = logging.getLogger(__name__)
+User = get_user_model()
+
+# End-to-end load harness used by the benchmark_discourse command: a local
+# stand-in for the Discourse API, and scenarios that drive the real views and
+# sync code against it through the Django test client.
+
+PERCENTILES = (50, 95, 99)
+
+_ADMIN_USER = re.compile(r'^/admin/users/(\d+)\.json$')
+_ADMIN_LIST = re.compile(r'^/admin/users/list/\w+\.json$')
+_BY_EXTERNAL = re.compile(r'^/u/by-external/([^/]+)\.json$')
+_BY_USERNAME = re.compile(r'^/u/([^/]+)\.json$')
+
+class FakeDiscourse:
+    """
+    A threaded HTTP server that answers the Discourse endpoints this app uses,
+    keeping users in memory.
+
+    Every request waits ``latency`` seconds plus up to ``jitter``. A
+    ``rate_limit_rate`` fraction of requests is answered 429 with Retry-After:
+    ``retry_after``, and an ``error_rate`` fraction 503. ``seed`` makes the
+    injected faults repeatable. Use it as a context manager, or start()/stop().
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, rate_limit_rate=0.0, retry_after=1, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.users = {}
+        self.status_counts = {}
+        self._random = random.Random(seed)
+        self._next_id = 1
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        handler = type('FakeDiscourseHandler', (_Handler,), {'fake': self})
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-discourse', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+        return False
+
+    def fault(self):
+        """
+        The injected failure for the next request: 429, 503 or None.
+        """
+        with self._lock:
+            roll = self._random.random()
+            delay = self.latency + (self._random.uniform(0, self.jitter) if self.jitter else 0)
+        time.sleep(delay)
+        if roll < self.rate_limit_rate:
+            return 429
+        if roll < self.rate_limit_rate + self.error_rate:
+            return 503
+        return None
+
+    def record(self, status):
+        with self._lock:
+            self.status_counts[status] = self.status_counts.get(status, 0) + 1
+
+    def handle(self, method, path, query, body):
+        """
+        Returns (status, payload) for one request that passed fault injection.
+        """
+        with self._lock:
+            if method == 'POST' and path == '/users.json':
+                if any(user['username'] == body.get('username') for user in self.users.values()):
+                    return 200, {'success': False, 'message': 'Username must be unique'}
+                discourse_id = self._next_id
+                self._next_id += 1
+                self.users[discourse_id] = {
+                    'id': discourse_id,
+                    'username': body.get('username'),
+                    'email': body.get('email'),
+                    'name': body.get('name'),
+                    'external_id': body.get('external_id'),
+                }
+                return 200, {'success': True, 'active': True, 'id': discourse_id, 'user_id': discourse_id}
+            match = _ADMIN_USER.match(path)
+            if match:
+                discourse_id = int(match.group(1))
+                if discourse_id not in self.users:
+                    return 404, {'errors': ['Not found']}
+                if method == 'PUT':
+                    self.users[discourse_id].update({key: value for key, value in body.items() if key in ('email', 'name', 'username')})
+                    return 200, {'success': 'OK', 'user': self.users[discourse_id]}
+                if method == 'DELETE':
+                    del self.users[discourse_id]
+                    return 200, {'deleted': True}
+                return 200, self.users[discourse_id]
+            if method == 'GET' and _ADMIN_LIST.match(path):
+                page = int(query.get('page', ['1'])[0])
+                users = sorted(self.users.values(), key=lambda user: user['id'])
+                return 200, users[(page - 1) * 100:page * 100]
+            match = _BY_EXTERNAL.match(path) or _BY_USERNAME.match(path)
+            if method == 'GET' and match:
+                field = 'external_id' if match.re is _BY_EXTERNAL else 'username'
+                for user in self.users.values():
+                    if str(user.get(field)) == match.group(1):
+                        return 200, {'user': user}
+                return 404, {'errors': ['Not found']}
+        return 404, {'errors': ['Not found']}
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # Keep-alive, like Discourse behind nginx
+    fake = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _serve(self):
+        url = urlsplit(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else b''
+        status = self.fake.fault()
+        headers = {}
+        if status == 429:
+            payload = {'errors': ['Too many requests']}
+            headers['Retry-After'] = str(self.fake.retry_after)
+        elif status == 503:
+            payload = {'errors': ['Service unavailable']}
+        else:
+            try:
+                body = json.loads(raw) if raw else {}
+            except ValueError:
+                body = {}
+            status, payload = self.fake.handle(self.command, url.path, parse_qs(url.query), body)
+        self.fake.record(status)
+        content = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _serve
+
+def percentile(ordered, p):
+    """
+    Nearest-rank percentile of an already sorted list.
+    """
+    if not ordered:
+        return None
+    rank = max(1, -(-len(ordered) * p // 100)) # ceil(n * p / 100)
+    return ordered[int(rank) - 1]
+
+def summarize(latencies, errors=0, duration=None, concurrency=1):
+    """
+    Latency percentiles (milliseconds) and throughput for one scenario.
+    """
+    ordered = sorted(latencies)
+    result = {
+        'requests': len(ordered) + errors,
+        'errors': errors,
+        'concurrency': concurrency,
+    }
+    if duration is not None:
+        result['duration_s'] = round(duration, 4)
+        result['rps'] = round(len(ordered) / duration, 2) if duration else None
+    result['latency_ms'] = {
+        **{f'p{p}': _ms(percentile(ordered, p)) for p in PERCENTILES},
+        'mean': _ms(sum(ordered) / len(ordered) if ordered else None),
+        'max': _ms(ordered[-1] if ordered else None),
+    }
+    return result
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+def run_load(task, items, concurrency=1):
+    """
+    Runs ``task(item)`` for every item on ``concurrency`` threads. Each task
+    returns a dict of named timings in seconds. Returns (timings by name,
+    error count, wall-clock duration).
+    """
+    timings = {}
+    errors = 0
+
+    def call(item):
+        try:
+            return task(item)
+        except Exception as e:
+            logger.warning("Benchmark task failed for %s: %s", item, e)
+            return None
+        finally:
+            if concurrency > 1:
+                close_old_connections()
+
+    started = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(call, items))
+    else:
+        results = [call(item) for item in items]
+    duration = time.perf_counter() - started
+
+    for result in results:
+        if result is None:
+            errors += 1
+            continue
+        for name, seconds in result.items():
+            timings.setdefault(name, []).append(seconds)
+    return timings, errors, duration
+
+def signup_form_data(username):
+    password = f"Bench-{username}-pw-{username[::-1]}"
+    return {
+        'username': username,
+        'first_name': 'Bench',
+        'last_name': username,
+        'email': f'{username}@bench.example',
+        'password1': password,
+        'password2': password,
+    }
+
+def run_signups(usernames, concurrency=1):
+    """
+    Posts the sign-up form once per username. Returns summaries keyed by scenario.
+    """
+    url = reverse('signup')
+
+    def signup(username):
+        client = Client()
+        started = time.perf_counter()
+        response = client.post(url, signup_form_data(username))
+        elapsed = time.perf_counter() - started
+        if response.status_code != 302:
+            raise ValueError(f"sign-up answered {response.status_code}")
+        return {'signup': elapsed}
+
+    timings, errors, duration = run_load(signup, usernames, concurrency)
+    return {'signup': summarize(timings.get('signup', []), errors, duration, concurrency)}
+
+def run_sso(users, concurrency=1, start_url=None):
+    """
+    Runs a full DiscourseConnect handshake per user: the login view, then the
+    callback Discourse would post back. Each view is summarized separately.
+    """
+    login_url = start_url or reverse('discourse:discourse_sso_login')
+    callback_url = reverse('discourse:discourse_sso_callback')
+    codec = get_sso_codec()
+
+    def handshake(user):
+        client = Client()
+        client.force_login(user)
+        started = time.perf_counter()
+        response = client.get(login_url)
+        login_elapsed = time.perf_counter() - started
+        if response.status_code != 302:
+            raise ValueError(f"SSO login answered {response.status_code}")
+        query = parse_qs(urlsplit(response['Location']).query)
+        payload = codec.decode(query['sso'][0], query['sig'][0])
+        sso, sig = codec.encode({'nonce': payload['nonce'], 'external_id': payload['external_id'], 'email': payload['email']})
+        started = time.perf_counter()
+        response = client.post(callback_url, {'sso': sso, 'sig': sig})
+        callback_elapsed = time.perf_counter() - started
+        if response.status_code != 302:
+            raise ValueError(f"SSO callback answered {response.status_code}")
+        return {'sso_login': login_elapsed, 'sso_callback': callback_elapsed}
+
+    timings, errors, duration = run_load(handshake, users, concurrency)
+    return {
+        name: summarize(timings.get(name, []), errors, duration, concurrency)
+        for name in ('sso_login', 'sso_callback')
+    }
+
+def run_bulk_sync(queryset, concurrency=1, batch_size=500):
+    """
+    Syncs ``queryset`` with sync_users on ``concurrency`` workers. Reports
+    users/second for the run and the latency of every Discourse API call made.
+    """
+    session = get_discourse_api().session
+    api_latencies = []
+
+    def record(response, *args, **kwargs):
+        api_latencies.append(response.elapsed.total_seconds())
+
+    session.hooks['response'].append(record)
+    try:
+        started = time.perf_counter()
+        counts = sync_users(queryset, workers=concurrency, batch_size=batch_size)
+        duration = time.perf_counter() - started
+    finally:
+        session.hooks['response'].remove(record)
+
+    synced = sum(count for outcome, count in counts.items() if outcome != 'failed')
+    bulk = {
+        'users': synced + counts['failed'],
+        'errors': counts['failed'],
+        'concurrency': concurrency,
+        'duration_s': round(duration, 4),
+        'users_per_s': round(synced / duration, 2) if duration else None,
+        'outcomes': counts,
+    }
+    return {'bulk_sync': bulk, 'discourse_api': summarize(api_latencies, duration=duration, concurrency=concurrency)}
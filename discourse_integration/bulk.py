@@ -0,0 +1,177 @@
+# discourse_integration/bulk.py
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from django.contrib.auth import get_user_model
+from django.db import close_old_connections, transaction
+from .api import get_discourse_api, index_conflict
+from .index import match_indexed_users
+from .models import DiscourseOutbox, DiscourseProfile
+from .tasks import is_unchanged, link_profile, provisions_on_first_visit, record_failure, sync_user
+
+logger = logging.getLogger(__name__)
+User = get_user_model()
+
+_suspension = threading.local()
+
+def planned_action(user):
+    """
+    Returns the outbox action needed to bring a user in line with Discourse,
+    or None when the user's synced fields have not changed.
+    """
+    profile = getattr(user, 'discourse_profile', None)
+    if profile is None or not profile.discourse_user_id:
+        return DiscourseOutbox.CREATE
+    if is_unchanged(user):
+        return None
+    return DiscourseOutbox.UPDATE
+
+def empty_counts():
+    return {DiscourseOutbox.CREATE: 0, DiscourseOutbox.UPDATE: 0, 'linked': 0, 'unchanged': 0, 'deferred': 0, 'failed': 0}
+
+def ensure_profiles(users):
+    """
+    Creates the missing DiscourseProfile rows for a batch of users with one
+    bulk_create, and caches every profile on its user.
+    """
+    missing = [user for user in users if getattr(user, 'discourse_profile', None) is None]
+    if not missing:
+        return
+    DiscourseProfile.objects.bulk_create([DiscourseProfile(user=user) for user in missing], ignore_conflicts=True)
+    # ignore_conflicts leaves primary keys unset; fetch the rows back in one query
+    profiles = {profile.user_id: profile for profile in DiscourseProfile.objects.filter(user__in=missing)}
+    for user in missing:
+        user.discourse_profile = profiles[user.pk]
+
+def sync_users(queryset=None, workers=8, batch_size=500, api=None, dry_run=False, on_batch=None):
+    """
+    Brings every eligible user in ``queryset`` in line with Discourse and
+    returns counts per outcome (create, update, linked, unchanged, deferred, failed).
+
+    Users are streamed in primary-key order, ``batch_size`` at a time. Each batch:
+    - gets its missing profiles from one bulk_create;
+    - is matched against the local Discourse user index in one query; users
+      whose username or email belongs to another account fail as conflicts;
+    - is pushed through a pool of ``workers`` threads.
+    Unchanged users are skipped. With first-visit provisioning, unlinked users
+    are deferred rather than created. ``on_batch(last_user)`` runs after each
+    batch, e.g. to checkpoint. Staff, superusers and inactive users are ignored,
+    as they are by the post_save dispatcher.
+    """
+    queryset = User.objects.all() if queryset is None else queryset
+    users = (
+        queryset.filter(is_staff=False, is_superuser=False, is_active=True)
+        .select_related('discourse_profile')
+        .order_by('pk')
+    )
+    api = None if dry_run else (api or get_discourse_api())
+    lazy = provisions_on_first_visit()
+    counts = empty_counts()
+
+    def push(user, action, indexed_id=None, conflict_id=None):
+        if action is None:
+            return 'unchanged'
+        try:
+            if conflict_id is not None:
+                # Someone else's account has this username or email; never adopt it
+                raise index_conflict(user, conflict_id)
+            if indexed_id is not None:
+                # Already in Discourse: link it and let the next sync push any changes
+                if not dry_run:
+                    link_profile(user, indexed_id)
+                return 'linked'
+            if action == DiscourseOutbox.CREATE and lazy:
+                return 'deferred' # Created on first forum visit instead
+            if not dry_run:
+                sync_user(api, user, action)
+            return action
+        except Exception as e:
+            logger.error("Discourse %s failed for user %s: %s", action, user.username, e)
+            if not dry_run:
+                record_failure(user, e)
+            return 'failed'
+        finally:
+            if workers > 1:
+                close_old_connections()
+
+    def run_batch(batch):
+        if not dry_run:
+            ensure_profiles(batch)
+        actions = [planned_action(user) for user in batch]
+        # One index query per batch finds creates Discourse would reject as duplicates
+        creates = [user for user, action in zip(batch, actions) if action == DiscourseOutbox.CREATE]
+        indexed, conflicts = match_indexed_users(creates)
+        indexed_ids = [indexed.get(user.pk) for user in batch]
+        conflict_ids = [conflicts.get(user.pk) for user in batch]
+        if executor is not None:
+            results = executor.map(push, batch, actions, indexed_ids, conflict_ids)
+        else:
+            results = map(push, batch, actions, indexed_ids, conflict_ids)
+        for result in results:
+            counts[result] += 1
+        if on_batch is not None:
+            on_batch(batch[-1])
+
+    executor = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+        batch = []
+        for user in users.iterator(chunk_size=batch_size):
+            batch.append(user)
+            if len(batch) >= batch_size:
+                run_batch(batch)
+                batch = []
+        if batch:
+            run_batch(batch)
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    logger.info("Bulk Discourse sync finished: %s", counts)
+    return counts
+
+class SuspendedSync:
+    """
+    Collects the users saved while per-row syncing is suspended.
+    Users changed behind post_save's back (bulk_create, QuerySet.update) can be
+    registered with add().
+    """
+
+    def __init__(self):
+        self.user_ids = set()
+
+    def add(self, *users):
+        """
+        Registers users, or user IDs, for the sync at exit.
+        """
+        for user in users:
+            self.user_ids.add(getattr(user, 'pk', user))
+
+def current_suspension():
+    """
+    The SuspendedSync active in this thread, or None.
+    """
+    return getattr(_suspension, 'current', None)
+
+@contextmanager
+def suspended_sync(flush=True, **sync_options):
+    """
+    Suspends the per-row post_save sync in this thread for mass user operations.
+
+    Inside the block the dispatcher only records which users were saved. On a
+    clean exit, once the surrounding transaction commits, they are synced in
+    one sync_users() batch (``sync_options`` are passed through). Nested blocks
+    flush with the outermost one. On an exception nothing is synced.
+    """
+    outer = current_suspension()
+    if outer is not None:
+        yield outer
+        return
+    collected = _suspension.current = SuspendedSync()
+    try:
+        yield collected
+    finally:
+        _suspension.current = None
+    if flush and collected.user_ids:
+        user_ids = sorted(collected.user_ids)
+        transaction.on_commit(lambda: sync_users(User.objects.filter(pk__in=user_ids), **sync_options))
@@ -0,0 +1,82 @@
+# discourse_integration/conf.py
+from django.conf import settings
+
+# Defaults for the optional Discourse integration settings.
+# Projects override any of these in their Django settings module.
+DEFAULTS = {
+    # HTTP client
+    'DISCOURSE_HTTP_POOL_SIZE': 10,
+    'DISCOURSE_CONNECT_TIMEOUT': 3.05,
+    'DISCOURSE_READ_TIMEOUT': 10,
+    # asyncio client (requires httpx)
+    'DISCOURSE_ASYNC_POOL_SIZE': 100,
+    'DISCOURSE_ASYNC_CONCURRENCY': 50,
+    # Client-side rate limiting, shared by all DiscourseAPI callers in a process.
+    # Set DISCOURSE_RATE_LIMIT_CACHE to a cache alias to share the budget across processes;
+    # the shared limiter then counts BURST requests per window of 60 * BURST / PER_MINUTE seconds.
+    'DISCOURSE_RATE_LIMIT_PER_MINUTE': 60,
+    'DISCOURSE_RATE_LIMIT_BURST': 10,
+    'DISCOURSE_RATE_LIMIT_CACHE': None,
+    'DISCOURSE_MAX_CONCURRENCY': 8,
+    # Longest wait for the limiter (or a retry) on interactive paths such as
+    # first-visit provisioning; longer waits hand the work to the outbox
+    'DISCOURSE_INTERACTIVE_MAX_WAIT': 1.0,
+    # Retries (idempotent calls only) and circuit breaker
+    'DISCOURSE_RETRIES': 2,
+    'DISCOURSE_RETRY_BACKOFF': 0.5,
+    'DISCOURSE_RETRY_MAX_BACKOFF': 8,
+    'DISCOURSE_BREAKER_FAILURE_THRESHOLD': 5,
+    'DISCOURSE_BREAKER_RESET_TIMEOUT': 30,
+    # Cache for Discourse user lookups: in-process unless a cache alias is given
+    'DISCOURSE_LOOKUP_CACHE_ALIAS': None,
+    'DISCOURSE_LOOKUP_CACHE_SIZE': 10000,
+    'DISCOURSE_LOOKUP_CACHE_TTL': 300,
+    'DISCOURSE_LOOKUP_NEGATIVE_TTL': 30,
+    # DiscourseConnect: larger incoming payloads are rejected unverified
+    'DISCOURSE_SSO_MAX_PAYLOAD_LENGTH': 4096,
+    # Signed nonces carry the user ID and expiry, so the SSO flow needs no session
+    # writes; replays are caught by an in-process LRU, or by the cache alias in
+    # DISCOURSE_SSO_REPLAY_CACHE when several processes serve the callback.
+    'DISCOURSE_SSO_STATELESS_NONCES': False,
+    'DISCOURSE_SSO_NONCE_TTL': 600,
+    'DISCOURSE_SSO_REPLAY_CACHE': None,
+    'DISCOURSE_SSO_REPLAY_CACHE_SIZE': 100000,
+    # Seconds after a completed handshake during which the forum link goes straight
+    # to Discourse (0 disables); tracked in a signed cookie.
+    'DISCOURSE_SSO_FRESHNESS_WINDOW': 0,
+    'DISCOURSE_SSO_FRESH_COOKIE': 'discourse_sso_fresh',
+    # When Discourse accounts are created: 'signup' (queued by the post_save signal)
+    # or 'first_visit' (when the user first starts SSO; see tasks.ensure_provisioned)
+    'DISCOURSE_PROVISIONING': 'signup',
+    # Bearer token Prometheus presents to the metrics view; without one only staff can read it
+    'DISCOURSE_METRICS_TOKEN': None,
+    # Sampling request profiler (profiling.SamplingProfilerMiddleware): the fraction of
+    # requests profiled, optionally only for some URL names, and where the collapsed
+    # stacks go. A rate of 0 disables the middleware entirely.
+    'DISCOURSE_PROFILER_RATE': 0,
+    'DISCOURSE_PROFILER_URL_NAMES': (),
+    'DISCOURSE_PROFILER_DIR': None,
+    'DISCOURSE_PROFILER_INTERVAL': 0.005,
+    'DISCOURSE_PROFILER_MAX_BYTES': 10 * 1024 * 1024,
+    'DISCOURSE_PROFILER_BACKUPS': 5,
+    # Keyword arguments for DiscourseAPI.delete_user when deleted users are purged
+    # from Discourse: block_email, block_urls, delete_posts
+    'DISCOURSE_DELETE_OPTIONS': {},
+    # Sync outbox worker
+    'DISCOURSE_SYNC_COALESCE_WINDOW': 5,
+    # A batch must finish well inside the lease: 20 rows take about 20s at the
+    # default 60 requests/minute, leaving room for retries and Retry-After pauses
+    'DISCOURSE_OUTBOX_BATCH_SIZE': 20,
+    'DISCOURSE_OUTBOX_MAX_ATTEMPTS': 10,
+    'DISCOURSE_OUTBOX_RETRY_DELAY': 30,
+    # Seconds a worker has to finish the rows it claimed before others may take
+    # them over; must exceed DISCOURSE_SYNC_COALESCE_WINDOW
+    'DISCOURSE_OUTBOX_LEASE': 300,
+}
+
+def get_setting(name):
+    """
+    Returns the project's value for a Discourse integration setting,
+    falling back to the app default. Read on every call so override_settings works.
+    """
+    return getattr(settings, name, DEFAULTS[name])
@@ -0,0 +1,107 @@
+# discourse_integration/index.py
+import logging
+from django.db.models import Q
+from django.utils import timezone
+from .models import DiscourseUserIndex
+
+logger = logging.getLogger(__name__)
+
+INDEX_FIELDS = ['username', 'email', 'external_id', 'active', 'refreshed_at']
+
+def index_entry(data, refreshed_at):
+    external_id = data.get('external_id')
+    return DiscourseUserIndex(
+        discourse_user_id=data['id'],
+        username=(data.get('username') or '').lower(),
+        email=(data.get('email') or '').lower(),
+        external_id=str(external_id) if external_id is not None else None,
+        active=bool(data.get('active', True)),
+        refreshed_at=refreshed_at,
+    )
+
+def refresh_user_index(api, full=False, flag='active'):
+    """
+    Streams Discourse's admin user list into DiscourseUserIndex, one page at a time.
+
+    Pages are requested newest account first. An incremental refresh stops at the
+    first page that contains no account missing from the index; a full refresh
+    walks every page and then drops entries for accounts Discourse no longer lists.
+    Only one page is held in memory. Returns the number of accounts written.
+    """
+    started = timezone.now()
+    written = 0
+    for page in api.iter_admin_user_pages(flag=flag, order='created', asc=False):
+        entries = [index_entry(data, started) for data in page if data.get('id')]
+        if not entries:
+            continue
+        ids = [entry.discourse_user_id for entry in entries]
+        known = set() if full else set(
+            DiscourseUserIndex.objects.filter(discourse_user_id__in=ids).values_list('discourse_user_id', flat=True)
+        )
+        DiscourseUserIndex.objects.bulk_create(
+            entries, update_conflicts=True, unique_fields=['discourse_user_id'], update_fields=INDEX_FIELDS,
+        )
+        written += len(entries)
+        if not full and known.issuperset(ids):
+            break
+    if full:
+        removed, _ = DiscourseUserIndex.objects.filter(refreshed_at__lt=started).delete()
+        logger.info("Removed %s Discourse index entries for deleted accounts.", removed)
+    logger.info("Indexed %s Discourse users (%s refresh).", written, 'full' if full else 'incremental')
+    return written
+
+def _match_query(users):
+    by_external_id = {str(user.pk): user for user in users}
+    by_username = {user.username.lower(): user for user in users}
+    by_email = {user.email.lower(): user for user in users if user.email}
+    query = Q(external_id__in=by_external_id) | Q(username__in=by_username)
+    if by_email:
+        query |= Q(email__in=by_email)
+    rows = DiscourseUserIndex.objects.filter(query).values_list('discourse_user_id', 'external_id', 'username', 'email')
+    return rows, (by_external_id, by_username, by_email)
+
+def _collect_matches(rows, lookups):
+    by_external_id, by_username, by_email = lookups
+    matches, conflicts = {}, {}
+    for discourse_user_id, external_id, username, email in rows:
+        user = by_external_id.get(external_id)
+        if user is not None:
+            matches[user.pk] = discourse_user_id
+        for user in (by_username.get(username), by_email.get(email)):
+            if user is not None and external_id != str(user.pk):
+                conflicts.setdefault(user.pk, discourse_user_id)
+    for pk in matches:
+        conflicts.pop(pk, None)
+    return matches, conflicts
+
+def match_indexed_users(users):
+    """
+    Looks a batch of users up in the index with one query. Returns two dicts,
+    ``{user.pk: discourse_user_id}``: the accounts whose external_id is the
+    user's, and for users without one, an account already using their username
+    or email. Only the first kind may be adopted; the second belongs to someone
+    else as far as we can tell, and must not be updated or linked.
+    """
+    if not users:
+        return {}, {}
+    rows, lookups = _match_query(users)
+    return _collect_matches(rows, lookups)
+
+def find_indexed_user(user):
+    """
+    Returns (discourse_user_id, conflicting_discourse_user_id) for a Django
+    user, each None when the index has no such account. See match_indexed_users.
+    """
+    matches, conflicts = match_indexed_users([user])
+    return matches.get(user.pk), conflicts.get(user.pk)
+
+async def afind_indexed_user(user):
+    rows, lookups = _match_query([user])
+    matches, conflicts = _collect_matches([row async for row in rows], lookups)
+    return matches.get(user.pk), conflicts.get(user.pk)
+
+def forget_indexed_user(discourse_user_id):
+    DiscourseUserIndex.objects.filter(discourse_user_id=discourse_user_id).delete()
+
+async def aforget_indexed_user(discourse_user_id):
+    await DiscourseUserIndex.objects.filter(discourse_user_id=discourse_user_id).adelete()
@@ -0,0 +1,126 @@
+# discourse_integration/lookup_cache.py
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import quote
+from django.core.cache import caches
+from .conf import get_setting
+
+# Stored for lookups that found nothing, so repeated misses stay off the network.
+MISSING = object()
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+class TTLCache:
+    """
+    Thread-safe, size-bounded LRU cache whose entries expire after a TTL.
+    Negative results (MISSING) get their own, usually shorter, TTL.
+    """
+
+    def __init__(self, maxsize, ttl, negative_ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns the cached value, MISSING for a cached miss, or None when the key is absent or expired.
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        ttl = self.negative_ttl if value is MISSING else self.ttl
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def add(self, key, value, ttl=None):
+        """
+        Stores ``value`` only if the key is absent or expired. Returns True when stored.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[1] > now:
+                return False
+            self._data[key] = (value, now + (self.ttl if ttl is None else ttl))
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+class SharedLookupCache:
+    """
+    TTLCache-compatible lookup cache stored in a Django cache, so every process
+    sees the same answers. Keys are (kind, value) tuples scoped by ``key_prefix``.
+    """
+    # Stands in for MISSING, which does not survive pickling
+    _MISSING_MARKER = '__discourse_missing__'
+
+    def __init__(self, cache_alias, ttl, negative_ttl, key_prefix):
+        self.cache = caches[cache_alias]
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.key_prefix = key_prefix
+
+    def _key(self, key):
+        return ':'.join([self.key_prefix] + [quote(str(part), safe='') for part in key])
+
+    def get(self, key):
+        value = self.cache.get(self._key(key))
+        return MISSING if value == self._MISSING_MARKER else value
+
+    def set(self, key, value):
+        if value is MISSING:
+            self.cache.set(self._key(key), self._MISSING_MARKER, timeout=self.negative_ttl)
+        else:
+            self.cache.set(self._key(key), value, timeout=self.ttl)
+
+    def delete(self, key):
+        self.cache.delete(self._key(key))
+
+def get_lookup_cache(base_url):
+    """
+    Returns the Discourse user lookup cache for a base URL: a process-wide
+    TTLCache, or a SharedLookupCache when DISCOURSE_LOOKUP_CACHE_ALIAS is set.
+    """
+    cache_alias = get_setting('DISCOURSE_LOOKUP_CACHE_ALIAS')
+    key = (base_url, cache_alias)
+    cache = _caches.get(key)
+    if cache is None:
+        with _caches_lock:
+            cache = _caches.get(key)
+            if cache is None:
+                ttl = get_setting('DISCOURSE_LOOKUP_CACHE_TTL')
+                negative_ttl = get_setting('DISCOURSE_LOOKUP_NEGATIVE_TTL')
+                if cache_alias:
+                    cache = SharedLookupCache(cache_alias, ttl, negative_ttl, key_prefix=f"discourse:lookup:{quote(base_url, safe='')}")
+                else:
+                    cache = TTLCache(get_setting('DISCOURSE_LOOKUP_CACHE_SIZE'), ttl, negative_ttl)
+                _caches[key] = cache
+    return cache
@@ -0,0 +1,135 @@
+# discourse_integration/management/commands/benchmark_discourse.py
+import json
+import os
+import platform
+import subprocess
+import tempfile
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import setup_test_environment, teardown_test_environment
+from discourse_integration.benchmark import FakeDiscourse, run_bulk_sync, run_signups, run_sso
+
+User = get_user_model()
+
+SCENARIOS = ('signup', 'sync', 'sso')
+
+class Command(BaseCommand):
+    help = (
+        "End-to-end benchmark against a local fake Discourse server with configurable "
+        "latency, 5xx and 429 rates. Drives sign-up, bulk sync and the SSO handshake "
+        "through the real views and client code in a throwaway test database, then "
+        "reports p50/p95/p99 latency and throughput as JSON for comparison across commits."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=200, help="Users signed up, synced and put through SSO.")
+        parser.add_argument('--concurrency', type=int, default=8, help="Concurrent clients per scenario.")
+        parser.add_argument('--scenarios', default=','.join(SCENARIOS), help=f"Comma-separated subset of {', '.join(SCENARIOS)}, run in that order.")
+        parser.add_argument('--latency', type=float, default=0.02, help="Fake Discourse base latency in seconds.")
+        parser.add_argument('--jitter', type=float, default=0.01, help="Extra random latency, up to this many seconds.")
+        parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of Discourse requests answered 503.")
+        parser.add_argument('--rate-limit-rate', type=float, default=0.0, help="Fraction of Discourse requests answered 429.")
+        parser.add_argument('--retry-after', type=int, default=1, help="Retry-After seconds sent with 429s.")
+        parser.add_argument('--client-rate-limit', type=int, default=None, help="DISCOURSE_RATE_LIMIT_PER_MINUTE during the run; unlimited by default.")
+        parser.add_argument('--fast-hasher', action='store_true', help="Hash passwords with MD5 so sign-up measures everything but PBKDF2.")
+        parser.add_argument('--seed', type=int, default=None, help="Seed for the injected faults.")
+        parser.add_argument('--label', default='', help="Free-form label stored with the results.")
+        parser.add_argument('--output', help="Write the JSON report to this file instead of stdout.")
+
+    def handle(self, *args, **options):
+        scenarios = [name.strip() for name in options['scenarios'].split(',') if name.strip()]
+        unknown = set(scenarios) - set(SCENARIOS)
+        if unknown:
+            raise CommandError(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+        count = max(1, options['users'])
+        concurrency = max(1, options['concurrency'])
+
+        fake = FakeDiscourse(
+            latency=options['latency'],
+            jitter=options['jitter'],
+            error_rate=options['error_rate'],
+            rate_limit_rate=options['rate_limit_rate'],
+            retry_after=options['retry_after'],
+            seed=options['seed'],
+        )
+        overrides = {
+            'DISCOURSE_RATE_LIMIT_PER_MINUTE': options['client_rate_limit'],
+            'DISCOURSE_HTTP_POOL_SIZE': max(concurrency, 10),
+        }
+        if options['fast_hasher']:
+            overrides['PASSWORD_HASHERS'] = ['django.contrib.auth.hashers.MD5PasswordHasher']
+
+        results = {}
+        with fake, self.test_database():
+            with override_settings(
+                DISCOURSE_BASE_URL=fake.base_url,
+                DISCOURSE_SSO_LOGIN_URL=f'{fake.base_url}/session/sso_provider',
+                **overrides,
+            ):
+                usernames = [f'bench{i:06d}' for i in range(count)]
+                if 'signup' in scenarios:
+                    self.stderr.write(f"Signing up {count} users...")
+                    results.update(run_signups(usernames, concurrency))
+                else:
+                    User.objects.bulk_create(User(username=name, email=f'{name}@bench.example') for name in usernames)
+                users = User.objects.filter(username__in=usernames)
+                if 'sync' in scenarios:
+                    self.stderr.write(f"Syncing {count} users...")
+                    results.update(run_bulk_sync(users, concurrency))
+                if 'sso' in scenarios:
+                    self.stderr.write(f"Running {count} SSO handshakes...")
+                    results.update(run_sso(list(users.order_by('pk')), concurrency))
+
+        report = {
+            'label': options['label'],
+            'commit': self.git_commit(),
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'database': connection.vendor,
+            'config': {
+                key: options[key] for key in (
+                    'users', 'concurrency', 'latency', 'jitter', 'error_rate', 'rate_limit_rate',
+                    'retry_after', 'client_rate_limit', 'fast_hasher', 'seed',
+                )
+            },
+            'discourse_status_counts': {str(status): n for status, n in sorted(fake.status_counts.items())},
+            'scenarios': results,
+        }
+        text = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                f.write(text + '\n')
+            self.stderr.write(f"Wrote {options['output']}.")
+        else:
+            self.stdout.write(text)
+
+    @contextmanager
+    def test_database(self):
+        """
+        Points the default connection at a fresh test database for the run,
+        so the benchmark never touches real data.
+        """
+        setup_test_environment()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            if connection.vendor == 'sqlite':
+                # A file rather than shared memory, so concurrent writers wait instead of failing
+                connection.settings_dict.setdefault('TEST', {})['NAME'] = os.path.join(tmpdir, 'benchmark.sqlite3')
+            old_name = connection.settings_dict['NAME']
+            connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+            try:
+                yield
+            finally:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+                teardown_test_environment()
+
+    def git_commit(self):
+        try:
+            return subprocess.run(
+                ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True, timeout=5,
+            ).stdout.strip()
+        except (OSError, subprocess.SubprocessError):
+            return None
@@ -0,0 +1,78 @@
+# discourse_integration/management/commands/merge_profiles.py
+import glob
+import os
+from collections import Counter
+from django.core.management.base import BaseCommand, CommandError
+from discourse_integration.conf import get_setting
+from discourse_integration.profiling import read_collapsed
+
+class Command(BaseCommand):
+    help = (
+        "Merges the collapsed-stack files written by SamplingProfilerMiddleware "
+        "(every process and rotation) into one file for flamegraph.pl, speedscope or "
+        "inferno, and prints samples per view and the hottest functions."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='*', help="Files or directories to merge. Defaults to DISCOURSE_PROFILER_DIR.")
+        parser.add_argument('--view', action='append', default=[], help="Only stacks for this URL name (repeatable).")
+        parser.add_argument('--output', help="Write the merged collapsed stacks to this file.")
+        parser.add_argument('--top', type=int, default=15, help="Functions listed in the summary.")
+
+    def handle(self, *args, **options):
+        files = self.find_files(options['paths'] or [get_setting('DISCOURSE_PROFILER_DIR')])
+        if not files:
+            raise CommandError("No collapsed-stack files found.")
+        views = set(options['view'])
+
+        merged = Counter()
+        for path in files:
+            for stack, count in read_collapsed(path):
+                if views and stack[0] not in views:
+                    continue
+                merged[stack] += count
+        if not merged:
+            raise CommandError("No samples matched.")
+
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                for stack, count in sorted(merged.items()):
+                    f.write(f"{';'.join(stack)} {count}\n")
+            self.stdout.write(f"Wrote {len(merged)} stacks to {options['output']}.")
+
+        self.write_summary(merged, len(files), max(1, options['top']))
+
+    def find_files(self, paths):
+        files = []
+        for path in paths:
+            if not path:
+                continue
+            if os.path.isdir(path):
+                # Current files and their rotations: profile-<pid>.collapsed[.N]
+                files.extend(sorted(glob.glob(os.path.join(path, '*.collapsed*'))))
+            elif os.path.exists(path):
+                files.append(path)
+            else:
+                raise CommandError(f"{path} does not exist.")
+        return files
+
+    def write_summary(self, merged, file_count, top):
+        total = sum(merged.values())
+        per_view = Counter()
+        self_time = Counter()
+        inclusive = Counter()
+        for stack, count in merged.items():
+            per_view[stack[0]] += count
+            if len(stack) > 1:
+                self_time[stack[-1]] += count
+            for frame in set(stack[1:]): # Recursive frames count once per sample
+                inclusive[frame] += count
+
+        self.stdout.write(f"{total} samples from {file_count} files.")
+        self.stdout.write("\nSamples per view:")
+        for view, count in per_view.most_common():
+            self.stdout.write(f"  {count:>8}  {count / total:6.1%}  {view}")
+        for title, counter in (("Self", self_time), ("Inclusive", inclusive)):
+            self.stdout.write(f"\n{title} (top {top}):")
+            for frame, count in counter.most_common(top):
+                self.stdout.write(f"  {count:>8}  {count / total:6.1%}  {frame}")
@@ -0,0 +1,24 @@
+# discourse_integration/management/commands/process_discourse_outbox.py
+import time
+from django.core.management.base import BaseCommand
+from discourse_integration.tasks import drain_outbox
+
+class Command(BaseCommand):
+    help = "Drains the Discourse sync outbox in batches. Safe to run several workers at once."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None, help="Rows claimed per batch.")
+        parser.add_argument('--interval', type=float, default=1.0, help="Seconds to sleep when the outbox is empty.")
+        parser.add_argument('--once', action='store_true', help="Drain until empty, then exit.")
+
+    def handle(self, *args, **options):
+        total = 0
+        while True:
+            processed = drain_outbox(batch_size=options['batch_size'])
+            total += processed
+            if processed:
+                continue
+            if options['once']:
+                break
+            time.sleep(options['interval'])
+        self.stdout.write(self.style.SUCCESS(f"Processed {total} outbox rows."))
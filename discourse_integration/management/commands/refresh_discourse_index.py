@@ -0,0 +1,19 @@
+# discourse_integration/management/commands/refresh_discourse_index.py
+from django.core.management.base import BaseCommand
+from discourse_integration.api import get_discourse_api
+from discourse_integration.index import refresh_user_index
+
+class Command(BaseCommand):
+    help = (
+        "Streams Discourse's admin user list into the local user index. By default only "
+        "accounts created since the last refresh are fetched; --full re-reads every page "
+        "and drops accounts that no longer exist."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true', help="Re-read the whole user list instead of only new accounts.")
+        parser.add_argument('--flag', default='active', help="admin/users/list filter to index (active, new, staged, ...).")
+
+    def handle(self, *args, **options):
+        written = refresh_user_index(get_discourse_api(), full=options['full'], flag=options['flag'])
+        self.stdout.write(self.style.SUCCESS(f"Indexed {written} Discourse users."))
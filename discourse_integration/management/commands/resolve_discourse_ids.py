@@ -0,0 +1,14 @@
+# discourse_integration/management/commands/resolve_discourse_ids.py
+from django.core.management.base import BaseCommand
+from discourse_integration.tasks import resolve_missing_discourse_ids
+
+class Command(BaseCommand):
+    help = "Looks up and stores the Discourse user ID for every profile that is missing one."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=8, help="Concurrent Discourse lookups.")
+        parser.add_argument('--batch-size', type=int, default=200, help="Profiles resolved and saved per batch.")
+
+    def handle(self, *args, **options):
+        linked = resolve_missing_discourse_ids(workers=max(1, options['workers']), batch_size=max(1, options['batch_size']))
+        self.stdout.write(self.style.SUCCESS(f"Linked {linked} Discourse profiles."))
@@ -0,0 +1,85 @@
+# discourse_integration/management/commands/sync_discourse_users.py
+from datetime import datetime
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+from django.utils import timezone
+from discourse_integration.bulk import sync_users
+from discourse_integration.models import DiscourseOutbox, DiscourseSyncCheckpoint
+from discourse_integration.tasks import provisions_on_first_visit
+
+User = get_user_model()
+
+CHECKPOINT_NAME = 'sync_discourse_users'
+
+class Command(BaseCommand):
+    help = (
+        "Reconciles all eligible Django users with Discourse. Users are streamed in "
+        "primary-key order and pushed through a bounded thread pool; progress is "
+        "checkpointed after every batch so an interrupted run resumes where it stopped. "
+        "Users whose account the local Discourse user index knows by external_id are linked "
+        "without a create; an indexed account that only shares a username or email is reported "
+        "as a failure and left alone. "
+        "With first-visit provisioning, other unlinked users are left for their first SSO."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4, help="Concurrent Discourse requests.")
+        parser.add_argument('--batch-size', type=int, default=500, help="Users fetched and checkpointed per batch.")
+        parser.add_argument('--since', help="Only users who joined or logged in on or after this ISO date/datetime.")
+        parser.add_argument('--dry-run', action='store_true', help="Report what would be sent without calling Discourse.")
+        parser.add_argument('--reset', action='store_true', help="Ignore any saved checkpoint and start from the first user.")
+
+    def handle(self, *args, **options):
+        workers = max(1, options['workers'])
+        batch_size = max(1, options['batch_size'])
+        since = self.parse_since(options['since'])
+        dry_run = options['dry_run']
+
+        checkpoint_name = CHECKPOINT_NAME if since is None else f"{CHECKPOINT_NAME}:{since.isoformat()}"
+        checkpoint = (
+            DiscourseSyncCheckpoint.objects.filter(name=checkpoint_name).first()
+            or DiscourseSyncCheckpoint(name=checkpoint_name)
+        )
+        if options['reset']:
+            checkpoint.last_user_id = 0
+        if checkpoint.last_user_id:
+            self.stdout.write(f"Resuming after user ID {checkpoint.last_user_id}.")
+
+        users = User.objects.filter(pk__gt=checkpoint.last_user_id)
+        if since is not None:
+            users = users.filter(Q(date_joined__gte=since) | Q(last_login__gte=since))
+
+        lazy = provisions_on_first_visit()
+
+        def save_checkpoint(last_user):
+            if not dry_run:
+                # Every user up to the end of this batch has been attempted
+                checkpoint.last_user_id = last_user.pk
+                checkpoint.save()
+
+        counts = sync_users(users, workers=workers, batch_size=batch_size, dry_run=dry_run, on_batch=save_checkpoint)
+
+        if checkpoint.pk and not dry_run:
+            # A completed run starts from the beginning next time
+            checkpoint.delete()
+        verb = "Would create" if dry_run else "Created"
+        self.stdout.write(self.style.SUCCESS(
+            f"{verb} {counts[DiscourseOutbox.CREATE]}, "
+            f"{'would update' if dry_run else 'updated'} {counts[DiscourseOutbox.UPDATE]}, "
+            f"{'would link' if dry_run else 'linked'} {counts['linked']}, "
+            f"unchanged {counts['unchanged']}, "
+            + (f"deferred {counts['deferred']}, " if lazy else "")
+            + f"failed {counts['failed']}."
+        ))
+
+    def parse_since(self, value):
+        if not value:
+            return None
+        try:
+            since = datetime.fromisoformat(value)
+        except ValueError:
+            raise CommandError(f"--since must be an ISO date or datetime, got {value!r}.")
+        if since.tzinfo is None:
+            since = timezone.make_aware(since)
+        return since
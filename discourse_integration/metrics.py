@@ -0,0 +1,261 @@
+# discourse_integration/metrics.py
+import functools
+import re
+import threading
+import time
+from bisect import bisect_left
+from asgiref.sync import iscoroutinefunction
+
+# In-process metrics for Discourse API calls and the SSO views, rendered in the
+# Prometheus text format by views.metrics. Each worker process keeps its own
+# numbers, so Prometheus should scrape every process (or go through a
+# per-host aggregator). Recording is a lock, a dict lookup and an add.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Rate limiter waits run from nothing up to a full Retry-After window
+WAIT_BUCKETS = (0.001, 0.01, 0.05, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_ENDPOINT_PATTERNS = (
+    (re.compile(r'^u/by-external/[^/]+\.json$'), 'u/by-external/{external_id}.json'),
+    (re.compile(r'^u/[^/]+\.json$'), 'u/{username}.json'),
+)
+_ID_SEGMENT = re.compile(r'/\d+(?=/|\.json$|$)')
+
+def endpoint_label(path):
+    """
+    Collapses a request path to its endpoint template, e.g. admin/users/42.json
+    to admin/users/{id}.json, so label values stay bounded.
+    """
+    for pattern, label in _ENDPOINT_PATTERNS:
+        if pattern.match(path):
+            return label
+    return _ID_SEGMENT.sub('/{id}', path)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format_labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def samples(self):
+        """
+        Yields (suffix, label values, extra label, value) for the exposition.
+        """
+        with self._lock:
+            items = sorted(self._values.items())
+        for labels, value in items:
+            yield '', labels, '', value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} {self.kind}']
+        for suffix, labels, extra, value in self.samples():
+            lines.append(f'{self.name}{suffix}{_format_labels(self.labelnames, labels, extra)} {_format_value(value)}')
+        return '\n'.join(lines)
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, *labels, value):
+        with self._lock:
+            self._values[labels] = value
+
+class Histogram(Metric):
+    """
+    Fixed-bucket histogram. Per label set it keeps non-cumulative bucket counts
+    plus a sum; the cumulative Prometheus buckets are built when rendering.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        index = bisect_left(self.buckets, value) # len(buckets) is the +Inf bucket
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def count(self, *labels):
+        state = self._values.get(labels)
+        return sum(state[0]) if state else 0
+
+    def samples(self):
+        with self._lock:
+            items = sorted((labels, (list(counts), total)) for labels, (counts, total) in self._values.items())
+        for labels, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(float(bound))
+                yield '_bucket', labels, f'le="{le}"', cumulative
+            yield '_sum', labels, '', total
+            yield '_count', labels, '', cumulative
+
+API_REQUEST_DURATION = Histogram(
+    'discourse_api_request_duration_seconds',
+    "Time spent on one HTTP request to the Discourse API.",
+    ('method', 'endpoint'),
+)
+API_RESPONSES = Counter(
+    'discourse_api_responses_total',
+    "Discourse API requests by outcome: the HTTP status, 'error' when no response arrived, 'circuit_open' when not sent.",
+    ('method', 'endpoint', 'status'),
+)
+API_RETRIES = Counter(
+    'discourse_api_retries_total',
+    "Discourse API requests retried after a retryable failure.",
+    ('method', 'endpoint'),
+)
+API_IN_FLIGHT = Gauge(
+    'discourse_api_in_flight_requests',
+    "Discourse API requests currently awaiting a response.",
+    ('method', 'endpoint'),
+)
+SSO_DURATION = Histogram(
+    'discourse_sso_view_duration_seconds',
+    "Time spent in the DiscourseConnect views.",
+    ('view', 'status'),
+)
+BREAKER_STATE = Gauge(
+    'discourse_circuit_breaker_state',
+    "Circuit breaker state per Discourse base URL: 1 for the current state, 0 for the others.",
+    ('base_url', 'state'),
+)
+BREAKER_OPENED = Counter(
+    'discourse_circuit_breaker_opened_total',
+    "Times the circuit breaker for a Discourse base URL opened.",
+    ('base_url',),
+)
+
+RATE_LIMIT_WAIT = Histogram(
+    'discourse_rate_limit_wait_seconds',
+    "Time requests waited for the client-side rate limiter: 'acquired' when they went on to be sent, 'timeout' when they gave up at max_wait.",
+    ('outcome',),
+    buckets=WAIT_BUCKETS,
+)
+
+BREAKER_STATES = ('closed', 'open', 'half_open')
+
+REGISTRY = (
+    API_REQUEST_DURATION, API_RESPONSES, API_RETRIES, API_IN_FLIGHT, SSO_DURATION,
+    BREAKER_STATE, BREAKER_OPENED, RATE_LIMIT_WAIT,
+)
+
+def render():
+    """
+    All metrics in the Prometheus text exposition format (version 0.0.4).
+    """
+    return '\n'.join(metric.render() for metric in REGISTRY) + '\n'
+
+def reset():
+    """
+    Clears every metric. For tests.
+    """
+    for metric in REGISTRY:
+        metric.clear()
+
+class track_request:
+    """
+    Context manager around one Discourse API request: keeps the in-flight gauge
+    and, on exit, records latency and outcome. Set ``status`` inside the block;
+    it stays 'error' if no response arrived.
+    """
+
+    def __init__(self, method, path):
+        self.labels = (method, endpoint_label(path))
+        self.status = 'error'
+
+    def __enter__(self):
+        API_IN_FLIGHT.inc(*self.labels)
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        API_REQUEST_DURATION.observe(time.perf_counter() - self.started, *self.labels)
+        API_IN_FLIGHT.dec(*self.labels)
+        API_RESPONSES.inc(*self.labels, str(self.status))
+        return False
+
+def record_retry(method, path):
+    API_RETRIES.inc(method, endpoint_label(path))
+
+def record_rejected(method, path):
+    API_RESPONSES.inc(method, endpoint_label(path), 'circuit_open')
+
+def record_rate_limit_wait(seconds, outcome='acquired'):
+    RATE_LIMIT_WAIT.observe(seconds, outcome)
+
+def record_breaker_state(base_url, state, opened=False):
+    """
+    Publishes a circuit breaker's current state; ``opened`` counts a transition to open.
+    """
+    for name in BREAKER_STATES:
+        BREAKER_STATE.set(base_url, name, value=int(name == state))
+    if opened:
+        BREAKER_OPENED.inc(base_url)
+
+def timed_view(name):
+    """
+    Records the duration and response status of a sync or async view in
+    discourse_sso_view_duration_seconds under view=``name``.
+    """
+    def decorator(view):
+        if iscoroutinefunction(view):
+            async def wrapper(request, *args, **kwargs):
+                started = time.perf_counter()
+                status = 500
+                try:
+                    response = await view(request, *args, **kwargs)
+                    status = response.status_code
+                    return response
+                finally:
+                    SSO_DURATION.observe(time.perf_counter() - started, name, str(status))
+        else:
+            def wrapper(request, *args, **kwargs):
+                started = time.perf_counter()
+                status = 500
+                try:
+                    response = view(request, *args, **kwargs)
+                    status = response.status_code
+                    return response
+                finally:
+                    SSO_DURATION.observe(time.perf_counter() - started, name, str(status))
+        return functools.wraps(view)(wrapper)
+    return decorator
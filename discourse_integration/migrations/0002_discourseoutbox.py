@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:38
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('discourse_integration', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DiscourseOutbox',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('user_id', models.BigIntegerField(db_index=True)),
+                ('action', models.CharField(choices=[('create', 'Create'), ('update', 'Update')], max_length=10)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('available_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+            ],
+            options={
+                'ordering': ['id'],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('discourse_integration', '0003_discoursesynccheckpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='discourseprofile',
+            name='payload_hash',
+            field=models.CharField(blank=True, help_text='Hash of the user fields last sent to Discourse', max_length=64),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('discourse_integration', '0004_discourseprofile_payload_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DiscourseUserIndex',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('discourse_user_id', models.IntegerField(unique=True)),
+                ('username', models.CharField(db_index=True, max_length=255)),
+                ('email', models.CharField(blank=True, db_index=True, max_length=254)),
+                ('external_id', models.CharField(blank=True, db_index=True, max_length=255, null=True)),
+                ('active', models.BooleanField(default=True)),
+                ('refreshed_at', models.DateTimeField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:03
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def mark_existing_synced(apps, schema_editor):
+    # Profiles synced before this migration keep their history as 'synced'
+    DiscourseProfile = apps.get_model('discourse_integration', 'DiscourseProfile')
+    DiscourseProfile.objects.filter(discourse_user_id__isnull=False, last_synced_at__isnull=False).update(sync_status='synced')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('discourse_integration', '0005_discourseuserindex'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='discourseprofile',
+            name='last_error',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='discourseprofile',
+            name='sync_attempts',
+            field=models.PositiveSmallIntegerField(default=0, help_text='Consecutive failed sync attempts'),
+        ),
+        migrations.AddField(
+            model_name='discourseprofile',
+            name='sync_status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('synced', 'Synced'), ('failed', 'Failed')], default='pending', max_length=10),
+        ),
+        migrations.RunPython(mark_existing_synced, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='discourseprofile',
+            index=models.Index(fields=['sync_status', 'last_synced_at'], name='discourse_profile_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='discourseprofile',
+            index=models.Index(condition=models.Q(('discourse_user_id__isnull', True)), fields=['user'], name='discourse_profile_unlinked_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('discourse_integration', '0006_discourseprofile_sync_state'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='discourseoutbox',
+            name='discourse_user_id',
+            field=models.IntegerField(blank=True, help_text='Discourse account to delete (delete rows only)', null=True),
+        ),
+        migrations.AlterField(
+            model_name='discourseoutbox',
+            name='action',
+            field=models.CharField(choices=[('create', 'Create'), ('update', 'Update'), ('delete', 'Delete')], max_length=10),
+        ),
+    ]
@@ -2,41 +2,139 @@
 
 from django.db import models
 from django.conf import settings
-from django.db.models.signals import post_save, post_delete
-from django.dispatch import receiver
+from django.utils import timezone
+
+class DiscourseProfileQuerySet(models.QuerySet):
+    def failed(self):
+        return self.filter(sync_status=DiscourseProfile.FAILED)
+
+    def stale(self, before):
+        """
+        Synced profiles not refreshed since ``before``.
+        """
+        return self.filter(sync_status=DiscourseProfile.SYNCED, last_synced_at__lt=before)
+
+    def unlinked(self):
+        return self.filter(discourse_user_id__isnull=True)
 
 class DiscourseProfile(models.Model):
     """
     Links a Django user to their Discourse representation.
+
+    sync_status records the outcome of the last sync: pending (never synced,
+    or linked without sending the current data), synced or failed. When the
+    next attempt is due is tracked by the outbox row, not here.
     """
+    PENDING = 'pending'
+    SYNCED = 'synced'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (SYNCED, 'Synced'),
+        (FAILED, 'Failed'),
+    ]
+    SYNC_STATE_FIELDS = ['sync_status', 'sync_attempts', 'last_error']
+
     user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='discourse_profile')
     discourse_user_id = models.IntegerField(unique=True, null=True, blank=True, help_text="Discourse user ID")
     last_synced_at = models.DateTimeField(null=True, blank=True)
+    payload_hash = models.CharField(max_length=64, blank=True, help_text="Hash of the user fields last sent to Discourse")
+    sync_status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    sync_attempts = models.PositiveSmallIntegerField(default=0, help_text="Consecutive failed sync attempts")
+    last_error = models.TextField(blank=True)
+
+    objects = DiscourseProfileQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Dashboards: counts per status and stale synced profiles
+            models.Index(fields=['sync_status', 'last_synced_at'], name='discourse_profile_status_idx'),
+            # resolve_discourse_ids and backfills: profiles without a Discourse ID
+            models.Index(fields=['user'], name='discourse_profile_unlinked_idx', condition=models.Q(discourse_user_id__isnull=True)),
+        ]
 
     def __str__(self):
         return f"Discourse Profile for {self.user.username}"
 
-# Signal to create a DiscourseProfile when a new user is created
-@receiver(post_save, sender=settings.AUTH_USER_MODEL)
-def create_discourse_profile(sender, instance, created, **kwargs):
-    if created and not (instance.is_staff or instance.is_superuser): # Do not create profiles for admins
-        DiscourseProfile.objects.get_or_create(user=instance)
-
-# Signal to potentially handle Discourse user deletion when a Django user is deleted
-# For a basic setup without Celery, this will just print a message.
-# In a production setup, this would trigger an async task to delete the user in Discourse.
-@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
-def delete_discourse_user_signal(sender, instance, **kwargs):
-    if not (instance.is_staff or instance.is_superuser): # Do not attempt to delete admins from Discourse
-        try:
-            profile = instance.discourse_profile
-            if profile.discourse_user_id:
-                print(f"Django user {instance.username} (Discourse ID: {profile.discourse_user_id}) deleted. "
-                      f"Manual deletion in Discourse might be required if not handled by a background task.")
-                # In a production system, you would trigger an async task here:
-                # from .tasks import delete_discourse_user_task
-                # delete_discourse_user_task.delay(profile.discourse_user_id)
-        except DiscourseProfile.DoesNotExist:
-            pass # No Discourse profile to delete
+    def set_synced(self, payload_hash):
+        """
+        Records a successful sync of ``payload_hash``. Returns the fields to save.
+        """
+        self.last_synced_at = timezone.now()
+        self.payload_hash = payload_hash
+        self.sync_status = self.SYNCED
+        self.sync_attempts = 0
+        self.last_error = ''
+        return ['last_synced_at', 'payload_hash'] + self.SYNC_STATE_FIELDS
+
+    def set_failed(self, error):
+        """
+        Records a failed sync. Returns the fields to save.
+        """
+        self.sync_status = self.FAILED
+        self.sync_attempts = min(self.sync_attempts + 1, 32767)
+        self.last_error = str(error)[:2000]
+        return self.SYNC_STATE_FIELDS
+
+class DiscourseOutbox(models.Model):
+    """
+    Pending Discourse sync work, written in the same transaction as the user change
+    and drained in batches by discourse_integration.tasks.drain_outbox.
+    Delete rows carry the Discourse ID, as the user and profile rows are gone.
+    """
+    CREATE = 'create'
+    UPDATE = 'update'
+    DELETE = 'delete'
+    ACTION_CHOICES = [
+        (CREATE, 'Create'),
+        (UPDATE, 'Update'),
+        (DELETE, 'Delete'),
+    ]
+
+    # A plain integer rather than a foreign key keeps the row compact and
+    # lets it outlive the user row.
+    user_id = models.BigIntegerField(db_index=True)
+    action = models.CharField(max_length=10, choices=ACTION_CHOICES)
+    discourse_user_id = models.IntegerField(null=True, blank=True, help_text="Discourse account to delete (delete rows only)")
+    created_at = models.DateTimeField(auto_now_add=True)
+    available_at = models.DateTimeField(default=timezone.now, db_index=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
 
+    class Meta:
+        ordering = ['id']
+
+    def __str__(self):
+        return f"Discourse {self.action} for user {self.user_id}"
+
+class DiscourseUserIndex(models.Model):
+    """
+    Local copy of the identifying fields of every Discourse user, streamed from
+    admin/users/list by discourse_integration.index. Lets creates and reconciliation
+    find existing Discourse accounts without one HTTP call per user.
+    Usernames and emails are stored lowercased.
+    """
+    discourse_user_id = models.IntegerField(unique=True)
+    username = models.CharField(max_length=255, db_index=True)
+    email = models.CharField(max_length=254, blank=True, db_index=True)
+    external_id = models.CharField(max_length=255, null=True, blank=True, db_index=True)
+    active = models.BooleanField(default=True)
+    refreshed_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"Discourse user {self.discourse_user_id} ({self.username})"
+
+class DiscourseSyncCheckpoint(models.Model):
+    """
+    Progress marker for resumable bulk jobs such as sync_discourse_users.
+    Every user with a primary key up to last_user_id has been processed.
+    """
+    name = models.CharField(max_length=100, unique=True)
+    last_user_id = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name} at user {self.last_user_id}"
 
+# DiscourseProfile rows for new users are created by the post_save dispatcher
+# in discourse_integration.signals, together with the sync bookkeeping. The
+# delete receivers there queue Discourse deletions for deleted users.
@@ -0,0 +1,179 @@
+# discourse_integration/profiling.py
+import logging
+import os
+import random
+import sys
+import threading
+from collections import Counter
+from asgiref.sync import iscoroutinefunction
+from django.core.exceptions import MiddlewareNotUsed
+from .conf import get_setting
+
+logger = logging.getLogger(__name__)
+
+MAX_STACK_DEPTH = 128
+
+_writers = {}
+_writers_lock = threading.Lock()
+
+def frame_label(frame):
+    """
+    The collapsed-stack name for a frame: ``module:function``.
+    """
+    module = frame.f_globals.get('__name__', '?')
+    return f"{module}:{frame.f_code.co_name}".replace(';', ':').replace(' ', '_')
+
+def collapse(frame):
+    """
+    The stack ending at ``frame``, root first, as a tuple of frame labels.
+    """
+    labels = []
+    while frame is not None and len(labels) < MAX_STACK_DEPTH:
+        labels.append(frame_label(frame))
+        frame = frame.f_back
+    labels.reverse()
+    return tuple(labels)
+
+class StackSampler:
+    """
+    Samples one thread's Python stack every ``interval`` seconds from a
+    background thread until stop() is called, counting identical stacks.
+    The sampled thread runs undisturbed; it only pays for the GIL handoffs.
+    """
+
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='discourse-profiler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        return self.stacks
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                return
+            self.stacks[collapse(frame)] += 1
+            del frame # Don't keep the sampled thread's locals alive
+
+class CollapsedStackWriter:
+    """
+    Appends collapsed stacks (``frame;frame;frame count`` lines, as read by
+    flamegraph.pl, speedscope and inferno) to ``<directory>/<prefix>-<pid>.collapsed``.
+    The file is rotated at ``max_bytes``, keeping ``backups`` older files.
+    """
+
+    def __init__(self, directory, max_bytes, backups, prefix='profile'):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.path = os.path.join(directory, f"{prefix}-{os.getpid()}.collapsed")
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def write(self, stacks, root=None):
+        lines = []
+        for stack, count in stacks.items():
+            frames = (root,) + stack if root else stack
+            lines.append(f"{';'.join(frames)} {count}\n")
+        data = ''.join(lines).encode('utf-8')
+        if not data:
+            return
+        with self._lock:
+            try:
+                size = os.path.getsize(self.path)
+            except OSError:
+                size = 0
+            if size and size + len(data) > self.max_bytes:
+                self._rotate()
+            with open(self.path, 'ab') as f:
+                f.write(data)
+
+    def _rotate(self):
+        if self.backups < 1:
+            os.remove(self.path)
+            return
+        for index in range(self.backups - 1, 0, -1):
+            source = f"{self.path}.{index}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{index + 1}")
+        os.replace(self.path, f"{self.path}.1")
+
+def get_stack_writer():
+    """
+    Returns the process-wide writer for DISCOURSE_PROFILER_DIR.
+    """
+    key = (get_setting('DISCOURSE_PROFILER_DIR'), get_setting('DISCOURSE_PROFILER_MAX_BYTES'), get_setting('DISCOURSE_PROFILER_BACKUPS'))
+    writer = _writers.get(key)
+    if writer is None:
+        with _writers_lock:
+            writer = _writers.get(key)
+            if writer is None:
+                writer = _writers[key] = CollapsedStackWriter(*key)
+    return writer
+
+class SamplingProfilerMiddleware:
+    """
+    Profiles a random DISCOURSE_PROFILER_RATE fraction of requests whose URL
+    name is in DISCOURSE_PROFILER_URL_NAMES (every request when empty) and
+    appends their stacks, rooted at the URL name, to collapsed-stack files in
+    DISCOURSE_PROFILER_DIR. Merge them with the merge_profiles command.
+
+    With a rate of 0 Django drops the middleware at startup; otherwise an
+    unsampled request costs one random() call. Only sync (WSGI) request handling
+    is profiled. Under ASGI the middleware also drops itself: views run on the
+    event loop thread, where samples would charge other coroutines' frames to
+    the sampled view. Being async-capable, it never forces a thread hop there.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.rate = get_setting('DISCOURSE_PROFILER_RATE')
+        if not self.rate or not get_setting('DISCOURSE_PROFILER_DIR'):
+            raise MiddlewareNotUsed("Discourse request profiling is disabled.")
+        if iscoroutinefunction(get_response):
+            raise MiddlewareNotUsed("Discourse request profiling only samples sync request handling.")
+        self.url_names = frozenset(get_setting('DISCOURSE_PROFILER_URL_NAMES'))
+        self.interval = get_setting('DISCOURSE_PROFILER_INTERVAL')
+
+    def __call__(self, request):
+        try:
+            return self.get_response(request)
+        finally:
+            sampler = getattr(request, '_discourse_profiler', None)
+            if sampler is not None:
+                stacks = sampler.stop()
+                try:
+                    get_stack_writer().write(stacks, root=request.resolver_match.view_name)
+                except OSError as e:
+                    logger.warning("Could not write request profile: %s", e)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if random.random() >= self.rate:
+            return None
+        if self.url_names and request.resolver_match.view_name not in self.url_names:
+            return None
+        request._discourse_profiler = StackSampler(threading.get_ident(), self.interval).start()
+        return None
+
+def read_collapsed(path):
+    """
+    Yields (stack tuple, count) from a collapsed-stack file, skipping malformed lines.
+    """
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            stack, _, count = line.rstrip('\n').rpartition(' ')
+            if not stack or not count.isdigit():
+                continue
+            yield tuple(stack.split(';')), int(count)
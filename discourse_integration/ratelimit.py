@@ -0,0 +1,366 @@
+# discourse_integration/ratelimit.py
+import asyncio
+import logging
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from email.utils import parsedate_to_datetime
+from django.core.cache import caches
+from .conf import get_setting
+from .metrics import record_rate_limit_wait
+
+logger = logging.getLogger(__name__)
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+# Longest wait for the limiter allowed in the current context (None: unbounded);
+# set by bounded_wait() around interactive calls such as SSO provisioning.
+_max_wait = ContextVar('discourse_rate_limit_max_wait', default=None)
+
+# How often async callers re-check for a free concurrency slot
+SLOT_POLL_INTERVAL = 0.01
+
+# Rate-limit reset headers above this are Unix timestamps rather than delta-seconds
+EPOCH_RESET_THRESHOLD = 1e9
+
+class RateLimitTimeout(Exception):
+    """
+    Raised when the limiter cannot let a request through within the caller's
+    max_wait. retry_after is the wait that was needed, when known.
+    """
+    def __init__(self, retry_after=None):
+        super().__init__("No Discourse rate limit slot within the allowed wait.")
+        self.retry_after = retry_after
+
+@contextmanager
+def bounded_wait(max_wait):
+    """
+    Limits how long Discourse calls inside the block wait for the rate limiter,
+    and for retry backoff, to ``max_wait`` seconds. Longer waits raise
+    DiscourseRateLimited, so interactive callers can hand the work to the outbox.
+    """
+    token = _max_wait.set(max_wait)
+    try:
+        yield
+    finally:
+        _max_wait.reset(token)
+
+def current_max_wait():
+    return _max_wait.get()
+
+def cap_wait(seconds):
+    """
+    ``seconds``, lowered to the current bounded_wait() limit if there is one.
+    """
+    max_wait = _max_wait.get()
+    return seconds if max_wait is None else min(seconds, max_wait)
+
+def _deadline(max_wait):
+    return None if max_wait is None else time.monotonic() + max_wait
+
+def _remaining(deadline):
+    return None if deadline is None else max(0.0, deadline - time.monotonic())
+
+def _check_wait(delay, deadline):
+    if deadline is not None and time.monotonic() + delay > deadline:
+        raise RateLimitTimeout(delay)
+
+@contextmanager
+def _recorded_wait():
+    """
+    Records the time spent waiting for the limiter in discourse_rate_limit_wait_seconds.
+    """
+    started = time.monotonic()
+    try:
+        yield
+    except RateLimitTimeout:
+        record_rate_limit_wait(time.monotonic() - started, 'timeout')
+        raise
+    record_rate_limit_wait(time.monotonic() - started)
+
+def parse_retry_after(value):
+    """
+    Returns the delay in seconds from a Retry-After header (seconds or HTTP date), or None.
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def parse_rate_limit_reset(value):
+    """
+    Returns the delay in seconds from an X-RateLimit-Reset or RateLimit-Reset
+    header, or None. Gateways send either delta-seconds or a Unix timestamp;
+    the delay is capped at DISCOURSE_RETRY_MAX_BACKOFF so a misread header
+    cannot stall every Discourse call in the process.
+    """
+    try:
+        reset = float(value)
+    except (TypeError, ValueError):
+        return None
+    if reset > EPOCH_RESET_THRESHOLD:
+        reset -= time.time()
+    return min(max(0.0, reset), get_setting('DISCOURSE_RETRY_MAX_BACKOFF'))
+
+class RateLimiter:
+    """
+    Client-side limiter for outgoing Discourse API traffic within one process.
+
+    Combines a token bucket (``per_minute`` requests, bursts of up to ``burst``)
+    with an adaptive cap on concurrent requests: the cap halves whenever
+    Discourse answers 429 and grows back by one after a run of successes.
+    A Retry-After or exhausted rate-limit header pauses all callers until the
+    server's window reopens. Callers may bound their wait with ``max_wait``.
+    """
+
+    def __init__(self, per_minute, burst, max_concurrency):
+        self.rate = per_minute / 60.0
+        self.capacity = float(burst)
+        self.max_concurrency = max_concurrency
+        self.concurrency = max_concurrency
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._in_flight = 0
+        self._successes = 0
+        self._lock = threading.Lock()
+        self._slot_available = threading.Condition(self._lock)
+
+    def try_acquire(self):
+        """
+        Takes one token if available. Returns 0 on success, otherwise the
+        number of seconds to wait before trying again.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if now < self._blocked_until:
+                return self._blocked_until - now
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self, max_wait=None):
+        """
+        Waits for a token; raises RateLimitTimeout instead of waiting past ``max_wait`` seconds.
+        """
+        deadline = _deadline(max_wait)
+        while True:
+            delay = self.try_acquire()
+            if not delay:
+                return
+            _check_wait(delay, deadline)
+            time.sleep(delay)
+
+    async def atry_acquire(self):
+        """
+        try_acquire() for coroutines. The in-process bucket never blocks on I/O.
+        """
+        return self.try_acquire()
+
+    async def aacquire(self, max_wait=None):
+        deadline = _deadline(max_wait)
+        while True:
+            delay = await self.atry_acquire()
+            if not delay:
+                return
+            _check_wait(delay, deadline)
+            await asyncio.sleep(delay)
+
+    def _try_enter(self):
+        with self._lock:
+            if self._in_flight >= self.concurrency:
+                return False
+            self._in_flight += 1
+            return True
+
+    def _enter(self, deadline):
+        with self._slot_available:
+            while self._in_flight >= self.concurrency:
+                timeout = _remaining(deadline)
+                if timeout == 0:
+                    raise RateLimitTimeout()
+                self._slot_available.wait(timeout)
+            self._in_flight += 1
+
+    def _leave(self):
+        with self._slot_available:
+            self._in_flight -= 1
+            self._slot_available.notify()
+
+    @contextmanager
+    def slot(self, max_wait=None):
+        """
+        Holds a token and one of the adaptive concurrency slots for the duration
+        of a request. Raises RateLimitTimeout if both are not free within ``max_wait`` seconds.
+        """
+        deadline = _deadline(max_wait)
+        with _recorded_wait():
+            self._enter(deadline)
+            try:
+                self.acquire(_remaining(deadline))
+            except BaseException:
+                self._leave()
+                raise
+        try:
+            yield
+        finally:
+            self._leave()
+
+    @asynccontextmanager
+    async def aslot(self, max_wait=None):
+        """
+        slot() for coroutines: the same token bucket and concurrency cap, waited
+        for without blocking the event loop.
+        """
+        deadline = _deadline(max_wait)
+        with _recorded_wait():
+            while not self._try_enter():
+                _check_wait(SLOT_POLL_INTERVAL, deadline)
+                await asyncio.sleep(SLOT_POLL_INTERVAL)
+            try:
+                await self.aacquire(_remaining(deadline))
+            except BaseException:
+                self._leave()
+                raise
+        try:
+            yield
+        finally:
+            self._leave()
+
+    def pause(self, seconds):
+        """
+        Stops handing out tokens for ``seconds``.
+        """
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+            self._tokens = 0
+
+    def observe(self, status_code, headers):
+        """
+        Adjusts the limiter from a Discourse response. Returns the Retry-After delay for 429s.
+        """
+        if status_code == 429:
+            retry_after = parse_retry_after(headers.get('Retry-After'))
+            if retry_after is None:
+                retry_after = 60 / max(self.rate * 60, 1)
+            self.pause(retry_after)
+            with self._lock:
+                self.concurrency = max(1, self.concurrency // 2)
+                self._successes = 0
+            logger.warning("Discourse rate limit hit; pausing %.1fs, concurrency now %s.", retry_after, self.concurrency)
+            return retry_after
+
+        remaining = headers.get('X-RateLimit-Remaining') or headers.get('RateLimit-Remaining')
+        if remaining is not None and str(remaining).strip() == '0':
+            reset = parse_rate_limit_reset(headers.get('X-RateLimit-Reset') or headers.get('RateLimit-Reset'))
+            if reset:
+                self.pause(reset)
+
+        with self._slot_available:
+            self._successes += 1
+            if self.concurrency < self.max_concurrency and self._successes >= self.concurrency:
+                self.concurrency += 1
+                self._successes = 0
+                self._slot_available.notify()
+        return None
+
+class CacheRateLimiter(RateLimiter):
+    """
+    Cross-process variant that counts requests in a shared Django cache, so every
+    web and worker process draws from the same Discourse budget.
+
+    Requests are counted in fixed windows of 60 * burst / per_minute seconds that
+    admit ``burst`` requests each: the average stays at ``per_minute``, and at
+    most 2 * burst requests go out around a window boundary. Needs a cache with
+    atomic incr (Redis, memcached) to be exact. Async callers count through the
+    cache's async API (aget/aadd/aincr), so the event loop never blocks on it.
+    """
+
+    def __init__(self, per_minute, burst, max_concurrency, cache_alias='default', key_prefix='discourse:ratelimit'):
+        super().__init__(per_minute, burst, max_concurrency)
+        self.per_minute = per_minute
+        self.burst = max(1, int(burst))
+        self.window = 60.0 * self.burst / per_minute
+        self.cache = caches[cache_alias]
+        self.key_prefix = key_prefix
+
+    def _blocked_for(self, blocked_until, now):
+        return blocked_until - now if blocked_until and now < blocked_until else 0
+
+    def _window(self, now):
+        """
+        Returns the cache key counting the window ``now`` falls in, the key's
+        timeout, and the seconds until the next window opens.
+        """
+        index = int(now // self.window)
+        return f"{self.key_prefix}:{index}", int(2 * self.window) + 1, (index + 1) * self.window - now
+
+    def try_acquire(self):
+        now = time.time()
+        blocked = self._blocked_for(self.cache.get(f"{self.key_prefix}:blocked_until"), now)
+        if blocked:
+            return blocked
+        key, timeout, reopens_in = self._window(now)
+        self.cache.add(key, 0, timeout=timeout)
+        try:
+            count = self.cache.incr(key)
+        except ValueError: # Key expired between add and incr
+            self.cache.add(key, 1, timeout=timeout)
+            count = 1
+        return 0 if count <= self.burst else reopens_in
+
+    async def atry_acquire(self):
+        now = time.time()
+        blocked = self._blocked_for(await self.cache.aget(f"{self.key_prefix}:blocked_until"), now)
+        if blocked:
+            return blocked
+        key, timeout, reopens_in = self._window(now)
+        await self.cache.aadd(key, 0, timeout=timeout)
+        try:
+            count = await self.cache.aincr(key)
+        except ValueError: # Key expired between add and incr
+            await self.cache.aadd(key, 1, timeout=timeout)
+            count = 1
+        return 0 if count <= self.burst else reopens_in
+
+    def pause(self, seconds):
+        super().pause(seconds)
+        self.cache.set(f"{self.key_prefix}:blocked_until", time.time() + seconds, timeout=int(seconds) + 1)
+
+def get_rate_limiter():
+    """
+    Returns the limiter shared by every DiscourseAPI in this process, or None when
+    DISCOURSE_RATE_LIMIT_PER_MINUTE is unset.
+    """
+    per_minute = get_setting('DISCOURSE_RATE_LIMIT_PER_MINUTE')
+    if not per_minute:
+        return None
+    key = (
+        per_minute,
+        get_setting('DISCOURSE_RATE_LIMIT_BURST'),
+        get_setting('DISCOURSE_MAX_CONCURRENCY'),
+        get_setting('DISCOURSE_RATE_LIMIT_CACHE'),
+    )
+    limiter = _limiters.get(key)
+    if limiter is None:
+        with _limiters_lock:
+            limiter = _limiters.get(key)
+            if limiter is None:
+                per_minute, burst, max_concurrency, cache_alias = key
+                if cache_alias:
+                    limiter = CacheRateLimiter(per_minute, burst, max_concurrency, cache_alias=cache_alias)
+                else:
+                    limiter = RateLimiter(per_minute, burst, max_concurrency)
+                _limiters[key] = limiter
+    return limiter
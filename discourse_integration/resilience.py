@@ -0,0 +1,133 @@
+# discourse_integration/resilience.py
+import logging
+import random
+import threading
+import time
+from .conf import get_setting
+from .metrics import record_breaker_state
+
+logger = logging.getLogger(__name__)
+
+# Methods Discourse treats idempotently; only these are retried automatically.
+IDEMPOTENT_METHODS = frozenset({'GET', 'HEAD', 'PUT', 'DELETE'})
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+def backoff_delay(attempt, retry_after=None):
+    """
+    Full-jitter exponential backoff for retry number ``attempt`` (0-based).
+    A server-supplied Retry-After is used as a lower bound.
+    """
+    cap = min(get_setting('DISCOURSE_RETRY_MAX_BACKOFF'), get_setting('DISCOURSE_RETRY_BACKOFF') * 2 ** attempt)
+    delay = random.uniform(0, cap)
+    if retry_after:
+        delay = max(delay, retry_after)
+    return delay
+
+class CircuitBreaker:
+    """
+    Fails Discourse calls fast after ``failure_threshold`` consecutive failures.
+
+    closed: requests flow normally.
+    open: requests are rejected until ``reset_timeout`` seconds have passed.
+    half_open: a single probe request is let through; its outcome closes
+    the breaker or opens it again.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.times_opened = 0
+        self.rejected = 0
+        self._probing = False
+        self._lock = threading.Lock()
+        record_breaker_state(name, self.state)
+
+    def allow_request(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self._transition(self.HALF_OPEN)
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            self.rejected += 1
+            return False
+
+    def retry_after(self):
+        """
+        Seconds until the breaker will let a probe through.
+        """
+        return max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._probing = False
+            if self.state != self.CLOSED:
+                self._transition(self.CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.failure_threshold):
+                self.opened_at = time.monotonic()
+                self.times_opened += 1
+                self._transition(self.OPEN)
+
+    def release(self):
+        """
+        Gives back a permission from allow_request() for a request that was never sent.
+        """
+        with self._lock:
+            self._probing = False
+
+    def reset(self):
+        with self._lock:
+            self.failures = 0
+            self._probing = False
+            self.state = self.CLOSED
+        record_breaker_state(self.name, self.state)
+
+    def snapshot(self):
+        """
+        Current state and counters, for logging. The metrics endpoint exports
+        the state and open count as discourse_circuit_breaker_* series.
+        """
+        return {
+            'state': self.state,
+            'consecutive_failures': self.failures,
+            'times_opened': self.times_opened,
+            'rejected': self.rejected,
+        }
+
+    def _transition(self, state):
+        logger.warning("Discourse circuit breaker for %s: %s -> %s (%s consecutive failures).", self.name, self.state, state, self.failures)
+        self.state = state
+        record_breaker_state(self.name, state, opened=state == self.OPEN)
+
+def get_circuit_breaker(base_url):
+    """
+    Returns the process-wide circuit breaker for a Discourse base URL.
+    """
+    breaker = _breakers.get(base_url)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.get(base_url)
+            if breaker is None:
+                breaker = _breakers[base_url] = CircuitBreaker(
+                    base_url,
+                    failure_threshold=get_setting('DISCOURSE_BREAKER_FAILURE_THRESHOLD'),
+                    reset_timeout=get_setting('DISCOURSE_BREAKER_RESET_TIMEOUT'),
+                )
+    return breaker
@@ -1,40 +1,144 @@
 # discourse_integration/signals.py
 import logging
-from django.db.models.signals import post_save
+import threading
+from django.db.models import QuerySet
+from django.db.models.signals import post_delete, post_save, pre_delete
 from django.dispatch import receiver
 from django.conf import settings # noqa: F401 (Suppress unused-import warning)
 from django.contrib.auth import get_user_model
-from .api import DiscourseAPI
+from .api import SYNCED_USER_FIELDS
+from .bulk import current_suspension
+from .models import DiscourseOutbox, DiscourseProfile
+from .tasks import enqueue_deletions, enqueue_sync, provisions_on_first_visit
 
 logger = logging.getLogger(__name__)
 User = get_user_model()
 
+# Deletions collected while Django's Collector deletes users in this thread
+_deletions = threading.local()
+
+def get_cached_profile(user):
+    """
+    Returns the user's DiscourseProfile, or None. The profile is cached on the
+    instance, so repeated calls during one save cost at most one query.
+    """
+    try:
+        return user.discourse_profile
+    except DiscourseProfile.DoesNotExist:
+        return None
+
 @receiver(post_save, sender=User)
-def user_post_save_handler(sender, instance, created, **kwargs):
+def user_post_save_handler(sender, instance, created, update_fields=None, raw=False, **kwargs):
     """
-    Handles post_save signal for Django User model.
-    Synchronizes user to Discourse, but skips superusers.
+    Handles post_save signal for Django User model. This is the app's only
+    post_save receiver: it creates the DiscourseProfile for new users and
+    queues the user for Discourse synchronization, but skips superusers.
+    With DISCOURSE_PROVISIONING = 'first_visit', only users already linked to a
+    Discourse account are queued.
+
+    The outbox row is written in the same transaction as the user row, so it is
+    discarded on rollback and the HTTP call happens later in
+    discourse_integration.tasks.drain_outbox, off the request path.
+
+    Query budget per save: 0 for saves that touch no synced field (last_login,
+    password) and for staff; 2 for a signup (profile and outbox inserts); at
+    most 2 for an edit (coalescing check and outbox insert), plus one profile
+    lookup with first-visit provisioning.
     """
+    # Fixture loading saves raw rows; related objects come from the fixture too
+    if raw:
+        return
+
     # Prevent synchronization for Django superusers or staff
     if instance.is_staff or instance.is_superuser:
-        logger.info(f"Skipping Discourse sync for superuser or staff: {instance.username}")
+        logger.debug("Skipping Discourse sync for superuser or staff: %s", instance.username)
+        return
+
+    # Saves limited to fields Discourse does not mirror (last_login on sign-in,
+    # password changes) need no sync.
+    if not created and update_fields is not None and not SYNCED_USER_FIELDS.intersection(update_fields):
+        return
+
+    # Inside bulk.suspended_sync() saves are only collected, then synced in one batch
+    suspension = current_suspension()
+    if suspension is not None:
+        suspension.add(instance)
         return
 
+    if created:
+        # A new user cannot have a profile yet, so a plain insert is enough;
+        # assigning the user also caches the profile on the instance.
+        DiscourseProfile.objects.create(user=instance)
+
     # Optional: Skip if not an active user (e.g., if you have other custom user types that shouldn't sync)
     if not instance.is_active:
-        logger.info(f"Skipping Discourse sync for inactive user: {instance.username}")
+        logger.debug("Skipping Discourse sync for inactive user: %s", instance.username)
         return
 
-    try:
-        discourse_api = DiscourseAPI()
-        if created:
-            logger.info(f"Attempting to create Discourse user for Django user {instance.username}")
-            discourse_api.create_user(instance) # This will now also update DiscourseProfile
-            logger.info(f"Successfully created user {instance.username} in Discourse.")
-        else:
-            logger.info(f"Attempting to update Discourse user for Django user {instance.username}")
-            discourse_api.update_user(instance) # This will now use DiscourseProfile's ID
-            logger.info(f"Successfully updated user {instance.username} in Discourse.")
-
-    except Exception as e:
-        logger.error(f"An unexpected error occurred during direct sync for user ID {instance.id}: {e}")
+    if provisions_on_first_visit():
+        # Accounts are created when the user first opens the forum; until then
+        # there is nothing in Discourse to create or update.
+        profile = None if created else get_cached_profile(instance)
+        if profile is None or not profile.discourse_user_id:
+            return
+
+    action = DiscourseOutbox.CREATE if created else DiscourseOutbox.UPDATE
+    if enqueue_sync(instance.pk, action):
+        logger.debug("Queued Discourse %s for Django user %s", action, instance.username)
+
+def _deletion_state():
+    if not hasattr(_deletions, 'pending'):
+        _deletions.pending = []
+        _deletions.user_ids = set()
+    return _deletions
+
+def _deletes_profiles_only(origin):
+    """
+    True when a delete() was started on profiles rather than on their users.
+    """
+    if isinstance(origin, QuerySet):
+        return issubclass(origin.model, DiscourseProfile)
+    return isinstance(origin, DiscourseProfile)
+
+# Deleting users queues the deletion of their Discourse accounts. A delete(),
+# whether started on users or cascading to them from another model, sends
+# pre_delete for every user, then deletes the profiles (post_delete per
+# profile), then the users (post_delete per user). The receivers below use that
+# order: profiles are collected in memory and the first user post_delete
+# writes them all with one bulk insert, in the same transaction. Cascaded and
+# bulk deletes of thousands of users never wait for Discourse, and cost no
+# query per user.
+
+@receiver(pre_delete, sender=User)
+def user_pre_delete_handler(sender, instance, **kwargs):
+    """
+    Notes the users whose Discourse accounts go with them: everyone but staff
+    and superusers.
+    """
+    state = _deletion_state()
+    state.pending.clear() # Left over only if an earlier delete() failed
+    if not (instance.is_staff or instance.is_superuser):
+        state.user_ids.add(instance.pk)
+
+@receiver(post_delete, sender=DiscourseProfile)
+def profile_post_delete_handler(sender, instance, origin=None, **kwargs):
+    """
+    Collects the Discourse account of a linked profile deleted along with its user.
+    """
+    if not instance.discourse_user_id or _deletes_profiles_only(origin):
+        return
+    state = _deletion_state()
+    if instance.user_id in state.user_ids:
+        state.pending.append((instance.user_id, instance.discourse_user_id))
+
+@receiver(post_delete, sender=User)
+def user_post_delete_handler(sender, instance, **kwargs):
+    """
+    Queues the collected Discourse deletions for the outbox worker.
+    """
+    state = _deletion_state()
+    state.user_ids.discard(instance.pk)
+    if state.pending:
+        entries, state.pending = state.pending, []
+        enqueue_deletions(entries)
+        logger.info("Queued deletion of %s Discourse accounts.", len(entries))
@@ -0,0 +1,262 @@
+# discourse_integration/sso.py
+import base64
+import binascii
+import hashlib
+import hmac
+import secrets
+import threading
+import time
+from urllib.parse import quote_plus, unquote_plus, urlencode
+from django.conf import settings
+from django.core.cache import caches
+from .conf import get_setting
+from .lookup_cache import TTLCache
+
+_codecs = {}
+_codecs_lock = threading.Lock()
+_nonce_signers = {}
+_replay_caches = {}
+_nonces_lock = threading.Lock()
+
+_HEX_DIGITS = frozenset('0123456789abcdefABCDEF')
+# Standard base64 alphabet; Discourse versions that use Base64.encode64 also wrap lines.
+_BASE64_CHARS = frozenset('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/=\n')
+_SIGNATURE_LENGTH = hashlib.sha256().digest_size * 2
+
+class SSOError(Exception):
+    """Raised for DiscourseConnect payloads that are oversized, malformed or wrongly signed."""
+
+def parse_payload(query):
+    """
+    Parses a decoded DiscourseConnect payload (a query string) into a dict in one pass.
+    The first value wins for repeated keys, matching parse_qs(...)[key][0].
+    """
+    params = {}
+    for pair in query.split('&'):
+        if not pair:
+            continue
+        key, sep, value = pair.partition('=')
+        if not sep:
+            continue
+        # Most keys and many values need no unescaping; skip the call for them
+        if '%' in key or '+' in key:
+            key = unquote_plus(key)
+        if key not in params:
+            params[key] = unquote_plus(value) if '%' in value or '+' in value else value
+    return params
+
+class SSOCodec:
+    """
+    Signs and verifies DiscourseConnect payloads with one shared secret.
+
+    The HMAC is keyed once, when the codec is built; each sign/verify copies
+    that state instead of re-deriving the key. Incoming payloads that are too
+    large or not base64, and signatures that are not SHA-256 hex digests, are
+    rejected before any hashing or decoding.
+    """
+
+    def __init__(self, secret, max_payload_length=4096):
+        self._mac = hmac.new(secret.encode('utf-8'), digestmod=hashlib.sha256)
+        self.max_payload_length = max_payload_length
+
+    def sign(self, sso):
+        mac = self._mac.copy()
+        mac.update(sso.encode('utf-8'))
+        return mac.hexdigest()
+
+    def encode(self, params):
+        """
+        Returns (sso, sig) for a dict of payload parameters.
+        """
+        sso = base64.b64encode(urlencode(params).encode('utf-8')).decode('ascii')
+        return sso, self.sign(sso)
+
+    def verify(self, sso, sig):
+        """
+        True when ``sig`` is the signature of ``sso``. Malformed input is simply unverified.
+        """
+        if not sso or not sig or len(sig) != _SIGNATURE_LENGTH or len(sso) > self.max_payload_length:
+            return False
+        if not _HEX_DIGITS.issuperset(sig) or not _BASE64_CHARS.issuperset(sso):
+            return False
+        return hmac.compare_digest(self.sign(sso), sig.lower())
+
+    def decode(self, sso, sig):
+        """
+        Verifies and decodes an incoming payload. Returns its parameters as a dict;
+        raises SSOError for anything that is not a correctly signed payload.
+        """
+        if not self.verify(sso, sig):
+            raise SSOError("Invalid DiscourseConnect payload or signature.")
+        try:
+            query = base64.b64decode(sso).decode('utf-8')
+        except (binascii.Error, UnicodeDecodeError) as e:
+            raise SSOError(f"Undecodable DiscourseConnect payload: {e}")
+        return parse_payload(query)
+
+    def login_url(self, params, endpoint=None):
+        """
+        Returns the URL that hands a signed payload to Discourse.
+        """
+        sso, sig = self.encode(params)
+        return f"{endpoint or settings.DISCOURSE_SSO_LOGIN_URL}?sso={quote_plus(sso)}&sig={sig}"
+
+def build_user_payload(user, nonce, return_sso_url=None):
+    """
+    The DiscourseConnect parameters that describe a Django user to Discourse.
+    """
+    return {
+        'nonce': nonce,
+        'return_sso_url': return_sso_url or settings.DISCOURSE_SSO_CALLBACK_URL,
+        'email': user.email,
+        'external_id': str(user.pk), # Use Django user ID as external_id
+        'username': user.username,
+        'name': user.get_full_name() or user.username, # Provide a name if available
+        # Add other parameters if needed, e.g., 'avatar_url', 'about_me', 'website'
+        # 'suppress_welcome_message': 'true', # To prevent Discourse welcome emails
+    }
+
+def get_sso_codec():
+    """
+    Returns the process-wide codec for the configured DISCOURSE_SSO_SECRET.
+    """
+    key = (settings.DISCOURSE_SSO_SECRET, get_setting('DISCOURSE_SSO_MAX_PAYLOAD_LENGTH'))
+    codec = _codecs.get(key)
+    if codec is None:
+        with _codecs_lock:
+            codec = _codecs.get(key)
+            if codec is None:
+                codec = _codecs[key] = SSOCodec(*key)
+    return codec
+
+class NonceSigner:
+    """
+    Issues self-validating SSO nonces of the form
+    ``<user_id>.<expires>.<forum>.<random>.<mac>``, so the callback can check who
+    started the handshake, and whether it came from the forum link, without a
+    session. The MAC uses a key derived from SECRET_KEY, which Discourse never sees.
+    """
+
+    def __init__(self, secret_key, ttl):
+        key = hashlib.sha256(b'discourse_integration.sso.nonce' + secret_key.encode('utf-8')).digest()
+        self._mac = hmac.new(key, digestmod=hashlib.sha256)
+        self.ttl = ttl
+
+    def _sign(self, body):
+        mac = self._mac.copy()
+        mac.update(body.encode('ascii'))
+        return mac.hexdigest()[:32]
+
+    def issue(self, user_id, forum=False):
+        body = f"{int(user_id)}.{int(time.time()) + self.ttl}.{int(bool(forum))}.{secrets.token_hex(8)}"
+        return f"{body}.{self._sign(body)}"
+
+    def verify(self, nonce):
+        """
+        Returns (user_id, forum, expires) for a nonce this signer issued and that
+        has not expired. Raises SSOError otherwise. Does not check for replays.
+        """
+        if not nonce or len(nonce) > 128:
+            raise SSOError("Malformed SSO nonce.")
+        body, _, mac = nonce.rpartition('.')
+        parts = body.split('.')
+        if len(parts) != 4 or not hmac.compare_digest(self._sign(body), mac):
+            raise SSOError("Invalid SSO nonce.")
+        user_id, expires, forum, _ = parts
+        try:
+            user_id, expires = int(user_id), int(expires)
+        except ValueError:
+            raise SSOError("Malformed SSO nonce.")
+        if expires < time.time():
+            raise SSOError("Expired SSO nonce.")
+        return user_id, forum == '1', expires
+
+class LocalReplayCache:
+    """
+    Remembers used nonces in a bounded in-process LRU. Only effective when one
+    process handles every callback; use CacheReplayCache otherwise.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self._cache = TTLCache(maxsize, ttl, ttl)
+
+    def add(self, nonce, ttl):
+        return self._cache.add(nonce, True, ttl=ttl)
+
+class CacheReplayCache:
+    """
+    Remembers used nonces in a shared Django cache via its atomic add().
+    """
+
+    def __init__(self, cache_alias, key_prefix='discourse:sso:nonce'):
+        self.cache = caches[cache_alias]
+        self.key_prefix = key_prefix
+
+    def add(self, nonce, ttl):
+        return self.cache.add(f"{self.key_prefix}:{nonce}", 1, timeout=max(1, int(ttl) + 1))
+
+FRESH_COOKIE_SALT = 'discourse_integration.sso.fresh'
+
+def mark_sso_fresh(request, response, user_id):
+    """
+    Records a completed handshake for ``user_id`` in a signed cookie on ``response``,
+    valid for DISCOURSE_SSO_FRESHNESS_WINDOW seconds. Does nothing when the window is 0.
+    """
+    window = get_setting('DISCOURSE_SSO_FRESHNESS_WINDOW')
+    if not window:
+        return
+    response.set_signed_cookie(
+        get_setting('DISCOURSE_SSO_FRESH_COOKIE'), str(user_id), salt=FRESH_COOKIE_SALT,
+        max_age=window, secure=request.is_secure(), httponly=True, samesite='Lax',
+    )
+
+def is_sso_fresh(request, user_id):
+    """
+    True when this browser completed a handshake for ``user_id`` within the freshness window.
+    """
+    window = get_setting('DISCOURSE_SSO_FRESHNESS_WINDOW')
+    if not window:
+        return False
+    value = request.get_signed_cookie(get_setting('DISCOURSE_SSO_FRESH_COOKIE'), default=None, salt=FRESH_COOKIE_SALT, max_age=window)
+    return value == str(user_id)
+
+def get_nonce_signer():
+    key = (settings.SECRET_KEY, get_setting('DISCOURSE_SSO_NONCE_TTL'))
+    signer = _nonce_signers.get(key)
+    if signer is None:
+        with _nonces_lock:
+            signer = _nonce_signers.get(key)
+            if signer is None:
+                signer = _nonce_signers[key] = NonceSigner(*key)
+    return signer
+
+def get_replay_cache():
+    """
+    Returns the process-wide replay cache configured by DISCOURSE_SSO_REPLAY_CACHE.
+    """
+    key = (get_setting('DISCOURSE_SSO_REPLAY_CACHE'), get_setting('DISCOURSE_SSO_REPLAY_CACHE_SIZE'), get_setting('DISCOURSE_SSO_NONCE_TTL'))
+    cache = _replay_caches.get(key)
+    if cache is None:
+        with _nonces_lock:
+            cache = _replay_caches.get(key)
+            if cache is None:
+                cache_alias, maxsize, ttl = key
+                cache = CacheReplayCache(cache_alias) if cache_alias else LocalReplayCache(maxsize, ttl)
+                _replay_caches[key] = cache
+    return cache
+
+def issue_nonce(user_id, forum=False):
+    """
+    Returns a signed nonce for a stateless SSO handshake started by ``user_id``.
+    """
+    return get_nonce_signer().issue(user_id, forum)
+
+def consume_nonce(nonce):
+    """
+    Verifies a signed nonce and marks it used. Returns (user_id, forum);
+    raises SSOError for invalid, expired or already-used nonces.
+    """
+    user_id, forum, expires = get_nonce_signer().verify(nonce)
+    if not get_replay_cache().add(nonce, expires - time.time()):
+        raise SSOError("Replayed SSO nonce.")
+    return user_id, forum
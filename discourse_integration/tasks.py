@@ -0,0 +1,357 @@
+# discourse_integration/tasks.py
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from asgiref.sync import sync_to_async
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.utils import timezone
+from .api import DiscourseAPIError, DiscourseUnavailable, get_discourse_api, user_payload_hash
+from .conf import get_setting
+from .index import forget_indexed_user
+from .lookup_cache import get_lookup_cache
+from .models import DiscourseOutbox, DiscourseProfile
+from .ratelimit import bounded_wait
+
+logger = logging.getLogger(__name__)
+User = get_user_model()
+
+# DISCOURSE_PROVISIONING values
+PROVISION_AT_SIGNUP = 'signup'
+PROVISION_ON_FIRST_VISIT = 'first_visit'
+
+def provisions_on_first_visit():
+    return get_setting('DISCOURSE_PROVISIONING') == PROVISION_ON_FIRST_VISIT
+
+def is_unchanged(user):
+    """
+    True when the user's synced fields match what was last sent to Discourse.
+    """
+    profile = getattr(user, 'discourse_profile', None)
+    return bool(profile and profile.discourse_user_id and profile.payload_hash == user_payload_hash(user))
+
+def link_profile(user, discourse_user_id, payload_hash=''):
+    """
+    Records the Discourse account for a user. A blank payload_hash marks the
+    account's details as unsynced, so the next sync sends an update.
+    """
+    profile = getattr(user, 'discourse_profile', None) # Reuse a profile the caller already loaded
+    if profile is None:
+        profile, _ = DiscourseProfile.objects.get_or_create(user=user)
+    profile.discourse_user_id = discourse_user_id
+    if payload_hash:
+        update_fields = profile.set_synced(payload_hash)
+    else:
+        profile.last_synced_at = timezone.now()
+        profile.payload_hash = ''
+        profile.sync_status = DiscourseProfile.PENDING
+        update_fields = ['last_synced_at', 'payload_hash', 'sync_status']
+    profile.save(update_fields=['discourse_user_id'] + update_fields)
+    user.discourse_profile = profile
+    return profile
+
+def record_failure(user, error):
+    """
+    Stores a failed sync on the user's profile, if they have one.
+    """
+    profile = getattr(user, 'discourse_profile', None)
+    if profile is not None:
+        profile.save(update_fields=profile.set_failed(error))
+
+def sync_user(api, user, action):
+    """
+    Pushes one Django user to Discourse and links the returned Discourse ID.
+    A create for a user who is already linked is sent as an update. Updates are
+    skipped (returning None) when nothing Discourse mirrors has changed.
+    """
+    profile = getattr(user, 'discourse_profile', None)
+    if action == DiscourseOutbox.CREATE and profile is not None and profile.discourse_user_id:
+        # Already linked: a create queued twice, or one whose response was lost
+        action = DiscourseOutbox.UPDATE
+    if action == DiscourseOutbox.CREATE:
+        discourse_user_id = api.create_user(user)
+        if discourse_user_id is True:
+            # Discourse omitted the new ID; look it up so later updates can find the account
+            discourse_user_id = api.resolve_user_id(user) or True
+        if discourse_user_id is not True:
+            link_profile(user, discourse_user_id, user_payload_hash(user))
+        return discourse_user_id
+    if is_unchanged(user):
+        logger.debug("Discourse fields unchanged for %s; skipping update.", user.username)
+        return None
+    return api.update_user(user)
+
+def ensure_provisioned(user, api=None):
+    """
+    Creates and links the user's Discourse account if they have none yet, for
+    first-visit provisioning. Returns the Discourse user ID, or None when it is
+    not known yet. A create that fails transiently, or that would wait longer
+    than DISCOURSE_INTERACTIVE_MAX_WAIT for the rate limiter, is queued for the
+    outbox worker instead of raised, so SSO can carry on; a create already
+    queued is not queued again. Permanent failures (a conflict, a 4xx) are
+    only recorded on the profile.
+    """
+    try:
+        profile = user.discourse_profile # Cached on the user for link_profile below
+    except DiscourseProfile.DoesNotExist:
+        profile = None
+    if profile is not None and profile.discourse_user_id:
+        return profile.discourse_user_id
+    try:
+        with bounded_wait(get_setting('DISCOURSE_INTERACTIVE_MAX_WAIT')):
+            discourse_user_id = sync_user(api or get_discourse_api(), user, DiscourseOutbox.CREATE)
+    except DiscourseAPIError as e:
+        if not (e.retryable or isinstance(e, DiscourseUnavailable)):
+            logger.error("Could not provision Discourse account for %s: %s", user.username, e)
+            record_failure(user, e)
+            return None
+        logger.error("Could not provision Discourse account for %s; queued for retry: %s", user.username, e)
+        if not DiscourseOutbox.objects.filter(user_id=user.pk, action=DiscourseOutbox.CREATE).exists():
+            enqueue_sync(user.pk, DiscourseOutbox.CREATE)
+        return None
+    return None if discourse_user_id is True else discourse_user_id
+
+async def aensure_provisioned(user):
+    """
+    Async wrapper for ensure_provisioned. Already-linked users are answered with
+    one async query; only a first visit hops to a thread for the create.
+    """
+    profile = await DiscourseProfile.objects.filter(user=user).afirst()
+    if profile is not None and profile.discourse_user_id:
+        return profile.discourse_user_id
+    return await sync_to_async(ensure_provisioned)(user)
+
+def resolve_missing_discourse_ids(profiles=None, workers=8, batch_size=200, api=None):
+    """
+    Fills in discourse_user_id for profiles that lack it.
+
+    Lookups run ``workers`` at a time through the cached external_id/username
+    resolver, and each batch is saved with one bulk_update. IDs already linked
+    to another profile are skipped. Returns the number of profiles linked.
+    """
+    api = api or get_discourse_api()
+    if profiles is None:
+        profiles = DiscourseProfile.objects.filter(
+            discourse_user_id__isnull=True,
+            user__is_active=True, user__is_staff=False, user__is_superuser=False,
+        )
+    profiles = profiles.select_related('user').order_by('pk')
+
+    def resolve(profile):
+        try:
+            return api.resolve_user_id(profile.user)
+        except DiscourseAPIError as e:
+            logger.error("Could not resolve Discourse ID for %s: %s", profile.user.username, e)
+            return None
+
+    def link(batch):
+        found = [(profile, discourse_user_id) for profile, discourse_user_id in zip(batch, executor.map(resolve, batch)) if discourse_user_id]
+        taken = set(
+            DiscourseProfile.objects.filter(discourse_user_id__in=[discourse_user_id for _, discourse_user_id in found])
+            .values_list('discourse_user_id', flat=True)
+        )
+        linked = []
+        for profile, discourse_user_id in found:
+            if discourse_user_id in taken:
+                logger.warning("Discourse ID %s for %s is already linked to another profile.", discourse_user_id, profile.user.username)
+                continue
+            taken.add(discourse_user_id)
+            profile.discourse_user_id = discourse_user_id
+            linked.append(profile)
+        DiscourseProfile.objects.bulk_update(linked, ['discourse_user_id'])
+        return len(linked)
+
+    total = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        batch = []
+        for profile in profiles.iterator(chunk_size=batch_size):
+            batch.append(profile)
+            if len(batch) >= batch_size:
+                total += link(batch)
+                batch = []
+        if batch:
+            total += link(batch)
+    logger.info("Linked %s Discourse profiles.", total)
+    return total
+
+def enqueue_sync(user_id, action):
+    """
+    Queues a Discourse create or update for a user, coalescing bursts of saves.
+
+    New rows become due after DISCOURSE_SYNC_COALESCE_WINDOW seconds. An update
+    for a user who already has a row inside that window is folded into it: the
+    row has not been claimed yet, and the worker sends the user's latest state
+    when it runs. Returns True when a new row was written.
+    """
+    window = get_setting('DISCOURSE_SYNC_COALESCE_WINDOW')
+    now = timezone.now()
+    if action == DiscourseOutbox.UPDATE and window:
+        # Rows claimed by a worker are due after the lease, beyond the window:
+        # their data may already be on its way, so they must not absorb this save.
+        upcoming = DiscourseOutbox.objects.filter(user_id=user_id, available_at__gt=now, available_at__lte=now + timedelta(seconds=window))
+        if upcoming.exists():
+            return False
+    DiscourseOutbox.objects.create(user_id=user_id, action=action, available_at=now + timedelta(seconds=window))
+    return True
+
+def enqueue_creates(user_ids):
+    """
+    Queues Discourse creates for users inserted without post_save (bulk_create)
+    with chunked bulk inserts. Rows are due immediately.
+    """
+    rows = [DiscourseOutbox(user_id=user_id, action=DiscourseOutbox.CREATE) for user_id in user_ids]
+    DiscourseOutbox.objects.bulk_create(rows, batch_size=1000)
+    return len(rows)
+
+def enqueue_deletions(entries):
+    """
+    Queues Discourse account deletions for (user_id, discourse_user_id) pairs
+    with chunked bulk inserts. Rows are due immediately.
+    """
+    rows = [DiscourseOutbox(user_id=user_id, action=DiscourseOutbox.DELETE, discourse_user_id=discourse_user_id) for user_id, discourse_user_id in entries]
+    DiscourseOutbox.objects.bulk_create(rows, batch_size=1000)
+    return len(rows)
+
+def delete_discourse_user(api, row):
+    """
+    Deletes the Discourse account of an outbox delete row, with
+    DISCOURSE_DELETE_OPTIONS. An account that is already gone counts as deleted.
+    """
+    try:
+        api.delete_user(row.discourse_user_id, **get_setting('DISCOURSE_DELETE_OPTIONS'))
+    except DiscourseAPIError as e:
+        if e.status_code != 404:
+            raise
+        logger.info("Discourse user %s was already deleted.", row.discourse_user_id)
+        forget_indexed_user(row.discourse_user_id)
+    get_lookup_cache(api.base_url).delete(('external_id', str(row.user_id)))
+
+def retry_delay(attempts):
+    """
+    Exponential backoff for failed outbox rows, capped at one hour.
+    """
+    return timedelta(seconds=min(get_setting('DISCOURSE_OUTBOX_RETRY_DELAY') * 2 ** (attempts - 1), 3600))
+
+def claim_outbox_rows(batch_size, now):
+    """
+    Claims up to ``batch_size`` due outbox rows and commits at once, so no row
+    lock is held while Discourse is called. Claimed rows are hidden from other
+    workers for DISCOURSE_OUTBOX_LEASE seconds; rows of a worker that dies
+    before finishing come back after that. Each returned row carries its lease
+    in available_at, for renew_lease.
+    """
+    with transaction.atomic():
+        rows = list(
+            DiscourseOutbox.objects.select_for_update(skip_locked=True)
+            .filter(available_at__lte=now)[:batch_size]
+        )
+        if rows:
+            lease = now + timedelta(seconds=get_setting('DISCOURSE_OUTBOX_LEASE'))
+            DiscourseOutbox.objects.filter(pk__in=[row.pk for row in rows]).update(available_at=lease)
+            for row in rows:
+                row.available_at = lease
+    return rows
+
+def renew_lease(row):
+    """
+    Extends this worker's lease on a claimed row just before it is sent.
+    Returns False when the lease ran out and another worker has claimed the
+    row since (or it is gone); the row must then be left to that worker.
+    """
+    lease = timezone.now() + timedelta(seconds=get_setting('DISCOURSE_OUTBOX_LEASE'))
+    if not DiscourseOutbox.objects.filter(pk=row.pk, available_at=row.available_at).update(available_at=lease):
+        logger.warning("Lost the lease on Discourse outbox row %s (user ID %s); skipping it.", row.pk, row.user_id)
+        return False
+    row.available_at = lease
+    return True
+
+def drain_outbox(batch_size=None, api=None):
+    """
+    Processes one batch of due outbox rows and returns how many rows were claimed.
+
+    Rows are claimed with SELECT ... FOR UPDATE SKIP LOCKED in a short
+    transaction of their own (see claim_outbox_rows), so several workers can
+    drain the outbox concurrently without handling the same row twice, and
+    Discourse calls and retries happen without holding any lock. Each row's
+    lease is renewed right before it is sent, so a slow batch never sends a
+    row another worker has taken over. Each row is synced in its own
+    transaction, so a database error rolls back that row only. Failed rows are rescheduled with backoff and dropped after
+    DISCOURSE_OUTBOX_MAX_ATTEMPTS attempts.
+    """
+    batch_size = batch_size or get_setting('DISCOURSE_OUTBOX_BATCH_SIZE')
+    api = api or get_discourse_api()
+    now = timezone.now()
+
+    rows = claim_outbox_rows(batch_size, now)
+    if not rows:
+        return 0
+
+    # Coalesce rows for the same user into one call carrying the latest
+    # state; a pending create absorbs any later updates, and a deletion
+    # makes both pointless.
+    done, failed = [], []
+    pending = {}
+    deletions = [row for row in rows if row.action == DiscourseOutbox.DELETE]
+    deleted_user_ids = {row.user_id for row in deletions}
+    for row in rows:
+        if row.action == DiscourseOutbox.DELETE:
+            continue
+        if row.user_id in deleted_user_ids:
+            done.append(row.pk)
+            continue
+        head = pending.setdefault(row.user_id, row)
+        if head is not row:
+            if row.action == DiscourseOutbox.CREATE:
+                head.action = DiscourseOutbox.CREATE
+            done.append(row.pk)
+
+    users = User.objects.select_related('discourse_profile').in_bulk(pending.keys())
+    for row in pending.values():
+        user = users.get(row.user_id)
+        if user is None or user.is_staff or user.is_superuser or not user.is_active:
+            done.append(row.pk) # User deleted or no longer eligible since it was queued
+            continue
+        if not renew_lease(row):
+            continue
+        try:
+            with transaction.atomic():
+                sync_user(api, user, row.action)
+            done.append(row.pk)
+        except Exception as e:
+            logger.error("Discourse %s for user ID %s failed (attempt %s): %s", row.action, row.user_id, row.attempts + 1, e)
+            failed.append((row, e))
+
+    for row in deletions:
+        if not renew_lease(row):
+            continue
+        try:
+            with transaction.atomic():
+                delete_discourse_user(api, row)
+            done.append(row.pk)
+        except Exception as e:
+            logger.error("Discourse delete of user %s (Django user ID %s) failed (attempt %s): %s", row.discourse_user_id, row.user_id, row.attempts + 1, e)
+            failed.append((row, e))
+
+    max_attempts = get_setting('DISCOURSE_OUTBOX_MAX_ATTEMPTS')
+    failed_profiles = []
+    for row, error in failed:
+        row.attempts += 1
+        row.available_at = now + retry_delay(row.attempts)
+        retry_after = getattr(error, 'retry_after', None)
+        if retry_after:
+            # Honour Retry-After or the circuit breaker's reopen time over our own backoff
+            row.available_at = max(row.available_at, now + timedelta(seconds=retry_after))
+        if row.attempts >= max_attempts:
+            logger.error("Giving up on Discourse %s for user ID %s after %s attempts.", row.action, row.user_id, row.attempts)
+            done.append(row.pk)
+        profile = getattr(users.get(row.user_id), 'discourse_profile', None)
+        if profile is not None:
+            profile.set_failed(error)
+            failed_profiles.append(profile)
+    with transaction.atomic():
+        DiscourseOutbox.objects.filter(pk__in=done).delete()
+        DiscourseOutbox.objects.bulk_update([row for row, _ in failed if row.pk not in done], ['action', 'attempts', 'available_at'])
+        DiscourseProfile.objects.bulk_update(failed_profiles, DiscourseProfile.SYNC_STATE_FIELDS)
+
+    logger.info("Drained %s Discourse outbox rows (%s failed).", len(rows), len(failed))
+    return len(rows)
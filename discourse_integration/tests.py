@@ -1,18 +1,49 @@
 # discourse_integration/tests.py
+import asyncio
+import hashlib
+import hmac
 import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from contextlib import contextmanager
+from io import StringIO
+from urllib.parse import parse_qs, urlsplit
 import requests
-from django.test import TestCase, override_settings
+from django.conf import settings
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.contrib.auth import get_user_model
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.management import call_command
+from django.db import connection, transaction
 from django.db.models.signals import post_save
+from django.urls import reverse
 from django.utils import timezone # Import timezone for datetime comparisons
 from unittest.mock import patch, MagicMock
 
 # Import the API class and custom exception
-from discourse_integration.api import DiscourseAPI, generate_random_password, DiscourseAPIError
+from discourse_integration.api import (
+    DiscourseAPI, generate_random_password, DiscourseAPIError, DiscourseConflict, DiscourseRateLimited, DiscourseUnavailable,
+    classify_failure, get_discourse_api, user_payload_hash,
+)
+from discourse_integration.benchmark import FakeDiscourse, percentile, run_bulk_sync, run_signups, run_sso
+from discourse_integration.bulk import suspended_sync, sync_users
+from discourse_integration.async_api import AsyncDiscourseAPI, gather_bounded, httpx
 # Import the signal handler
 from discourse_integration.signals import user_post_save_handler
+from discourse_integration.sso import LocalReplayCache, NonceSigner, SSOCodec, SSOError, parse_payload
 # Import the DiscourseProfile model
-from discourse_integration.models import DiscourseProfile # Import DiscourseProfile
+from discourse_integration.index import find_indexed_user, refresh_user_index
+from discourse_integration.models import DiscourseOutbox, DiscourseProfile, DiscourseSyncCheckpoint, DiscourseUserIndex
+from discourse_integration.ratelimit import CacheRateLimiter, RateLimiter, RateLimitTimeout, get_rate_limiter
+from discourse_integration.resilience import CircuitBreaker, get_circuit_breaker
+from discourse_integration import metrics
+from discourse_integration.profiling import CollapsedStackWriter, SamplingProfilerMiddleware, StackSampler, read_collapsed
+from discourse_integration.lookup_cache import MISSING, SharedLookupCache, TTLCache, get_lookup_cache
+from discourse_integration.tasks import drain_outbox, resolve_missing_discourse_ids, sync_user
 
 # Get the Django User model
 User = get_user_model()
@@ -75,6 +106,8 @@ class DiscourseAPITests(TestCase):
             self.discourse_profile.discourse_user_id = 12345
             self.discourse_profile.last_synced_at = timezone.now() - timezone.timedelta(days=1)
             self.discourse_profile.save() # Save to apply changes if it wasn't created
+            # Drop the stale profile cached on the user by the create signal
+            self.test_user.refresh_from_db()
 
         self.user_no_email = User.objects.create_user(
             username=f'noemailuser_{unique_suffix}',
@@ -92,7 +125,7 @@ class DiscourseAPITests(TestCase):
         )
 
     # --- Existing create_user tests (unchanged) ---
-    @patch('discourse_integration.api.requests.request')
+    @patch('discourse_integration.api.requests.Session.request')
     def test_create_user_success(self, mock_requests_request):
         mock_response = MagicMock()
         mock_response.status_code = 200
@@ -119,7 +152,7 @@ class DiscourseAPITests(TestCase):
 
         self.assertEqual(result, 123)
 
-    @patch('discourse_integration.api.requests.request')
+    @patch('discourse_integration.api.requests.Session.request')
     def test_create_user_success_no_id_in_response(self, mock_requests_request):
         mock_response = MagicMock()
         mock_response.status_code = 200
@@ -138,7 +171,7 @@ class DiscourseAPITests(TestCase):
         
         self.assertTrue(result)
 
-    @patch('discourse_integration.api.requests.request')
+    @patch('discourse_integration.api.requests.Session.request')
     def test_create_user_email_fallback(self, mock_requests_request):
         mock_response = MagicMock()
         mock_response.status_code = 200
@@ -151,10 +184,10 @@ class DiscourseAPITests(TestCase):
 
         call_kwargs = mock_requests_request.call_args[1]
         sent_json = call_kwargs['json']
-        self.assertEqual(sent_json['email'], 'noemailuser@example.com')
-        self.assertEqual(sent_json['username'], 'noemailuser')
+        self.assertEqual(sent_json['email'], f'{self.user_no_email.username}@example.com')
+        self.assertEqual(sent_json['username'], self.user_no_email.username)
 
-    @patch('discourse_integration.api.requests.request')
+    @patch('discourse_integration.api.requests.Session.request')
     def test_create_user_api_failure(self, mock_requests_request):
         mock_response = MagicMock()
         mock_response.status_code = 400
@@ -179,7 +212,7 @@ class DiscourseAPITests(TestCase):
 
 
     # --- New update_user tests ---
-    @patch('discourse_integration.api.requests.request')
+    @patch('discourse_integration.api.requests.Session.request')
     def test_update_user_success(self, mock_requests_request):
         """
         Tests successful user update in Discourse.
@@ -225,7 +258,7 @@ class DiscourseAPITests(TestCase):
         self.assertGreater(self.discourse_profile.last_synced_at, old_sync_time)
         self.assertLessEqual(self.discourse_profile.last_synced_at, timezone.now())
 
-    @patch('discourse_integration.api.requests.request')
+    @patch('discourse_integration.api.requests.Session.request')
     def test_update_user_no_discourse_profile(self, mock_requests_request):
         """
         Tests that update_user returns False if no DiscourseProfile is found.
@@ -242,7 +275,7 @@ class DiscourseAPITests(TestCase):
         # Assert that it returns False as per api.py logic
         self.assertFalse(result)
 
-    @patch('discourse_integration.api.requests.request')
+    @patch('discourse_integration.api.requests.Session.request')
     def test_update_user_null_discourse_id(self, mock_requests_request):
         """
         Tests that update_user returns False if DiscourseProfile has a null ID.
@@ -259,7 +292,7 @@ class DiscourseAPITests(TestCase):
         # Assert that it returns False as per api.py logic
         self.assertFalse(result)
 
-    @patch('discourse_integration.api.requests.request')
+    @patch('discourse_integration.api.requests.Session.request')
     def test_update_user_api_failure(self, mock_requests_request):
         """
         Tests that DiscourseAPIError is raised on HTTP error during update.
@@ -278,8 +311,23 @@ class DiscourseAPITests(TestCase):
         self.assertIsInstance(cm.exception, DiscourseAPIError)
         self.assertIn("Discourse API communication error", str(cm.exception))
 
+    @patch('discourse_integration.api.requests.Session.request')
+    def test_non_json_body_raises_api_error(self, mock_requests_request):
+        """
+        Tests that a 200 with an HTML body (e.g. a maintenance page) raises DiscourseAPIError.
+        """
+        mock_response = MagicMock()
+        mock_response.status_code = 200
+        mock_response.raise_for_status.return_value = None
+        mock_response.json.side_effect = requests.exceptions.JSONDecodeError("Expecting value", "<html>", 0)
+        mock_requests_request.return_value = mock_response
+
+        with self.assertRaises(DiscourseAPIError) as cm:
+            DiscourseAPI().get_user_by_external_id(12345, use_cache=False)
+        self.assertEqual(cm.exception.status_code, 200)
+
     # --- New delete_user tests ---
-    @patch('discourse_integration.api.requests.request')
+    @patch('discourse_integration.api.requests.Session.request')
     def test_delete_user_success(self, mock_requests_request):
         """
         Tests successful user deletion in Discourse.
@@ -309,7 +357,7 @@ class DiscourseAPITests(TestCase):
         # Assert the return value
         self.assertEqual(result, mock_response.json.return_value)
 
-    @patch('discourse_integration.api.requests.request')
+    @patch('discourse_integration.api.requests.Session.request')
     def test_delete_user_api_failure(self, mock_requests_request):
         """
         Tests that DiscourseAPIError is raised on HTTP error during delete.
@@ -329,3 +377,1615 @@ class DiscourseAPITests(TestCase):
         self.assertIn("Discourse API error during user deletion", str(cm.exception))
 
 
+
+@override_settings(
+    DISCOURSE_BASE_URL='https://testdiscourse.com/',
+    DISCOURSE_API_KEY='test_api_key',
+    DISCOURSE_API_USERNAME='test_api_username',
+    DISCOURSE_CONNECT_TIMEOUT=2,
+    DISCOURSE_READ_TIMEOUT=7,
+)
+class DiscourseClientPoolTests(SimpleTestCase):
+    """
+    Tests for the process-wide pooled HTTP session behind DiscourseAPI.
+    """
+
+    def test_instances_share_one_session(self):
+        self.assertIs(DiscourseAPI().session, DiscourseAPI().session)
+
+    def test_get_discourse_api_is_cached(self):
+        self.assertIs(get_discourse_api(), get_discourse_api())
+
+    def test_get_discourse_api_is_per_base_url(self):
+        api = get_discourse_api()
+        with self.settings(DISCOURSE_BASE_URL='https://otherdiscourse.com'):
+            other = get_discourse_api()
+        self.assertIsNot(api, other)
+        self.assertIsNot(api.session, other.session)
+
+    @patch('discourse_integration.api.requests.Session.request')
+    def test_request_uses_split_timeouts(self, mock_requests_request):
+        mock_requests_request.return_value.json.return_value = {}
+        DiscourseAPI()._make_request('GET', 'about.json')
+        self.assertEqual(mock_requests_request.call_args[1]['timeout'], (2, 7))
+
+@override_settings(
+    DISCOURSE_BASE_URL='https://testdiscourse.com/',
+    DISCOURSE_API_KEY='test_api_key',
+    DISCOURSE_API_USERNAME='test_api_username',
+    DEBUG=True
+)
+@unittest.skipIf(httpx is None, "httpx is not installed")
+class AsyncDiscourseAPITests(TestCase):
+    """
+    Tests for AsyncDiscourseAPI against an in-memory httpx transport.
+    """
+
+    def setUp(self):
+        post_save.disconnect(user_post_save_handler, sender=User)
+        self.addCleanup(post_save.connect, user_post_save_handler, sender=User)
+        self.user = User.objects.create_user(username='asyncuser', email='async@example.com', first_name='Async', last_name='User')
+        DiscourseProfile.objects.create(user=self.user, discourse_user_id=777)
+        self.requests = []
+
+    def make_api(self, handler):
+        def transport_handler(request):
+            self.requests.append(request)
+            return handler(request)
+        return AsyncDiscourseAPI(client=httpx.AsyncClient(transport=httpx.MockTransport(transport_handler)))
+
+    async def test_create_user_sends_shared_payload(self):
+        api = self.make_api(lambda request: httpx.Response(200, json={'success': True, 'id': 55}))
+        self.assertEqual(await api.create_user(self.user), 55)
+        request = self.requests[0]
+        self.assertEqual(request.method, 'POST')
+        self.assertEqual(str(request.url), 'https://testdiscourse.com/users.json')
+        self.assertEqual(json.loads(request.content)['username'], 'asyncuser')
+
+    async def test_create_user_forgets_cached_misses(self):
+        get_lookup_cache('https://testdiscourse.com').clear()
+        responses = iter([
+            httpx.Response(404, json={}),
+            httpx.Response(200, json={'success': True, 'id': 55}),
+            httpx.Response(200, json={'user': {'id': 55, 'username': 'asyncuser'}}),
+        ])
+        api = self.make_api(lambda request: next(responses))
+        self.assertIsNone(await api.get_user_by_external_id(self.user.pk))
+        await api.create_user(self.user)
+        self.assertEqual((await api.get_user_by_external_id(self.user.pk))['id'], 55)
+        self.assertEqual(len(self.requests), 3)
+
+    async def test_update_user_marks_profile_synced(self):
+        api = self.make_api(lambda request: httpx.Response(200, json={'success': 'OK'}))
+        await api.update_user(self.user)
+        self.assertEqual(str(self.requests[0].url), 'https://testdiscourse.com/admin/users/777.json')
+        profile = await DiscourseProfile.objects.aget(user=self.user)
+        self.assertIsNotNone(profile.last_synced_at)
+
+    async def test_delete_user_sends_options(self):
+        api = self.make_api(lambda request: httpx.Response(200, json={'deleted': True}))
+        await api.delete_user(777, delete_posts=True)
+        self.assertEqual(self.requests[0].method, 'DELETE')
+        self.assertEqual(self.requests[0].url.params['delete_posts'], 'true')
+
+    async def test_lookup_returns_none_on_404(self):
+        api = self.make_api(lambda request: httpx.Response(404, json={}))
+        self.assertIsNone(await api.get_user_by_external_id(self.user.pk))
+
+    async def test_http_error_raises_discourse_api_error(self):
+        api = self.make_api(lambda request: httpx.Response(500, json={}))
+        with self.assertRaises(DiscourseAPIError):
+            await api.create_user(self.user)
+
+    @patch('discourse_integration.async_api.asyncio.sleep')
+    async def test_idempotent_call_is_retried_after_5xx(self, mock_sleep):
+        self.addCleanup(get_circuit_breaker('https://testdiscourse.com').reset)
+        responses = iter([httpx.Response(503, json={}), httpx.Response(200, json={'ok': True})])
+        api = self.make_api(lambda request: next(responses))
+        self.assertEqual(await api._make_request('PUT', 'admin/users/1.json'), {'ok': True})
+        self.assertEqual(len(self.requests), 2)
+        mock_sleep.assert_awaited_once()
+
+    async def test_gather_bounded_limits_concurrency(self):
+        in_flight = peak = 0
+
+        async def call(i):
+            nonlocal in_flight, peak
+            in_flight += 1
+            peak = max(peak, in_flight)
+            await asyncio.sleep(0)
+            in_flight -= 1
+            if i == 3:
+                raise DiscourseAPIError('boom')
+            return i
+
+        results = await gather_bounded([call(i) for i in range(10)], limit=2)
+        self.assertEqual(peak, 2)
+        self.assertEqual(results[:3], [0, 1, 2])
+        self.assertIsInstance(results[3], DiscourseAPIError)
+
+@override_settings(
+    DISCOURSE_BASE_URL='https://testdiscourse.com/',
+    DISCOURSE_API_KEY='test_api_key',
+    DISCOURSE_API_USERNAME='test_api_username',
+    DEBUG=True,
+    DISCOURSE_SYNC_COALESCE_WINDOW=0
+)
+class DiscourseOutboxTests(TestCase):
+    """
+    Tests for the transactional outbox written by the post_save signal
+    and drained by tasks.drain_outbox.
+    """
+
+    def make_response(self, payload):
+        response = MagicMock()
+        response.json.return_value = payload
+        response.raise_for_status.return_value = None
+        return response
+
+    @patch('discourse_integration.api.requests.Session.request')
+    def test_signal_queues_without_http(self, mock_requests_request):
+        user = User.objects.create_user(username='queued', email='queued@example.com')
+        user.first_name = 'Queued'
+        user.save()
+        mock_requests_request.assert_not_called()
+        self.assertEqual(
+            list(DiscourseOutbox.objects.values_list('user_id', 'action')),
+            [(user.pk, DiscourseOutbox.CREATE), (user.pk, DiscourseOutbox.UPDATE)]
+        )
+
+    def test_rolled_back_save_leaves_no_outbox_row(self):
+        try:
+            with transaction.atomic():
+                User.objects.create_user(username='rolledback')
+                raise RuntimeError
+        except RuntimeError:
+            pass
+        self.assertFalse(DiscourseOutbox.objects.exists())
+
+    def test_staff_are_not_queued(self):
+        User.objects.create_superuser(username='admin', email='admin@example.com', password='pw')
+        self.assertFalse(DiscourseOutbox.objects.exists())
+
+    @patch('discourse_integration.api.requests.Session.request')
+    def test_drain_creates_and_links_profile(self, mock_requests_request):
+        mock_requests_request.return_value = self.make_response({'success': True, 'id': 42})
+        user = User.objects.create_user(username='drained', email='drained@example.com')
+
+        self.assertEqual(drain_outbox(), 1)
+        self.assertEqual(mock_requests_request.call_args[0][:2], ('POST', 'https://testdiscourse.com/users.json'))
+        profile = DiscourseProfile.objects.get(user=user)
+        self.assertEqual(profile.discourse_user_id, 42)
+        self.assertEqual(profile.sync_status, DiscourseProfile.SYNCED)
+        self.assertFalse(DiscourseOutbox.objects.exists())
+
+    @patch('discourse_integration.api.requests.Session.request')
+    def test_drain_reschedules_failures(self, mock_requests_request):
+        mock_requests_request.side_effect = requests.exceptions.ConnectionError('down')
+        self.addCleanup(get_circuit_breaker('https://testdiscourse.com').reset)
+        user = User.objects.create_user(username='failing')
+
+        self.assertEqual(drain_outbox(), 1)
+        row = DiscourseOutbox.objects.get()
+        self.assertEqual(row.attempts, 1)
+        self.assertGreater(row.available_at, timezone.now())
+        profile = DiscourseProfile.objects.get(user=user)
+        self.assertEqual((profile.sync_status, profile.sync_attempts), (DiscourseProfile.FAILED, 1))
+        self.assertIn('down', profile.last_error)
+        # Not due yet, so the next drain claims nothing
+        self.assertEqual(drain_outbox(), 0)
+
+    @patch('discourse_integration.api.requests.Session.request')
+    def test_drain_skips_rows_whose_lease_was_taken_over(self, mock_requests_request):
+        User.objects.create_user(username='leased1')
+        User.objects.create_user(username='leased2')
+        DiscourseOutbox.objects.update(available_at=timezone.now())
+        takeover = timezone.now() + timezone.timedelta(hours=1)
+
+        def slow_create(*args, **kwargs):
+            # While this worker is busy its lease runs out and another worker claims the other row
+            sent = User.objects.get(username=kwargs['json']['username'])
+            DiscourseOutbox.objects.exclude(user_id=sent.pk).update(available_at=takeover)
+            return self.make_response({'success': True, 'id': 61})
+
+        mock_requests_request.side_effect = slow_create
+        self.assertEqual(drain_outbox(), 2)
+        self.assertEqual(mock_requests_request.call_count, 1)
+        # The row taken over is left for the other worker, with its lease intact
+        self.assertEqual(list(DiscourseOutbox.objects.values_list('available_at', flat=True)), [takeover])
+
+    def test_last_login_save_is_not_queued(self):
+        user = User.objects.create_user(username='loginonly')
+        DiscourseOutbox.objects.all().delete()
+        user.last_login = timezone.now()
+        user.save(update_fields=['last_login'])
+        self.assertFalse(DiscourseOutbox.objects.exists())
+        user.email = 'changed@example.com'
+        user.save(update_fields=['email'])
+        self.assertEqual(DiscourseOutbox.objects.get().action, DiscourseOutbox.UPDATE)
+
+    @patch('discourse_integration.api.requests.Session.request')
+    def test_drain_skips_unchanged_updates(self, mock_requests_request):
+        mock_requests_request.return_value = self.make_response({'success': True, 'id': 43})
+        user = User.objects.create_user(username='fingerprinted', email='fp@example.com')
+        drain_outbox()
+        self.assertEqual(DiscourseProfile.objects.get(user=user).payload_hash, user_payload_hash(user))
+
+        # A full save that changes nothing Discourse mirrors costs no HTTP call
+        user.save()
+        drain_outbox()
+        self.assertEqual(mock_requests_request.call_count, 1)
+
+        user.first_name = 'Renamed'
+        user.save()
+        drain_outbox()
+        self.assertEqual(mock_requests_request.call_count, 2)
+        self.assertEqual(mock_requests_request.call_args[0][0], 'PUT')
+
+    def test_payload_hash_covers_only_the_update_payload(self):
+        user = User(username='hashed', email='hashed@example.com', first_name='Hashed', last_name='User')
+        before = user_payload_hash(user)
+        # The update PUT carries neither the username nor is_active
+        user.username = 'renamed'
+        user.is_active = False
+        self.assertEqual(user_payload_hash(user), before)
+        user.email = 'moved@example.com'
+        self.assertNotEqual(user_payload_hash(user), before)
+
+    @patch('discourse_integration.api.requests.Session.request')
+    def test_burst_of_saves_coalesces_into_one_create(self, mock_requests_request):
+        mock_requests_request.return_value = self.make_response({'success': True, 'id': 44})
+        with self.settings(DISCOURSE_SYNC_COALESCE_WINDOW=60):
+            user = User.objects.create_user(username='bursty', email='bursty@example.com')
+            user.first_name = 'Bursty'
+            user.save()
+            user.email = 'bursty2@example.com'
+            user.save()
+        self.assertEqual(DiscourseOutbox.objects.count(), 1)
+
+        DiscourseOutbox.objects.update(available_at=timezone.now())
+        drain_outbox()
+        self.assertEqual(mock_requests_request.call_count, 1)
+        sent_json = mock_requests_request.call_args[1]['json']
+        self.assertEqual(mock_requests_request.call_args[0][0], 'POST')
+        self.assertEqual(sent_json['email'], 'bursty2@example.com')
+
+    @patch('discourse_integration.api.requests.Session.request')
+    def test_drain_merges_rows_for_same_user(self, mock_requests_request):
+        mock_requests_request.return_value = self.make_response({'success': True, 'id': 45})
+        user = User.objects.create_user(username='merged', email='merged@example.com')
+        user.first_name = 'Merged'
+        user.save()
+        self.assertEqual(DiscourseOutbox.objects.count(), 2)
+
+        self.assertEqual(drain_outbox(), 2)
+        self.assertEqual(mock_requests_request.call_count, 1)
+        self.assertEqual(mock_requests_request.call_args[0][0], 'POST')
+        self.assertFalse(DiscourseOutbox.objects.exists())
+
+    @patch('discourse_integration.api.requests.Session.request')
+    def test_drain_claims_rows_before_calling_discourse(self, mock_requests_request):
+        user = User.objects.create_user(username='leased', email='leased@example.com')
+        DiscourseOutbox.objects.update(available_at=timezone.now())
+
+        def respond(*args, **kwargs):
+            # The row is leased, so a concurrent worker would not claim it
+            self.assertGreater(DiscourseOutbox.objects.get().available_at, timezone.now())
+            return self.make_response({'success': True, 'id': 46})
+        mock_requests_request.side_effect = respond
+        self.assertEqual(drain_outbox(), 1)
+        self.assertEqual(DiscourseProfile.objects.get(user=user).discourse_user_id, 46)
+        self.assertFalse(DiscourseOutbox.objects.exists())
+
+    @patch('discourse_integration.api.requests.Session.request')
+    def test_database_error_fails_only_its_row(self, mock_requests_request):
+        User.objects.create_user(username='holder')
+        DiscourseProfile.objects.filter(user__username='holder').update(discourse_user_id=47)
+        clashing = User.objects.create_user(username='clashing', email='clashing@example.com')
+        fine = User.objects.create_user(username='fine', email='fine@example.com')
+        DiscourseOutbox.objects.exclude(user_id__in=[clashing.pk, fine.pk]).delete()
+        mock_requests_request.side_effect = [
+            self.make_response({'success': True, 'id': 47}), # Already linked to holder
+            self.make_response({'success': True, 'id': 48}),
+        ]
+
+        self.assertEqual(drain_outbox(), 2)
+        row = DiscourseOutbox.objects.get()
+        self.assertEqual((row.user_id, row.attempts), (clashing.pk, 1))
+        self.assertEqual(DiscourseProfile.objects.get(user=clashing).sync_status, DiscourseProfile.FAILED)
+        self.assertEqual(DiscourseProfile.objects.get(user=fine).discourse_user_id, 48)
+
+    @patch('discourse_integration.api.requests.Session.request')
+    def test_create_for_linked_user_is_sent_as_update(self, mock_requests_request):
+        mock_requests_request.return_value = self.make_response({})
+        user = self.make_linked_user('relinked', 49)
+        user.first_name = 'Relinked'
+        user.save()
+        DiscourseOutbox.objects.update(action=DiscourseOutbox.CREATE)
+
+        drain_outbox()
+        self.assertEqual(mock_requests_request.call_args[0][:2], ('PUT', 'https://testdiscourse.com/admin/users/49.json'))
+        self.assertFalse(DiscourseOutbox.objects.exists())
+
+    def make_linked_user(self, username, discourse_user_id, **extra):
+        user = User.objects.create_user(username=username, email=f'{username}@example.com', **extra)
+        DiscourseProfile.objects.update_or_create(user=user, defaults={'discourse_user_id': discourse_user_id})
+        return user
+
+    def queued_deletions(self):
+        return list(
+            DiscourseOutbox.objects.filter(action=DiscourseOutbox.DELETE)
+            .order_by('discourse_user_id').values_list('user_id', 'discourse_user_id')
+        )
+
+    @patch('discourse_integration.api.requests.Session.request')
+    def test_deleting_user_queues_discourse_deletion(self, mock_requests_request):
+        user = self.make_linked_user('leaving', 50)
+        user_id = user.pk
+        user.delete()
+        mock_requests_request.assert_not_called()
+        self.assertEqual(self.queued_deletions(), [(user_id, 50)])
+
+    def test_bulk_delete_queues_with_one_insert(self):
+        users = [self.make_linked_user(f'bulk{i}', 60 + i) for i in range(3)]
+        self.make_linked_user('staffer', 70, is_staff=True)
+        User.objects.create_user(username='unlinked')
+        DiscourseOutbox.objects.all().delete()
+
+        with CaptureQueriesContext(connection) as queries:
+            User.objects.all().delete()
+        inserts = [query for query in queries if query['sql'].startswith('INSERT INTO "discourse_integration_discourseoutbox"')]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(self.queued_deletions(), [(user.pk, 60 + i) for i, user in enumerate(users)])
+
+    def test_deleting_profile_alone_queues_nothing(self):
+        user = self.make_linked_user('unlinking', 80)
+        DiscourseOutbox.objects.all().delete()
+        user.discourse_profile.delete()
+        self.assertFalse(DiscourseOutbox.objects.exists())
+
+    @patch('discourse_integration.api.requests.Session.request')
+    def test_drain_deletes_and_supersedes_pending_syncs(self, mock_requests_request):
+        mock_requests_request.return_value = self.make_response({'deleted': True})
+        user = self.make_linked_user('purged', 90)
+        user.first_name = 'Purged'
+        user.save()
+        user.delete()
+        self.assertEqual(DiscourseOutbox.objects.count(), 3)
+
+        with self.settings(DISCOURSE_DELETE_OPTIONS={'delete_posts': True}):
+            self.assertEqual(drain_outbox(), 3)
+        mock_requests_request.assert_called_once()
+        call_args, call_kwargs = mock_requests_request.call_args
+        self.assertEqual(call_args[:2], ('DELETE', 'https://testdiscourse.com/admin/users/90.json'))
+        self.assertEqual(call_kwargs['params'], {'block_email': True, 'block_urls': True, 'delete_posts': True})
+        self.assertFalse(DiscourseOutbox.objects.exists())
+
+    @patch('discourse_integration.api.requests.Session.request')
+    def test_drain_treats_missing_discourse_user_as_deleted(self, mock_requests_request):
+        response = self.make_response({'errors': ['Not found']})
+        response.status_code = 404
+        response.raise_for_status.side_effect = requests.exceptions.HTTPError('404 Not Found', response=response)
+        mock_requests_request.return_value = response
+        self.make_linked_user('gone', 91).delete()
+        DiscourseOutbox.objects.exclude(action=DiscourseOutbox.DELETE).delete()
+
+        self.assertEqual(drain_outbox(), 1)
+        self.assertFalse(DiscourseOutbox.objects.exists())
+
+    @patch('discourse_integration.api.requests.Session.request')
+    def test_drain_reschedules_failed_deletions(self, mock_requests_request):
+        mock_requests_request.side_effect = requests.exceptions.ConnectionError('down')
+        self.addCleanup(get_circuit_breaker('https://testdiscourse.com').reset)
+        self.make_linked_user('stuck', 92).delete()
+        DiscourseOutbox.objects.exclude(action=DiscourseOutbox.DELETE).delete()
+
+        self.assertEqual(drain_outbox(), 1)
+        row = DiscourseOutbox.objects.get()
+        self.assertEqual((row.action, row.discourse_user_id, row.attempts), (DiscourseOutbox.DELETE, 92, 1))
+        self.assertGreater(row.available_at, timezone.now())
+
+@override_settings(
+    DISCOURSE_BASE_URL='https://testdiscourse.com/',
+    DISCOURSE_API_KEY='test_api_key',
+    DISCOURSE_API_USERNAME='test_api_username',
+    DEBUG=True
+)
+class SyncDiscourseUsersCommandTests(TestCase):
+    """
+    Tests for the sync_discourse_users bulk reconciler.
+    """
+
+    def setUp(self):
+        self.linked = User.objects.create_user(username='linked', email='linked@example.com')
+        DiscourseProfile.objects.filter(user=self.linked).update(discourse_user_id=501)
+        self.unlinked = User.objects.create_user(username='unlinked', email='unlinked@example.com')
+        User.objects.create_superuser(username='admin', email='admin@example.com', password='pw')
+
+    def run_command(self, *args):
+        out = StringIO()
+        call_command('sync_discourse_users', '--workers=1', *args, stdout=out)
+        return out.getvalue()
+
+    @patch('discourse_integration.api.requests.Session.request')
+    def test_dry_run_makes_no_calls(self, mock_requests_request):
+        output = self.run_command('--dry-run')
+        mock_requests_request.assert_not_called()
+        self.assertIn("Would create 1, would update 1, would link 0, unchanged 0, failed 0.", output)
+
+    @patch('discourse_integration.api.requests.Session.request')
+    def test_creates_and_updates(self, mock_requests_request):
+        mock_requests_request.return_value.json.return_value = {'success': True, 'id': 502}
+        output = self.run_command('--batch-size=1')
+        methods = sorted(call[0][0] for call in mock_requests_request.call_args_list)
+        self.assertEqual(methods, ['POST', 'PUT'])
+        self.assertEqual(DiscourseProfile.objects.get(user=self.unlinked).discourse_user_id, 502)
+        self.assertIn("Created 1, updated 1, linked 0, unchanged 0, failed 0.", output)
+        # A finished run clears its checkpoint
+        self.assertFalse(DiscourseSyncCheckpoint.objects.exists())
+
+    @patch('discourse_integration.api.requests.Session.request')
+    def test_resumes_from_checkpoint(self, mock_requests_request):
+        mock_requests_request.return_value.json.return_value = {'success': True, 'id': 502}
+        DiscourseSyncCheckpoint.objects.create(name='sync_discourse_users', last_user_id=self.linked.pk)
+        self.run_command()
+        self.assertEqual(mock_requests_request.call_count, 1)
+        self.assertEqual(mock_requests_request.call_args[0][0], 'POST')
+
+    @patch('discourse_integration.api.requests.Session.request')
+    def test_since_filters_by_activity(self, mock_requests_request):
+        User.objects.filter(pk=self.linked.pk).update(date_joined=timezone.now() - timezone.timedelta(days=30))
+        output = self.run_command('--dry-run', '--since', (timezone.now() - timezone.timedelta(days=1)).date().isoformat())
+        self.assertIn("Would create 1, would update 0", output)
+
+    @patch('discourse_integration.api.requests.Session.request')
+    def test_indexed_users_are_linked_without_create(self, mock_requests_request):
+        DiscourseUserIndex.objects.create(discourse_user_id=503, username='unlinked', external_id=str(self.unlinked.pk), refreshed_at=timezone.now())
+        mock_requests_request.return_value.json.return_value = {}
+        output = self.run_command()
+        # Only the update for the already-linked user goes out
+        self.assertEqual([call[0][0] for call in mock_requests_request.call_args_list], ['PUT'])
+        self.assertEqual(DiscourseProfile.objects.get(user=self.unlinked).discourse_user_id, 503)
+        self.assertIn("linked 1,", output)
+
+    @patch('discourse_integration.api.requests.Session.request')
+    def test_indexed_username_collision_is_a_conflict(self, mock_requests_request):
+        DiscourseUserIndex.objects.create(discourse_user_id=504, username='unlinked', refreshed_at=timezone.now())
+        mock_requests_request.return_value.json.return_value = {}
+        output = self.run_command()
+        # The other account is neither updated nor linked
+        self.assertEqual([call[0][1] for call in mock_requests_request.call_args_list], ['https://testdiscourse.com/admin/users/501.json'])
+        profile = DiscourseProfile.objects.get(user=self.unlinked)
+        self.assertIsNone(profile.discourse_user_id)
+        self.assertIn('504', profile.last_error)
+        self.assertIn("linked 0, unchanged 0, failed 1.", output)
+
+class RateLimiterTests(SimpleTestCase):
+    """
+    Tests for the client-side Discourse rate limiters.
+    """
+
+    def test_bucket_allows_burst_then_asks_to_wait(self):
+        limiter = RateLimiter(per_minute=60, burst=2, max_concurrency=4)
+        self.assertEqual(limiter.try_acquire(), 0)
+        self.assertEqual(limiter.try_acquire(), 0)
+        self.assertAlmostEqual(limiter.try_acquire(), 1.0, places=1)
+
+    def test_429_pauses_and_halves_concurrency(self):
+        limiter = RateLimiter(per_minute=600, burst=10, max_concurrency=8)
+        self.assertEqual(limiter.observe(429, {'Retry-After': '30'}), 30)
+        self.assertEqual(limiter.concurrency, 4)
+        self.assertGreater(limiter.try_acquire(), 29)
+
+    def test_successes_grow_concurrency_back(self):
+        limiter = RateLimiter(per_minute=600, burst=10, max_concurrency=8)
+        limiter.observe(429, {'Retry-After': '0'})
+        for _ in range(4):
+            limiter.observe(200, {})
+        self.assertEqual(limiter.concurrency, 5)
+
+    def test_exhausted_remaining_header_pauses(self):
+        limiter = RateLimiter(per_minute=600, burst=10, max_concurrency=8)
+        limiter.observe(200, {'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': '5'})
+        self.assertGreater(limiter.try_acquire(), 4)
+
+    def test_epoch_reset_header_pauses_until_that_time(self):
+        limiter = RateLimiter(per_minute=600, burst=10, max_concurrency=8)
+        limiter.observe(200, {'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': str(int(time.time()) + 5)})
+        self.assertTrue(3 < limiter.try_acquire() <= 5)
+
+    @override_settings(DISCOURSE_RETRY_MAX_BACKOFF=8)
+    def test_reset_header_pause_is_capped(self):
+        limiter = RateLimiter(per_minute=600, burst=10, max_concurrency=8)
+        limiter.observe(200, {'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': '3600'})
+        self.assertLessEqual(limiter.try_acquire(), 8)
+        limiter = RateLimiter(per_minute=600, burst=10, max_concurrency=8)
+        limiter.observe(200, {'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': str(int(time.time()) + 86400)})
+        self.assertLessEqual(limiter.try_acquire(), 8)
+
+    def test_acquire_gives_up_after_max_wait(self):
+        limiter = RateLimiter(per_minute=60, burst=1, max_concurrency=4)
+        limiter.acquire()
+        with self.assertRaises(RateLimitTimeout) as cm:
+            limiter.acquire(max_wait=0.1)
+        self.assertGreater(cm.exception.retry_after, 0.5)
+
+    def test_slot_gives_up_when_concurrency_is_exhausted(self):
+        limiter = RateLimiter(per_minute=6000, burst=10, max_concurrency=1)
+        with limiter.slot():
+            with self.assertRaises(RateLimitTimeout):
+                with limiter.slot(max_wait=0.05):
+                    pass
+        with limiter.slot(max_wait=0.05):
+            pass
+
+    async def test_async_slot_respects_concurrency_cap(self):
+        limiter = RateLimiter(per_minute=6000, burst=10, max_concurrency=2)
+        limiter.observe(429, {'Retry-After': '0'}) # Cap drops to 1
+        async with limiter.aslot():
+            with self.assertRaises(RateLimitTimeout):
+                async with limiter.aslot(max_wait=0.05):
+                    pass
+        async with limiter.aslot(max_wait=0.05):
+            pass
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'ratelimit-tests'}})
+    def test_cache_limiter_shares_budget_between_instances(self):
+        first = CacheRateLimiter(per_minute=2, burst=2, max_concurrency=4, key_prefix='test:ratelimit')
+        second = CacheRateLimiter(per_minute=2, burst=2, max_concurrency=4, key_prefix='test:ratelimit')
+        self.assertEqual(first.try_acquire(), 0)
+        self.assertEqual(second.try_acquire(), 0)
+        self.assertGreater(first.try_acquire(), 0)
+        second.pause(5)
+        self.assertGreater(CacheRateLimiter(2, 2, 4, key_prefix='test:ratelimit').try_acquire(), 4)
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'ratelimit-burst-tests'}})
+    def test_cache_limiter_windows_admit_one_burst(self):
+        limiter = CacheRateLimiter(per_minute=600, burst=5, max_concurrency=4, key_prefix='test:burst')
+        self.assertEqual(limiter.window, 0.5)
+        with patch('discourse_integration.ratelimit.time.time', return_value=1000.125):
+            self.assertEqual([limiter.try_acquire() for _ in range(5)], [0] * 5)
+            # The sixth request waits for the next 0.5s window, not the next minute
+            self.assertAlmostEqual(limiter.try_acquire(), 0.375)
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'ratelimit-async-tests'}})
+    async def test_cache_limiter_async_path_shares_budget(self):
+        limiter = CacheRateLimiter(per_minute=2, burst=2, max_concurrency=4, key_prefix='test:async')
+        self.assertEqual(await limiter.atry_acquire(), 0)
+        self.assertEqual(limiter.try_acquire(), 0)
+        self.assertGreater(await limiter.atry_acquire(), 0)
+        limiter.pause(5)
+        self.assertGreater(await CacheRateLimiter(2, 2, 4, key_prefix='test:async').atry_acquire(), 4)
+
+    @override_settings(
+        DISCOURSE_BASE_URL='https://testdiscourse.com/',
+        DISCOURSE_API_KEY='test_api_key',
+        DISCOURSE_API_USERNAME='test_api_username',
+        DISCOURSE_RATE_LIMIT_PER_MINUTE=6000,
+        DISCOURSE_RATE_LIMIT_BURST=100,
+    )
+    @patch('discourse_integration.api.requests.Session.request')
+    def test_make_request_raises_rate_limited(self, mock_requests_request):
+        mock_requests_request.return_value.status_code = 429
+        mock_requests_request.return_value.headers = {'Retry-After': '0'}
+        with self.assertRaises(DiscourseRateLimited) as cm:
+            DiscourseAPI()._make_request('GET', 'about.json')
+        self.assertEqual(cm.exception.retry_after, 0)
+
+@override_settings(
+    DISCOURSE_BASE_URL='https://flakydiscourse.com/',
+    DISCOURSE_API_KEY='test_api_key',
+    DISCOURSE_API_USERNAME='test_api_username',
+    DISCOURSE_RETRIES=2,
+    DISCOURSE_BREAKER_FAILURE_THRESHOLD=3,
+    DISCOURSE_BREAKER_RESET_TIMEOUT=30,
+    DISCOURSE_RATE_LIMIT_PER_MINUTE=None,
+)
+class RetryAndCircuitBreakerTests(SimpleTestCase):
+    """
+    Tests for retries and the circuit breaker around DiscourseAPI._make_request.
+    """
+
+    def setUp(self):
+        self.breaker = get_circuit_breaker('https://flakydiscourse.com')
+        self.breaker.reset()
+        sleep_patcher = patch('discourse_integration.api.time.sleep')
+        self.sleep = sleep_patcher.start()
+        self.addCleanup(sleep_patcher.stop)
+
+    def make_response(self, status_code, payload=None):
+        response = requests.Response()
+        response.status_code = status_code
+        response._content = json.dumps(payload or {}).encode('utf-8')
+        return response
+
+    @patch('discourse_integration.api.requests.Session.request')
+    def test_idempotent_call_is_retried_after_5xx(self, mock_requests_request):
+        mock_requests_request.side_effect = [self.make_response(503), self.make_response(200, {'ok': True})]
+        self.assertEqual(DiscourseAPI()._make_request('PUT', 'admin/users/1.json'), {'ok': True})
+        self.assertEqual(mock_requests_request.call_count, 2)
+        self.sleep.assert_called_once()
+
+    @patch('discourse_integration.api.requests.Session.request')
+    def test_post_is_not_retried(self, mock_requests_request):
+        mock_requests_request.side_effect = requests.exceptions.ConnectionError('refused')
+        with self.assertRaises(DiscourseAPIError):
+            DiscourseAPI()._make_request('POST', 'users.json')
+        self.assertEqual(mock_requests_request.call_count, 1)
+
+    @patch('discourse_integration.api.requests.Session.request')
+    def test_client_errors_are_not_retried(self, mock_requests_request):
+        mock_requests_request.return_value = self.make_response(404)
+        with self.assertRaises(DiscourseAPIError):
+            DiscourseAPI()._make_request('GET', 'u/missing.json')
+        self.assertEqual(mock_requests_request.call_count, 1)
+        self.assertEqual(self.breaker.failures, 0)
+
+    @patch('discourse_integration.api.requests.Session.request')
+    def test_breaker_opens_and_fails_fast(self, mock_requests_request):
+        mock_requests_request.side_effect = requests.exceptions.Timeout('slow')
+        for _ in range(3):
+            with self.assertRaises(DiscourseAPIError):
+                DiscourseAPI()._make_request('POST', 'users.json')
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+        with self.assertRaises(DiscourseUnavailable) as cm:
+            DiscourseAPI()._make_request('POST', 'users.json')
+        self.assertEqual(mock_requests_request.call_count, 3)
+        self.assertGreater(cm.exception.retry_after, 0)
+        self.assertEqual(self.breaker.snapshot()['rejected'], 1)
+
+    @patch('discourse_integration.api.requests.Session.request')
+    def test_half_open_probe_closes_breaker(self, mock_requests_request):
+        mock_requests_request.return_value = self.make_response(200, {})
+        for _ in range(3):
+            self.breaker.record_failure()
+        self.breaker.opened_at -= 31
+        DiscourseAPI()._make_request('GET', 'about.json')
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_failure_classification(self):
+        self.assertTrue(classify_failure(None, True))
+        self.assertTrue(classify_failure(503, False))
+        self.assertFalse(classify_failure(404, False))
+        self.assertFalse(classify_failure(None, False))
+
+    def test_half_open_allows_a_single_probe(self):
+        for _ in range(3):
+            self.breaker.record_failure()
+        self.breaker.opened_at -= 31
+        self.assertTrue(self.breaker.allow_request())
+        self.assertFalse(self.breaker.allow_request())
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+class TTLCacheTests(SimpleTestCase):
+    """
+    Tests for the bounded TTL/LRU cache used for Discourse lookups.
+    """
+
+    def test_evicts_least_recently_used(self):
+        cache = TTLCache(maxsize=2, ttl=60, negative_ttl=10)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+
+    def test_entries_expire(self):
+        cache = TTLCache(maxsize=10, ttl=60, negative_ttl=0)
+        cache.set('hit', {'id': 1})
+        cache.set('miss', MISSING)
+        self.assertEqual(cache.get('hit'), {'id': 1})
+        self.assertIsNone(cache.get('miss'))
+
+    @override_settings(
+        CACHES={'shared': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'lookup-tests'}},
+        DISCOURSE_LOOKUP_CACHE_ALIAS='shared',
+    )
+    def test_shared_cache_round_trips_hits_and_misses(self):
+        cache = get_lookup_cache('https://shareddiscourse.com')
+        self.assertIsInstance(cache, SharedLookupCache)
+        cache.set(('username', 'jane doe'), {'id': 1})
+        cache.set(('external_id', '7'), MISSING)
+        self.assertEqual(cache.get(('username', 'jane doe')), {'id': 1})
+        self.assertIs(cache.get(('external_id', '7')), MISSING)
+        cache.delete(('username', 'jane doe'))
+        self.assertIsNone(cache.get(('username', 'jane doe')))
+
+@override_settings(
+    DISCOURSE_BASE_URL='https://testdiscourse.com/',
+    DISCOURSE_API_KEY='test_api_key',
+    DISCOURSE_API_USERNAME='test_api_username',
+    DISCOURSE_RATE_LIMIT_PER_MINUTE=None,
+    DEBUG=True
+)
+class DiscourseLookupTests(TestCase):
+    """
+    Tests for cached Discourse user lookups and the missing-ID resolver.
+    """
+
+    def setUp(self):
+        get_lookup_cache('https://testdiscourse.com').clear()
+        self.user = User.objects.create_user(username='lookup', email='lookup@example.com')
+        DiscourseOutbox.objects.all().delete()
+
+    def make_response(self, status_code, payload=None):
+        response = requests.Response()
+        response.status_code = status_code
+        response._content = json.dumps(payload or {}).encode('utf-8')
+        return response
+
+    @patch('discourse_integration.api.requests.Session.request')
+    def test_lookup_is_cached(self, mock_requests_request):
+        mock_requests_request.return_value = self.make_response(200, {'user': {'id': 9, 'username': 'lookup', 'bio_raw': 'x' * 1000}})
+        api = DiscourseAPI()
+        self.assertEqual(api.get_user_by_external_id(self.user.pk), {'id': 9, 'username': 'lookup', 'name': None, 'active': None})
+        api.get_user_by_external_id(self.user.pk)
+        self.assertEqual(mock_requests_request.call_count, 1)
+        self.assertEqual(mock_requests_request.call_args[0][1], f'https://testdiscourse.com/u/by-external/{self.user.pk}.json')
+
+    @patch('discourse_integration.api.requests.Session.request')
+    def test_misses_are_cached(self, mock_requests_request):
+        mock_requests_request.return_value = self.make_response(404)
+        api = DiscourseAPI()
+        self.assertIsNone(api.get_user_by_external_id(self.user.pk))
+        self.assertIsNone(api.get_user_by_external_id(self.user.pk))
+        self.assertEqual(mock_requests_request.call_count, 1)
+
+    @patch('discourse_integration.api.requests.Session.request')
+    def test_create_without_id_is_resolved(self, mock_requests_request):
+        mock_requests_request.side_effect = [
+            self.make_response(200, {'success': True, 'active': True}),
+            self.make_response(404),
+            self.make_response(200, {'user': {'id': 88, 'username': 'lookup'}}),
+        ]
+        sync_user(DiscourseAPI(), self.user, DiscourseOutbox.CREATE)
+        self.assertEqual(DiscourseProfile.objects.get(user=self.user).discourse_user_id, 88)
+        self.assertEqual(mock_requests_request.call_args[0][1], 'https://testdiscourse.com/u/lookup.json')
+
+    @patch('discourse_integration.api.requests.Session.request')
+    def test_resolve_missing_ids_links_profiles(self, mock_requests_request):
+        other = User.objects.create_user(username='lookup2')
+        holder = User.objects.create_user(username='holder')
+        DiscourseProfile.objects.filter(user=holder).update(discourse_user_id=2)
+
+        def respond(method, url, **kwargs):
+            if url.endswith(f'/u/by-external/{self.user.pk}.json'):
+                return self.make_response(200, {'user': {'id': 1}})
+            if url.endswith(f'/u/by-external/{other.pk}.json'):
+                return self.make_response(200, {'user': {'id': 2}}) # Already linked elsewhere
+            return self.make_response(404)
+        mock_requests_request.side_effect = respond
+
+        self.assertEqual(resolve_missing_discourse_ids(workers=2, batch_size=1), 1)
+        self.assertEqual(DiscourseProfile.objects.get(user=self.user).discourse_user_id, 1)
+        self.assertIsNone(DiscourseProfile.objects.get(user=other).discourse_user_id)
+
+@override_settings(
+    DISCOURSE_BASE_URL='https://testdiscourse.com/',
+    DISCOURSE_API_KEY='test_api_key',
+    DISCOURSE_API_USERNAME='test_api_username',
+    DEBUG=True
+)
+class DiscourseUserIndexTests(TestCase):
+    """
+    Tests for the local index of Discourse users.
+    """
+
+    def make_response(self, json_data, status_code=200):
+        response = MagicMock()
+        response.status_code = status_code
+        response.headers = {}
+        response.json.return_value = json_data
+        if status_code >= 400:
+            response.raise_for_status.side_effect = requests.exceptions.HTTPError(response=response)
+        return response
+
+    def pages(self, *pages):
+        return [self.make_response(list(page)) for page in pages] + [self.make_response([])]
+
+    @patch('discourse_integration.api.requests.Session.request')
+    def test_full_refresh_streams_pages_and_drops_deleted(self, mock_requests_request):
+        DiscourseUserIndex.objects.create(discourse_user_id=99, username='gone', refreshed_at=timezone.now() - timezone.timedelta(days=1))
+        mock_requests_request.side_effect = self.pages(
+            [{'id': 3, 'username': 'Carol', 'email': 'Carol@Example.com'}, {'id': 2, 'username': 'bob', 'email': 'bob@example.com'}],
+            [{'id': 1, 'username': 'alice', 'email': 'alice@example.com'}],
+        )
+        self.assertEqual(refresh_user_index(DiscourseAPI(), full=True), 3)
+        self.assertEqual(mock_requests_request.call_count, 3)
+        self.assertEqual(mock_requests_request.call_args_list[1][1]['params']['page'], 2)
+        self.assertEqual(sorted(DiscourseUserIndex.objects.values_list('discourse_user_id', flat=True)), [1, 2, 3])
+        self.assertEqual(DiscourseUserIndex.objects.get(discourse_user_id=3).email, 'carol@example.com')
+
+    @patch('discourse_integration.api.requests.Session.request')
+    def test_incremental_refresh_stops_at_known_page(self, mock_requests_request):
+        DiscourseUserIndex.objects.create(discourse_user_id=2, username='bob', refreshed_at=timezone.now())
+        mock_requests_request.side_effect = self.pages(
+            [{'id': 3, 'username': 'carol'}],
+            [{'id': 2, 'username': 'bob'}],
+            [{'id': 1, 'username': 'alice'}],
+        )
+        self.assertEqual(refresh_user_index(DiscourseAPI()), 2)
+        self.assertEqual(mock_requests_request.call_count, 2)
+        self.assertFalse(DiscourseUserIndex.objects.filter(discourse_user_id=1).exists())
+
+    def test_find_adopts_only_matching_external_id(self):
+        user = User.objects.create_user(username='Dana', email='Dana@Example.com')
+        DiscourseUserIndex.objects.create(discourse_user_id=7, username='someone', email='dana@example.com', refreshed_at=timezone.now())
+        self.assertEqual(find_indexed_user(user), (None, 7))
+        DiscourseUserIndex.objects.create(discourse_user_id=6, username='dana', external_id=str(user.pk), refreshed_at=timezone.now())
+        self.assertEqual(find_indexed_user(user), (6, None))
+
+    @patch('discourse_integration.api.requests.Session.request')
+    def test_create_user_refuses_account_sharing_email(self, mock_requests_request):
+        user = User.objects.create_user(username='bob', email='shared@example.com')
+        DiscourseUserIndex.objects.create(discourse_user_id=5, username='admin', email='shared@example.com', refreshed_at=timezone.now())
+        with self.assertRaises(DiscourseConflict) as cm:
+            DiscourseAPI().create_user(user)
+        self.assertEqual(cm.exception.discourse_user_id, 5)
+        mock_requests_request.assert_not_called()
+
+    @patch('discourse_integration.api.requests.Session.request')
+    def test_create_user_updates_indexed_account_instead(self, mock_requests_request):
+        user = User.objects.create_user(username='erin', email='erin@example.com')
+        DiscourseUserIndex.objects.create(discourse_user_id=8, username='erin', external_id=str(user.pk), refreshed_at=timezone.now())
+        mock_requests_request.return_value = self.make_response({})
+        self.assertEqual(DiscourseAPI().create_user(user), 8)
+        self.assertEqual(mock_requests_request.call_args[0][0], 'PUT')
+        self.assertTrue(mock_requests_request.call_args[0][1].endswith('admin/users/8.json'))
+
+    @patch('discourse_integration.api.requests.Session.request')
+    def test_create_user_falls_back_when_indexed_account_is_gone(self, mock_requests_request):
+        user = User.objects.create_user(username='finn', email='finn@example.com')
+        DiscourseUserIndex.objects.create(discourse_user_id=9, username='finn', external_id=str(user.pk), refreshed_at=timezone.now())
+        mock_requests_request.side_effect = [self.make_response({}, status_code=404), self.make_response({'success': True, 'id': 10})]
+        self.assertEqual(DiscourseAPI().create_user(user), 10)
+        self.assertEqual(mock_requests_request.call_args[0][0], 'POST')
+        self.assertFalse(DiscourseUserIndex.objects.exists())
+
+class SSOCodecTests(SimpleTestCase):
+    """
+    Tests for the DiscourseConnect codec.
+    """
+
+    def setUp(self):
+        self.codec = SSOCodec('sso_secret')
+
+    def test_round_trip(self):
+        sso, sig = self.codec.encode({'nonce': 'abc', 'email': 'a+b@example.com', 'name': 'Jane Doe'})
+        self.assertEqual(self.codec.decode(sso, sig), {'nonce': 'abc', 'email': 'a+b@example.com', 'name': 'Jane Doe'})
+
+    def test_signature_matches_fresh_hmac(self):
+        sso, sig = self.codec.encode({'nonce': 'abc'})
+        self.assertEqual(sig, hmac.new(b'sso_secret', sso.encode('utf-8'), hashlib.sha256).hexdigest())
+
+    def test_rejects_tampered_malformed_and_oversized_payloads(self):
+        sso, sig = self.codec.encode({'nonce': 'abc'})
+        for bad_sso, bad_sig in [
+            (sso, '0' * 64),            # wrong signature
+            (sso, sig[:-1]),            # wrong length
+            (sso, 'z' * 64),            # not hex
+            ('not base64!', sig),       # outside the base64 alphabet
+            ('A' * 5000, sig),          # larger than max_payload_length
+        ]:
+            with self.assertRaises(SSOError):
+                self.codec.decode(bad_sso, bad_sig)
+
+    def test_parse_payload_keeps_first_value(self):
+        self.assertEqual(parse_payload('a=1&b=x%20y&a=2&junk&c=p+q'), {'a': '1', 'b': 'x y', 'c': 'p q'})
+
+@override_settings(
+    DISCOURSE_SSO_SECRET='sso_secret',
+    DISCOURSE_SSO_LOGIN_URL='https://testdiscourse.com/session/sso_provider',
+    LOGIN_REDIRECT_URL='/',
+)
+class DiscourseSSOViewTests(TestCase):
+    """
+    Tests for the SSO login and callback views.
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='ssouser', email='sso@example.com')
+        self.codec = SSOCodec('sso_secret')
+
+    def test_login_then_callback(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('discourse:discourse_sso_login'))
+        self.assertEqual(response.status_code, 302)
+        query = parse_qs(urlsplit(response['Location']).query)
+        payload = self.codec.decode(query['sso'][0], query['sig'][0])
+        self.assertEqual(payload['external_id'], str(self.user.pk))
+
+        sso, sig = self.codec.encode({'nonce': payload['nonce'], 'external_id': str(self.user.pk)})
+        response = self.client.post(reverse('discourse:discourse_sso_callback'), {'sso': sso, 'sig': sig})
+        self.assertRedirects(response, '/', fetch_redirect_response=False)
+
+    def sso_handshake(self, start):
+        response = self.client.get(start, follow=False)
+        while urlsplit(response['Location']).netloc != 'testdiscourse.com':
+            response = self.client.get(response['Location'])
+        query = parse_qs(urlsplit(response['Location']).query)
+        payload = self.codec.decode(query['sso'][0], query['sig'][0])
+        return self.codec.encode({'nonce': payload['nonce'], 'external_id': payload['external_id']})
+
+    @override_settings(DISCOURSE_SSO_STATELESS_NONCES=True, DISCOURSE_BASE_URL='https://testdiscourse.com')
+    def test_stateless_nonces_skip_session_and_reject_replays(self):
+        self.client.force_login(self.user)
+        session_key = self.client.session.session_key
+        sso, sig = self.sso_handshake(reverse('discourse:discourse_forum_link'))
+        self.assertNotIn('discourse_sso_nonce', self.client.session)
+
+        callback = reverse('discourse:discourse_sso_callback')
+        response = self.client.post(callback, {'sso': sso, 'sig': sig})
+        self.assertRedirects(response, 'https://testdiscourse.com', fetch_redirect_response=False)
+        self.assertEqual(self.client.session.session_key, session_key)
+        # The same signed nonce cannot be used twice
+        self.assertEqual(self.client.post(callback, {'sso': sso, 'sig': sig}).status_code, 400)
+
+    @override_settings(DISCOURSE_SSO_STATELESS_NONCES=True)
+    def test_stateless_nonce_does_not_log_in(self):
+        self.client.force_login(self.user)
+        sso, sig = self.sso_handshake(reverse('discourse:discourse_sso_login'))
+        self.client.logout()
+
+        response = self.client.post(reverse('discourse:discourse_sso_callback'), {'sso': sso, 'sig': sig})
+        self.assertEqual(response.status_code, 400)
+        self.assertNotIn('_auth_user_id', self.client.session)
+
+    @override_settings(DISCOURSE_SSO_STATELESS_NONCES=True)
+    async def test_async_stateless_nonce_does_not_log_in(self):
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.get(reverse('discourse:discourse_sso_login_async'))
+        query = parse_qs(urlsplit(response['Location']).query)
+        payload = self.codec.decode(query['sso'][0], query['sig'][0])
+        sso, sig = self.codec.encode({'nonce': payload['nonce'], 'external_id': payload['external_id']})
+        await self.async_client.alogout()
+
+        response = await self.async_client.post(reverse('discourse:discourse_sso_callback_async'), {'sso': sso, 'sig': sig})
+        self.assertEqual(response.status_code, 400)
+
+    @override_settings(DISCOURSE_SSO_FRESHNESS_WINDOW=600, DISCOURSE_BASE_URL='https://testdiscourse.com')
+    def test_recent_handshake_skips_sso(self):
+        self.client.force_login(self.user)
+        forum_link = reverse('discourse:discourse_forum_link')
+        sso, sig = self.sso_handshake(forum_link)
+        self.client.post(reverse('discourse:discourse_sso_callback'), {'sso': sso, 'sig': sig})
+
+        response = self.client.get(forum_link)
+        self.assertRedirects(response, 'https://testdiscourse.com', fetch_redirect_response=False)
+
+        # The cookie is tied to the user who completed the handshake
+        other = User.objects.create_user(username='other', email='other@example.com')
+        self.client.force_login(other)
+        self.assertEqual(self.client.get(forum_link)['Location'], reverse('discourse:discourse_sso_login'))
+
+    async def test_async_views_complete_handshake(self):
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.get(reverse('discourse:discourse_forum_link_async'))
+        self.assertEqual(response['Location'], reverse('discourse:discourse_sso_login_async'))
+        response = await self.async_client.get(response['Location'])
+        query = parse_qs(urlsplit(response['Location']).query)
+        payload = self.codec.decode(query['sso'][0], query['sig'][0])
+
+        sso, sig = self.codec.encode({'nonce': payload['nonce'], 'external_id': str(self.user.pk)})
+        response = await self.async_client.post(reverse('discourse:discourse_sso_callback_async'), {'sso': sso, 'sig': sig})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response['Location'], settings.DISCOURSE_BASE_URL)
+
+    async def test_async_login_requires_authentication(self):
+        response = await self.async_client.get(reverse('discourse:discourse_sso_login_async'))
+        self.assertEqual(response.status_code, 302)
+        self.assertIn(settings.LOGIN_URL, response['Location'])
+
+    def test_callback_rejects_bad_signature(self):
+        sso, _ = self.codec.encode({'nonce': 'abc', 'external_id': str(self.user.pk)})
+        response = self.client.post(reverse('discourse:discourse_sso_callback'), {'sso': sso, 'sig': '0' * 64})
+        self.assertEqual(response.status_code, 400)
+
+class NonceSignerTests(SimpleTestCase):
+    """
+    Tests for stateless SSO nonces and the replay cache.
+    """
+
+    def test_round_trip_and_tampering(self):
+        signer = NonceSigner('secret', ttl=60)
+        nonce = signer.issue(42, forum=True)
+        user_id, forum, _ = signer.verify(nonce)
+        self.assertEqual((user_id, forum), (42, True))
+        with self.assertRaises(SSOError):
+            signer.verify('43' + nonce[2:])
+        with self.assertRaises(SSOError):
+            NonceSigner('other', ttl=60).verify(nonce)
+
+    def test_expired_nonce_is_rejected(self):
+        signer = NonceSigner('secret', ttl=-1)
+        with self.assertRaises(SSOError):
+            signer.verify(signer.issue(42))
+
+    def test_replay_cache_accepts_each_nonce_once(self):
+        cache = LocalReplayCache(maxsize=10, ttl=60)
+        self.assertTrue(cache.add('n1', 60))
+        self.assertFalse(cache.add('n1', 60))
+        self.assertTrue(cache.add('n2', 60))
+
+@override_settings(
+    DISCOURSE_BASE_URL='https://testdiscourse.com/',
+    DISCOURSE_API_KEY='test_api_key',
+    DISCOURSE_API_USERNAME='test_api_username',
+    DISCOURSE_SSO_LOGIN_URL='https://testdiscourse.com/session/sso_provider',
+    DISCOURSE_PROVISIONING='first_visit',
+    DISCOURSE_RATE_LIMIT_PER_MINUTE=None,
+    DEBUG=True
+)
+class FirstVisitProvisioningTests(TestCase):
+    """
+    Tests for creating Discourse accounts on first forum visit instead of at signup.
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='lazy', email='lazy@example.com')
+
+    def test_signup_and_edits_queue_nothing(self):
+        self.user.first_name = 'Lazy'
+        self.user.save()
+        self.assertFalse(DiscourseOutbox.objects.exists())
+
+    @override_settings(DISCOURSE_RATE_LIMIT_PER_MINUTE=6001, DISCOURSE_INTERACTIVE_MAX_WAIT=0.05)
+    @patch('discourse_integration.api.requests.Session.request')
+    def test_rate_limited_provisioning_is_queued_without_waiting(self, mock_requests_request):
+        get_rate_limiter().pause(60)
+        self.client.force_login(self.user)
+        started = time.monotonic()
+        response = self.client.get(reverse('discourse:discourse_sso_login'))
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual(response.status_code, 302)
+        mock_requests_request.assert_not_called()
+        self.assertTrue(DiscourseOutbox.objects.filter(user_id=self.user.pk, action=DiscourseOutbox.CREATE).exists())
+
+    @patch('discourse_integration.api.requests.Session.request')
+    def test_first_sso_login_creates_and_links_account(self, mock_requests_request):
+        mock_requests_request.return_value.status_code = 200
+        mock_requests_request.return_value.json.return_value = {'success': True, 'id': 77}
+        self.client.force_login(self.user)
+        login_url = reverse('discourse:discourse_sso_login')
+
+        self.client.get(login_url)
+        self.assertEqual(mock_requests_request.call_args[0][0], 'POST')
+        self.assertEqual(DiscourseProfile.objects.get(user=self.user).discourse_user_id, 77)
+
+        # Later visits find the linked profile and make no calls
+        self.client.get(login_url)
+        self.assertEqual(mock_requests_request.call_count, 1)
+
+        # Once linked, edits are synced again
+        user = User.objects.get(pk=self.user.pk)
+        user.last_name = 'Later'
+        user.save()
+        self.assertTrue(DiscourseOutbox.objects.filter(user_id=self.user.pk, action=DiscourseOutbox.UPDATE).exists())
+
+    @patch('discourse_integration.api.requests.Session.request')
+    def test_failed_provisioning_is_queued_and_sso_continues(self, mock_requests_request):
+        mock_requests_request.side_effect = requests.exceptions.ConnectionError("down")
+        self.addCleanup(get_circuit_breaker('https://testdiscourse.com').reset)
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('discourse:discourse_sso_login'))
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(DiscourseOutbox.objects.filter(user_id=self.user.pk, action=DiscourseOutbox.CREATE).exists())
+
+    @patch('discourse_integration.api.requests.Session.request')
+    def test_repeated_failed_visits_queue_one_create(self, mock_requests_request):
+        mock_requests_request.side_effect = requests.exceptions.ConnectionError("down")
+        self.addCleanup(get_circuit_breaker('https://testdiscourse.com').reset)
+        self.client.force_login(self.user)
+        self.client.get(reverse('discourse:discourse_sso_login'))
+        self.client.get(reverse('discourse:discourse_sso_login'))
+        self.assertEqual(DiscourseOutbox.objects.filter(user_id=self.user.pk).count(), 1)
+
+    @patch('discourse_integration.api.requests.Session.request')
+    def test_rejected_provisioning_is_recorded_not_queued(self, mock_requests_request):
+        response = requests.Response()
+        response.status_code = 422
+        response._content = b'{"errors": ["Username must be unique"]}'
+        mock_requests_request.return_value = response
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get(reverse('discourse:discourse_sso_login')).status_code, 302)
+        self.assertFalse(DiscourseOutbox.objects.exists())
+        profile = DiscourseProfile.objects.get(user=self.user)
+        self.assertEqual((profile.sync_status, profile.sync_attempts), (DiscourseProfile.FAILED, 1))
+
+    @patch('discourse_integration.api.requests.Session.request')
+    def test_backfill_links_known_accounts_and_defers_the_rest(self, mock_requests_request):
+        known = User.objects.create_user(username='known', email='known@example.com')
+        DiscourseUserIndex.objects.create(discourse_user_id=78, username='known', external_id=str(known.pk), refreshed_at=timezone.now())
+        out = StringIO()
+        call_command('sync_discourse_users', '--workers=1', stdout=out)
+        mock_requests_request.assert_not_called()
+        self.assertIn("linked 1, unchanged 0, deferred 1, failed 0.", out.getvalue())
+
+class UserSaveQueryBudgetTests(TestCase):
+    """
+    Query budget of the post_save dispatcher, counting the user's own save.
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='budget', email='budget@example.com')
+
+    def test_signup(self):
+        # user insert, profile insert, outbox insert
+        with self.assertNumQueries(3):
+            User.objects.create_user(username='budget2', email='budget2@example.com')
+
+    def test_login_and_password_saves_are_free(self):
+        self.user.last_login = timezone.now()
+        with self.assertNumQueries(1):
+            self.user.save(update_fields=['last_login'])
+        self.user.set_unusable_password()
+        with self.assertNumQueries(1):
+            self.user.save(update_fields=['password'])
+
+    def test_profile_edit(self):
+        DiscourseOutbox.objects.all().delete()
+        self.user.first_name = 'Budget'
+        # user update, coalescing check, outbox insert
+        with self.assertNumQueries(3):
+            self.user.save()
+        # A second edit folds into the pending row: no insert
+        self.user.last_name = 'Budget'
+        with self.assertNumQueries(2):
+            self.user.save()
+
+    @override_settings(DISCOURSE_SYNC_COALESCE_WINDOW=0)
+    def test_profile_edit_without_coalescing(self):
+        self.user.first_name = 'Budget'
+        with self.assertNumQueries(2):
+            self.user.save()
+
+    @override_settings(DISCOURSE_PROVISIONING='first_visit')
+    def test_first_visit_mode_reuses_cached_profile(self):
+        user = User.objects.get(pk=self.user.pk)
+        user.first_name = 'Budget'
+        # user update, one profile lookup; nothing queued for an unlinked user
+        with self.assertNumQueries(2):
+            user.save()
+        with self.assertNumQueries(1):
+            user.save()
+        self.assertEqual(DiscourseOutbox.objects.filter(action=DiscourseOutbox.UPDATE).count(), 0)
+
+@override_settings(
+    DISCOURSE_BASE_URL='https://testdiscourse.com/',
+    DISCOURSE_API_KEY='test_api_key',
+    DISCOURSE_API_USERNAME='test_api_username',
+    DISCOURSE_RATE_LIMIT_PER_MINUTE=None,
+    DEBUG=True
+)
+class BulkSyncTests(TestCase):
+    """
+    Tests for bulk.sync_users and bulk.suspended_sync.
+    """
+
+    def mock_creates(self, mock_requests_request):
+        ids = iter(range(900, 1000))
+        def respond(method, url, **kwargs):
+            response = MagicMock()
+            response.status_code = 200
+            response.json.return_value = {'success': True, 'id': next(ids)}
+            return response
+        mock_requests_request.side_effect = respond
+
+    @patch('discourse_integration.api.requests.Session.request')
+    def test_sync_users_covers_bulk_created_users(self, mock_requests_request):
+        self.mock_creates(mock_requests_request)
+        User.objects.bulk_create([User(username=f'bulk{i}', email=f'bulk{i}@example.com') for i in range(3)])
+        self.assertFalse(DiscourseProfile.objects.exists()) # bulk_create bypasses post_save
+
+        counts = sync_users(User.objects.filter(username__startswith='bulk'), workers=1, batch_size=2)
+        self.assertEqual(counts[DiscourseOutbox.CREATE], 3)
+        self.assertEqual(DiscourseProfile.objects.filter(sync_status=DiscourseProfile.SYNCED).count(), 3)
+
+        # Nothing changed, so a second run sends nothing
+        self.assertEqual(sync_users(User.objects.filter(username__startswith='bulk'), workers=1)['unchanged'], 3)
+        self.assertEqual(mock_requests_request.call_count, 3)
+
+    @patch('discourse_integration.api.requests.Session.request')
+    def test_suspended_sync_flushes_one_batch_on_commit(self, mock_requests_request):
+        self.mock_creates(mock_requests_request)
+        with self.captureOnCommitCallbacks(execute=True):
+            with suspended_sync(workers=1) as batch:
+                first = User.objects.create_user(username='feed1', email='feed1@example.com')
+                first.first_name = 'Feed'
+                first.save()
+                User.objects.create_user(username='feed2', email='feed2@example.com')
+                User.objects.bulk_create([User(username='feed3', email='feed3@example.com')])
+                batch.add(*User.objects.filter(username='feed3'))
+                self.assertFalse(DiscourseOutbox.objects.exists())
+                mock_requests_request.assert_not_called()
+        self.assertEqual(mock_requests_request.call_count, 3)
+        self.assertEqual(DiscourseProfile.objects.exclude(discourse_user_id=None).count(), 3)
+        self.assertFalse(DiscourseOutbox.objects.exists())
+
+    @patch('discourse_integration.api.requests.Session.request')
+    def test_suspended_sync_discards_on_error(self, mock_requests_request):
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with self.assertRaises(RuntimeError):
+                with suspended_sync():
+                    User.objects.create_user(username='aborted')
+                    raise RuntimeError
+        self.assertEqual(callbacks, [])
+        mock_requests_request.assert_not_called()
+
+@override_settings(
+    DISCOURSE_BASE_URL='https://metricsdiscourse.com/',
+    DISCOURSE_API_KEY='test_api_key',
+    DISCOURSE_API_USERNAME='test_api_username',
+    DISCOURSE_RETRIES=1,
+    DISCOURSE_RATE_LIMIT_PER_MINUTE=None,
+    DISCOURSE_SSO_SECRET='sso_secret',
+    DISCOURSE_SSO_LOGIN_URL='https://metricsdiscourse.com/session/sso_provider',
+)
+class MetricsTests(TestCase):
+    """
+    Tests for the Discourse API and SSO instrumentation and the metrics view.
+    """
+
+    def setUp(self):
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+        self.addCleanup(get_circuit_breaker('https://metricsdiscourse.com').reset)
+
+    def make_response(self, status_code, payload=None):
+        response = requests.Response()
+        response.status_code = status_code
+        response._content = json.dumps(payload or {}).encode('utf-8')
+        return response
+
+    def test_endpoint_labels_are_bounded(self):
+        self.assertEqual(metrics.endpoint_label('admin/users/42.json'), 'admin/users/{id}.json')
+        self.assertEqual(metrics.endpoint_label('u/by-external/7.json'), 'u/by-external/{external_id}.json')
+        self.assertEqual(metrics.endpoint_label('u/jane.doe.json'), 'u/{username}.json')
+        self.assertEqual(metrics.endpoint_label('admin/users/list/active.json'), 'admin/users/list/active.json')
+
+    @patch('discourse_integration.api.time.sleep')
+    @patch('discourse_integration.api.requests.Session.request')
+    def test_requests_record_latency_status_and_retries(self, mock_requests_request, mock_sleep):
+        mock_requests_request.side_effect = [self.make_response(503), self.make_response(200, {'ok': True})]
+        DiscourseAPI()._make_request('PUT', 'admin/users/9.json')
+        labels = ('PUT', 'admin/users/{id}.json')
+        self.assertEqual(metrics.API_REQUEST_DURATION.count(*labels), 2)
+        self.assertEqual(metrics.API_RESPONSES.value(*labels, '503'), 1)
+        self.assertEqual(metrics.API_RESPONSES.value(*labels, '200'), 1)
+        self.assertEqual(metrics.API_RETRIES.value(*labels), 1)
+        self.assertEqual(metrics.API_IN_FLIGHT.value(*labels), 0)
+
+    @patch('discourse_integration.api.requests.Session.request')
+    def test_connection_errors_are_counted(self, mock_requests_request):
+        mock_requests_request.side_effect = requests.exceptions.ConnectionError('refused')
+        with self.assertRaises(DiscourseAPIError):
+            DiscourseAPI()._make_request('POST', 'users.json')
+        self.assertEqual(metrics.API_RESPONSES.value('POST', 'users.json', 'error'), 1)
+
+    def test_sso_views_are_timed(self):
+        user = User.objects.create_user(username='metricsuser', email='metrics@example.com')
+        self.client.force_login(user)
+        self.client.get(reverse('discourse:discourse_sso_login'))
+        self.client.post(reverse('discourse:discourse_sso_callback'))
+        self.assertEqual(metrics.SSO_DURATION.count('sso_login', '302'), 1)
+        self.assertEqual(metrics.SSO_DURATION.count('sso_callback', '400'), 1)
+
+    @override_settings(DISCOURSE_METRICS_TOKEN='scrape-token')
+    def test_metrics_view_renders_prometheus_text(self):
+        metrics.API_REQUEST_DURATION.observe(0.2, 'GET', 'u/{username}.json')
+        url = reverse('discourse:discourse_metrics')
+        self.assertEqual(self.client.get(url).status_code, 403)
+        response = self.client.get(url, HTTP_AUTHORIZATION='Bearer scrape-token')
+        self.assertEqual(response.status_code, 200)
+        body = response.content.decode()
+        self.assertIn('# TYPE discourse_api_request_duration_seconds histogram', body)
+        self.assertIn('discourse_api_request_duration_seconds_bucket{method="GET",endpoint="u/{username}.json",le="0.1"} 0', body)
+        self.assertIn('discourse_api_request_duration_seconds_bucket{method="GET",endpoint="u/{username}.json",le="0.25"} 1', body)
+        self.assertIn('discourse_api_request_duration_seconds_count{method="GET",endpoint="u/{username}.json"} 1', body)
+
+    def test_circuit_breaker_state_is_exported(self):
+        breaker = CircuitBreaker('https://breakerdiscourse.com', failure_threshold=1, reset_timeout=0)
+        breaker.record_failure()
+        body = metrics.render()
+        self.assertIn('discourse_circuit_breaker_state{base_url="https://breakerdiscourse.com",state="open"} 1', body)
+        self.assertIn('discourse_circuit_breaker_state{base_url="https://breakerdiscourse.com",state="closed"} 0', body)
+        self.assertIn('discourse_circuit_breaker_opened_total{base_url="https://breakerdiscourse.com"} 1', body)
+        self.assertTrue(breaker.allow_request()) # Probe after the reset timeout
+        self.assertEqual(metrics.BREAKER_STATE.value('https://breakerdiscourse.com', 'half_open'), 1)
+
+    def test_rate_limiter_waits_are_recorded(self):
+        limiter = RateLimiter(per_minute=60, burst=1, max_concurrency=4)
+        with limiter.slot():
+            pass
+        with self.assertRaises(RateLimitTimeout):
+            with limiter.slot(max_wait=0.01):
+                pass
+        self.assertEqual(metrics.RATE_LIMIT_WAIT.count('acquired'), 1)
+        self.assertEqual(metrics.RATE_LIMIT_WAIT.count('timeout'), 1)
+        self.assertIn('discourse_rate_limit_wait_seconds_bucket{outcome="timeout",le="0.001"}', metrics.render())
+
+    def test_metrics_view_requires_staff_without_token(self):
+        url = reverse('discourse:discourse_metrics')
+        self.assertEqual(self.client.get(url).status_code, 403)
+        self.client.force_login(User.objects.create_user(username='ops', email='ops@example.com', is_staff=True))
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+@override_settings(
+    DISCOURSE_API_KEY='test_api_key',
+    DISCOURSE_API_USERNAME='test_api_username',
+    DISCOURSE_RATE_LIMIT_PER_MINUTE=None,
+    DISCOURSE_SSO_SECRET='sso_secret',
+    PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'],
+)
+class BenchmarkHarnessTests(TestCase):
+    """
+    Tests for the fake Discourse server and the benchmark scenarios.
+    """
+
+    def setUp(self):
+        self.fake = FakeDiscourse(seed=1).start()
+        self.addCleanup(self.fake.stop)
+        overrides = override_settings(
+            DISCOURSE_BASE_URL=self.fake.base_url,
+            DISCOURSE_SSO_LOGIN_URL=f'{self.fake.base_url}/session/sso_provider',
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        self.addCleanup(lambda: get_circuit_breaker(self.fake.base_url).reset())
+
+    def test_percentile_is_nearest_rank(self):
+        ordered = list(range(1, 101))
+        self.assertEqual([percentile(ordered, p) for p in (50, 95, 99)], [50, 95, 99])
+        self.assertEqual(percentile([7], 99), 7)
+        self.assertIsNone(percentile([], 50))
+
+    def test_fake_server_speaks_the_discourse_api(self):
+        api = DiscourseAPI()
+        user = User.objects.create_user(username='benchuser', email='bench@example.com')
+        discourse_user_id = api.create_user(user)
+        self.assertEqual(self.fake.users[discourse_user_id]['username'], 'benchuser')
+        self.assertEqual(api._make_request('GET', 'u/benchuser.json')['user']['id'], discourse_user_id)
+        with self.assertRaises(DiscourseAPIError) as cm:
+            api._make_request('GET', 'u/nobody.json')
+        self.assertEqual(cm.exception.status_code, 404)
+
+    def test_fake_server_injects_faults(self):
+        self.fake.rate_limit_rate = 1.0
+        with self.assertRaises(DiscourseRateLimited):
+            DiscourseAPI()._make_request('POST', 'users.json', data={'username': 'x'})
+        self.assertEqual(self.fake.status_counts, {429: 1})
+
+    def test_scenarios_report_latency(self):
+        results = run_signups(['bench1', 'bench2'])
+        self.assertEqual(results['signup']['errors'], 0)
+        self.assertEqual(results['signup']['requests'], 2)
+        users = User.objects.filter(username__in=['bench1', 'bench2'])
+
+        results.update(run_bulk_sync(users))
+        self.assertEqual(results['bulk_sync']['outcomes']['create'], 2)
+        self.assertEqual(results['discourse_api']['requests'], 2)
+        self.assertEqual(len(self.fake.users), 2)
+
+        results.update(run_sso(list(users)))
+        self.assertEqual(results['sso_callback']['errors'], 0)
+        self.assertIsNotNone(results['sso_login']['latency_ms']['p99'])
+
+@override_settings(
+    DISCOURSE_BASE_URL='https://testdiscourse.com',
+    DISCOURSE_API_KEY='test_api_key',
+    DISCOURSE_API_USERNAME='test_api_username',
+    DISCOURSE_RATE_LIMIT_PER_MINUTE=None,
+    DISCOURSE_SSO_SECRET='sso_secret',
+    DISCOURSE_SSO_LOGIN_URL='https://testdiscourse.com/session/sso_provider',
+    SESSION_ENGINE='django.contrib.sessions.backends.db',
+    PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'],
+    LOGIN_REDIRECT_URL='/',
+)
+class UserFlowBudgetTests(TestCase):
+    """
+    Exact DB query and Discourse request budgets for each user-facing flow.
+    A change that adds a query or an HTTP call to one of these paths must
+    update the budget here deliberately.
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='flow', email='flow@example.com', password='flow-password-123', first_name='Flow', last_name='User',
+        )
+        patcher = patch('discourse_integration.api.requests.Session.request')
+        self.mock_request = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.mock_request.return_value.status_code = 200
+        self.mock_request.return_value.json.return_value = {'success': True, 'id': 900}
+
+    @contextmanager
+    def assertDiscourseCalls(self, *expected):
+        """
+        Asserts the exact (method, path) Discourse requests made inside the block.
+        """
+        self.mock_request.reset_mock()
+        yield
+        prefix = settings.DISCOURSE_BASE_URL + '/'
+        made = [(call[0][0], call[0][1].removeprefix(prefix)) for call in self.mock_request.call_args_list]
+        self.assertEqual(made, list(expected), "Unexpected Discourse requests")
+
+    def link(self, user, discourse_user_id=901):
+        DiscourseProfile.objects.filter(user=user).update(discourse_user_id=discourse_user_id)
+
+    def start_handshake(self, url=None):
+        response = self.client.get(url or reverse('discourse:discourse_sso_login'))
+        query = parse_qs(urlsplit(response['Location']).query)
+        codec = SSOCodec('sso_secret')
+        payload = codec.decode(query['sso'][0], query['sig'][0])
+        return codec.encode({'nonce': payload['nonce'], 'external_id': payload['external_id']})
+
+    def test_signup_view(self):
+        password = 'signup-password-123'
+        data = {
+            'username': 'newflow', 'first_name': 'New', 'last_name': 'Flow', 'email': 'newflow@example.com',
+            'password1': password, 'password2': password,
+        }
+        # username check, user insert, profile insert, outbox coalescing check, outbox insert
+        with self.assertNumQueries(5), self.assertDiscourseCalls():
+            response = self.client.post(reverse('signup'), data)
+        self.assertEqual(response.status_code, 302)
+
+    def test_login_saves_last_login_only(self):
+        # user lookup; new session key check and insert; last_login update; session update
+        # (each session write is wrapped in a savepoint)
+        with self.assertNumQueries(9), self.assertDiscourseCalls():
+            response = self.client.post(reverse('login'), {'username': 'flow', 'password': 'flow-password-123'})
+        self.assertEqual(response.status_code, 302)
+
+    def test_sso_login(self):
+        self.client.force_login(self.user)
+        # session load, user load, session update in a savepoint
+        with self.assertNumQueries(5), self.assertDiscourseCalls():
+            self.client.get(reverse('discourse:discourse_sso_login'))
+
+    @override_settings(DISCOURSE_SSO_STATELESS_NONCES=True)
+    def test_sso_login_with_stateless_nonces(self):
+        self.client.force_login(self.user)
+        # session load, user load; no session write
+        with self.assertNumQueries(2), self.assertDiscourseCalls():
+            self.client.get(reverse('discourse:discourse_sso_login'))
+
+    @override_settings(DISCOURSE_PROVISIONING='first_visit')
+    def test_sso_login_provisions_on_first_visit(self):
+        self.client.force_login(self.user)
+        # session load, user load, profile load, index lookup, profile link, session update in a savepoint
+        with self.assertNumQueries(8), self.assertDiscourseCalls(('POST', 'users.json')):
+            self.client.get(reverse('discourse:discourse_sso_login'))
+        # Once linked, later visits make no Discourse calls
+        with self.assertNumQueries(6), self.assertDiscourseCalls():
+            self.client.get(reverse('discourse:discourse_sso_login'))
+
+    def test_sso_callback(self):
+        self.client.force_login(self.user)
+        sso, sig = self.start_handshake()
+        # session load, user load, session update in a savepoint
+        with self.assertNumQueries(5), self.assertDiscourseCalls():
+            response = self.client.post(reverse('discourse:discourse_sso_callback'), {'sso': sso, 'sig': sig})
+        self.assertEqual(response.status_code, 302)
+
+    def test_forum_link(self):
+        self.client.force_login(self.user)
+        # session load, user load, session update in a savepoint
+        with self.assertNumQueries(5), self.assertDiscourseCalls():
+            self.client.get(reverse('discourse:discourse_forum_link'))
+
+    @override_settings(DISCOURSE_SSO_FRESHNESS_WINDOW=300)
+    def test_fresh_forum_link_skips_the_session_write(self):
+        self.client.force_login(self.user)
+        sso, sig = self.start_handshake()
+        self.client.post(reverse('discourse:discourse_sso_callback'), {'sso': sso, 'sig': sig})
+        # session load, user load
+        with self.assertNumQueries(2), self.assertDiscourseCalls():
+            self.client.get(reverse('discourse:discourse_forum_link'))
+
+    def test_profile_update_is_queued_not_sent(self):
+        self.link(self.user)
+        DiscourseOutbox.objects.all().delete()
+        user = User.objects.get(pk=self.user.pk)
+        user.first_name = 'Changed'
+        # user update, outbox coalescing check, outbox insert
+        with self.assertNumQueries(3), self.assertDiscourseCalls():
+            user.save()
+
+    def test_outbox_drain_has_no_per_user_lookups(self):
+        users = [self.user] + [
+            User.objects.create_user(username=f'flow{i}', email=f'flow{i}@example.com') for i in range(2)
+        ]
+        for i, user in enumerate(users):
+            self.link(user, 910 + i)
+        DiscourseOutbox.objects.all().delete()
+        for user in users:
+            DiscourseOutbox.objects.create(user_id=user.pk, action=DiscourseOutbox.UPDATE)
+        expected = [('PUT', f'admin/users/{910 + i}.json') for i in range(len(users))]
+        # claim and lease the rows in a savepoint, fetch users with their profiles in one
+        # query, renew each row's lease, one profile save per user in a savepoint of its
+        # own, delete the done rows
+        with self.assertNumQueries(8 + 4 * len(users)), self.assertDiscourseCalls(*expected):
+            drain_outbox()
+
+class SamplingProfilerTests(TestCase):
+    """
+    Tests for the sampling request profiler and the merge_profiles command.
+    """
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.dir = tmpdir.name
+
+    def test_sampler_records_the_target_threads_stack(self):
+        def busy_profiled_function():
+            deadline = time.perf_counter() + 0.05
+            while time.perf_counter() < deadline:
+                pass
+
+        sampler = StackSampler(threading.get_ident(), interval=0.001).start()
+        busy_profiled_function()
+        stacks = sampler.stop()
+        self.assertTrue(any(stack[-1] == 'discourse_integration.tests:busy_profiled_function' for stack in stacks))
+
+    def test_middleware_is_removed_when_disabled(self):
+        with self.assertRaises(MiddlewareNotUsed):
+            SamplingProfilerMiddleware(lambda request: None)
+
+    def test_middleware_steps_aside_for_async_handlers(self):
+        async def get_response(request):
+            return None
+
+        with self.settings(DISCOURSE_PROFILER_RATE=1.0, DISCOURSE_PROFILER_DIR=self.dir):
+            self.assertTrue(SamplingProfilerMiddleware.async_capable)
+            with self.assertRaises(MiddlewareNotUsed):
+                SamplingProfilerMiddleware(get_response)
+            SamplingProfilerMiddleware(lambda request: None)
+
+    async def test_async_requests_skip_the_profiler(self):
+        user = await User.objects.acreate(username='asyncprofiled', email='asyncprofiled@example.com')
+        await self.async_client.aforce_login(user)
+        with self.settings(DISCOURSE_PROFILER_RATE=1.0, DISCOURSE_PROFILER_DIR=self.dir, DISCOURSE_BASE_URL='https://testdiscourse.com'):
+            response = await self.async_client.get(reverse('discourse:discourse_forum_link_async'))
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(os.listdir(self.dir), [])
+
+    def test_sampled_requests_are_written_under_their_url_name(self):
+        user = User.objects.create_user(username='profiled', email='profiled@example.com')
+        self.client.force_login(user)
+        with override_settings(
+            DISCOURSE_PROFILER_RATE=1.0,
+            DISCOURSE_PROFILER_DIR=self.dir,
+            DISCOURSE_PROFILER_URL_NAMES=['discourse:discourse_forum_link'],
+            DISCOURSE_PROFILER_INTERVAL=0.001,
+            DISCOURSE_BASE_URL='https://testdiscourse.com',
+        ), patch('discourse_integration.views.is_sso_fresh', side_effect=lambda *args: time.sleep(0.05)):
+            self.client.get(reverse('discourse:discourse_forum_link'))
+            self.client.get(reverse('discourse:discourse_sso_login'))
+        [path] = os.listdir(self.dir)
+        stacks = list(read_collapsed(os.path.join(self.dir, path)))
+        self.assertTrue(stacks)
+        self.assertEqual({stack[0] for stack, _ in stacks}, {'discourse:discourse_forum_link'})
+
+    def test_writer_rotates_at_max_bytes(self):
+        writer = CollapsedStackWriter(self.dir, max_bytes=40, backups=1)
+        for i in range(3):
+            writer.write({(f'frame{i}', 'leaf'): 1}, root='view')
+        self.assertEqual(sorted(os.listdir(self.dir)), sorted([os.path.basename(writer.path), os.path.basename(writer.path) + '.1']))
+        self.assertEqual(list(read_collapsed(writer.path)), [(('view', 'frame2', 'leaf'), 1)])
+
+    def test_merge_profiles(self):
+        for name, lines in (('a.collapsed', "v1;m:f;m:g 3\nv2;m:f 1\n"), ('b.collapsed', "v1;m:f;m:g 2\nbroken line\n")):
+            with open(os.path.join(self.dir, name), 'w') as f:
+                f.write(lines)
+        merged = os.path.join(self.dir, 'merged.txt')
+        out = StringIO()
+        call_command('merge_profiles', self.dir, '--view', 'v1', '--output', merged, stdout=out)
+        with open(merged) as f:
+            self.assertEqual(f.read(), "v1;m:f;m:g 5\n")
+        self.assertIn("5 samples from 2 files.", out.getvalue())
+        self.assertIn("100.0%  m:g", out.getvalue())
@@ -1,22 +1,25 @@
 # discourse_integration/views.py
 
-import base64
-import hashlib
 import hmac
-import urllib.parse
-import os
+import logging
 from django.shortcuts import redirect
 from django.conf import settings
 from django.contrib.auth import login
 from django.contrib.auth import get_user_model
-from django.http import HttpResponseBadRequest
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseForbidden
 from django.urls import reverse
 from django.utils.crypto import get_random_string
 from django.views.decorators.csrf import csrf_exempt
 from django.contrib.auth.decorators import login_required # Require login to initiate SSO
+from .conf import get_setting
+from .metrics import render as render_metrics, timed_view
+from .sso import SSOError, build_user_payload, consume_nonce, get_sso_codec, is_sso_fresh, issue_nonce, mark_sso_fresh
+from .tasks import ensure_provisioned, provisions_on_first_visit
 
+logger = logging.getLogger(__name__)
 User = get_user_model()
 
+@timed_view('sso_login')
 @login_required # Only logged-in Django users can initiate SSO
 def discourse_sso_login(request):
     """
@@ -27,43 +30,26 @@ def discourse_sso_login(request):
         # Optionally redirect admins to a different page or show an error
         return HttpResponseBadRequest("Admin users cannot use this SSO flow.")
 
-    nonce = get_random_string(32)
-    # Store the nonce and the user ID in the session to verify the callback
-    request.session['discourse_sso_nonce'] = nonce
-    request.session['discourse_sso_user_id'] = request.user.id
-
-    # Construct the payload with user information from Django
-    payload = {
-        'nonce': nonce,
-        'return_sso_url': settings.DISCOURSE_SSO_CALLBACK_URL,
-        'email': request.user.email,
-        'external_id': str(request.user.id), # Use Django user ID as external_id
-        'username': request.user.username,
-        'name': request.user.get_full_name() or request.user.username, # Provide a name if available
-        # Add other parameters if needed, e.g., 'avatar_url', 'about_me', 'website'
-        # 'require_activation': 'true' if user.is_active else 'false', # Example: if Django handles activation
-        # 'suppress_welcome_message': 'true', # To prevent Discourse welcome emails
-    }
-
-    # Encode the payload into a query string
-    query_string = urllib.parse.urlencode(payload)
-
-    # Base64 encode the query string
-    sso_payload = base64.b64encode(query_string.encode('utf-8')).decode('utf-8')
-
-    # Calculate the HMAC-SHA256 signature
-    signature = hmac.new(
-        settings.DISCOURSE_SSO_SECRET.encode('utf-8'),
-        sso_payload.encode('utf-8'),
-        hashlib.sha256
-    ).hexdigest()
-
-    # Construct the redirect URL
-    redirect_url = f"{settings.DISCOURSE_SSO_LOGIN_URL}?sso={urllib.parse.quote_plus(sso_payload)}&sig={signature}"
+    if provisions_on_first_visit():
+        # First forum visit: create and link the Discourse account now
+        ensure_provisioned(request.user)
+
+    if get_setting('DISCOURSE_SSO_STATELESS_NONCES'):
+        # The signed nonce itself carries the user ID, expiry and destination
+        nonce = issue_nonce(request.user.id, forum=request.GET.get('forum') == '1')
+    else:
+        nonce = get_random_string(32)
+        # Store the nonce and the user ID in the session to verify the callback
+        request.session['discourse_sso_nonce'] = nonce
+        request.session['discourse_sso_user_id'] = request.user.id
+
+    # Sign the payload with the user information from Django
+    redirect_url = get_sso_codec().login_url(build_user_payload(request.user, nonce))
 
     return redirect(redirect_url)
 
 @csrf_exempt # Necessary as Discourse posts to this URL
+@timed_view('sso_callback')
 def discourse_sso_callback(request):
     """
     Handles the callback from Discourse after SSO.
@@ -75,41 +61,48 @@ def discourse_sso_callback(request):
     if not sso_payload or not signature:
         return HttpResponseBadRequest("Missing SSO payload or signature.")
 
-    # Verify the signature
-    expected_signature = hmac.new(
-        settings.DISCOURSE_SSO_SECRET.encode('utf-8'),
-        sso_payload.encode('utf-8'),
-        hashlib.sha256
-    ).hexdigest()
-
-    if not hmac.compare_digest(signature, expected_signature):
+    try:
+        # Verify the signature, then decode and parse the payload
+        payload_params = get_sso_codec().decode(sso_payload, signature)
+    except SSOError as e:
         # Log suspicious activity
-        print(f"SSO Signature mismatch: Received={signature}, Expected={expected_signature}")
+        logger.warning("Rejected DiscourseConnect callback: %s", e)
         return HttpResponseBadRequest("Invalid SSO signature.")
 
     try:
-        # Decode and parse the payload
-        decoded_payload = base64.b64decode(sso_payload).decode('utf-8')
-        payload_params = urllib.parse.parse_qs(decoded_payload)
-
-        nonce = payload_params.get('nonce', [None])[0]
-        external_id = payload_params.get('external_id', [None])[0] # This should be the Django user ID
-        email = payload_params.get('email', [None])[0]
+        nonce = payload_params.get('nonce')
+        external_id = payload_params.get('external_id') # This should be the Django user ID
         # Retrieve other parameters, but Django is the source of truth
 
         # Verify the nonce against the one stored in the session
         # Note: The nonce verification here is primarily to confirm the request originated from
         # a Django-initiated SSO flow. The actual user linking/auth is based on Django's session.
-        stored_nonce = request.session.pop('discourse_sso_nonce', None)
-        stored_user_id = request.session.pop('discourse_sso_user_id', None)
+        redirect_url_after_sso = None
+        if get_setting('DISCOURSE_SSO_STATELESS_NONCES'):
+            try:
+                stored_user_id, forum = consume_nonce(nonce)
+            except SSOError as e:
+                logger.warning("Rejected SSO nonce: %s", e)
+                return HttpResponseBadRequest("Invalid or expired SSO request or user mismatch.")
+            # A signed nonce is not tied to a browser, so it never logs anyone in:
+            # it only completes the handshake for the user who started it.
+            if not request.user.is_authenticated or request.user.id != stored_user_id:
+                logger.warning("Stateless SSO callback for user ID %s without that user's session.", stored_user_id)
+                return HttpResponseBadRequest("Invalid or expired SSO request or user mismatch.")
+            stored_nonce = nonce
+            redirect_url_after_sso = settings.DISCOURSE_BASE_URL if forum else settings.LOGIN_REDIRECT_URL
+        else:
+            stored_nonce = request.session.pop('discourse_sso_nonce', None)
+            stored_user_id = request.session.pop('discourse_sso_user_id', None)
 
         if not stored_nonce or nonce != stored_nonce or not stored_user_id or external_id != str(stored_user_id):
              # This could indicate a replay attack or an issue with the session/linking
-             print(f"SSO Nonce/User ID mismatch: Stored Nonce={stored_nonce}, Received Nonce={nonce}, Stored User ID={stored_user_id}, Received External ID={external_id}")
+             logger.warning("SSO nonce/user ID mismatch: stored user ID %s, received external_id %s", stored_user_id, external_id)
              return HttpResponseBadRequest("Invalid or expired SSO request or user mismatch.")
 
         # At this point, we have a validated SSO callback for a specific Django user.
-        # Ensure the user is logged in. If not, log them in based on the stored user ID.
+        # Ensure the user is logged in. If not, log them in based on the user ID stored
+        # in the session (stateless nonces were checked against the logged-in user above).
         if not request.user.is_authenticated or request.user.id != stored_user_id:
             try:
                 user = User.objects.get(id=stored_user_id)
@@ -117,30 +110,39 @@ def discourse_sso_callback(request):
                 # not based on the Discourse payload data, as Django is the source of truth.
                 login(request, user)
             except User.DoesNotExist:
-                 print(f"Django user with ID {stored_user_id} not found during SSO callback.")
+                 logger.warning("Django user with ID %s not found during SSO callback.", stored_user_id)
                  return HttpResponseBadRequest("User not found.")
 
         # Redirect the user to the appropriate page after the SSO handshake is complete.
         # This could be the homepage, a specific forum page, or the page they were trying to access.
         # You might store the redirect URL in the session in the discourse_sso_login view.
-        redirect_url_after_sso = request.session.pop('redirect_url_after_sso', settings.LOGIN_REDIRECT_URL)
-        return redirect(redirect_url_after_sso)
+        if redirect_url_after_sso is None:
+            redirect_url_after_sso = request.session.pop('redirect_url_after_sso', settings.LOGIN_REDIRECT_URL)
+        response = redirect(redirect_url_after_sso)
+        mark_sso_fresh(request, response, stored_user_id)
+        return response
 
     except Exception as e:
         # Log the error
-        print(f"Error processing Discourse SSO callback: {e}")
+        logger.exception("Error processing Discourse SSO callback: %s", e)
         # Render an error page or redirect to an error URL
         # Consider a more user-friendly error page
         return HttpResponseBadRequest("An error occurred during SSO processing.")
 
+@timed_view('forum_link')
 @login_required
 def discourse_forum_link(request):
     """
     Redirects the logged-in user to the Discourse forum, triggering SSO if needed.
     """
-    # Check if the user is already linked or if SSO is required.
-    # For simplicity, we'll always initiate SSO for now.
-    # In a more complex scenario, you might check if a DiscourseProfile exists and is linked.
+    # Users who completed the handshake within DISCOURSE_SSO_FRESHNESS_WINDOW most
+    # likely still have a Discourse session; send them straight to the forum.
+    if is_sso_fresh(request, request.user.id):
+        return redirect(settings.DISCOURSE_BASE_URL)
+
+    if get_setting('DISCOURSE_SSO_STATELESS_NONCES'):
+        # The destination travels in the signed nonce instead of the session
+        return redirect(reverse('discourse:discourse_sso_login') + '?forum=1')
 
     # Store the desired redirect URL after SSO completion (e.g., the Discourse base URL)
     request.session['redirect_url_after_sso'] = settings.DISCOURSE_BASE_URL
@@ -148,3 +150,18 @@ def discourse_forum_link(request):
     # Redirect to the SSO login view which will handle the handshake
     return redirect('discourse:discourse_sso_login')
 
+
+def discourse_metrics(request):
+    """
+    Exposes the integration's metrics in the Prometheus text format.
+    Scrapers authenticate with "Authorization: Bearer <DISCOURSE_METRICS_TOKEN>";
+    without a configured token only staff users may read them.
+    """
+    token = get_setting('DISCOURSE_METRICS_TOKEN')
+    if token:
+        supplied = request.headers.get('Authorization', '').removeprefix('Bearer ')
+        if not hmac.compare_digest(supplied.encode('utf-8'), token.encode('utf-8')):
+            return HttpResponseForbidden("Invalid metrics token.")
+    elif not request.user.is_staff:
+        return HttpResponseForbidden("Metrics are only available to staff.")
+    return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
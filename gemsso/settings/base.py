@@ -23,6 +23,11 @@ env = environ.Env(
     # Database URL definition - django-environ will parse this
     DATABASE_URL=(str, 'sqlite:///db.sqlite3'), # Default to SQLite for simplicity if not provided
 
+    # Cache URL definition, e.g. locmemcache://, filecache:///var/tmp/gemsso,
+    # rediscache://127.0.0.1:6379/1 or pymemcache://127.0.0.1:11211
+    CACHE_URL=(str, 'locmemcache://'),
+    SESSION_ENGINE=(str, 'django.contrib.sessions.backends.db'),
+
     # Email settings
     EMAIL_BACKEND=(str, 'django.core.mail.backends.console.EmailBackend'), # Default to console backend
     EMAIL_HOST=(str, 'localhost'),
@@ -43,6 +48,19 @@ env = environ.Env(
     # DISCOURSE_SSO_CALLBACK_URL is derived from DISCOURSE_BASE_URL and URL patterns,
     # but defining it explicitly via env var is safer if your external URL differs
     DISCOURSE_SSO_CALLBACK_URL=(str), # Required, must be externally accessible by Discourse
+    DISCOURSE_HTTP_POOL_SIZE=(int, 10), # Keep-alive connections kept per process
+    DISCOURSE_CONNECT_TIMEOUT=(float, 3.05), # Seconds to establish a connection
+    DISCOURSE_READ_TIMEOUT=(float, 10.0), # Seconds to wait for a response
+    DISCOURSE_ASYNC_POOL_SIZE=(int, 100), # Connections per event loop for the async client
+    DISCOURSE_ASYNC_CONCURRENCY=(int, 50), # Default in-flight limit for gather_bounded
+    # Cache aliases shared across processes; empty keeps the state in-process
+    DISCOURSE_RATE_LIMIT_CACHE=(str, ''),
+    DISCOURSE_SSO_REPLAY_CACHE=(str, ''),
+    DISCOURSE_LOOKUP_CACHE_ALIAS=(str, ''),
+    DISCOURSE_METRICS_TOKEN=(str, ''), # Bearer token for the Prometheus metrics view
+    DISCOURSE_PROFILER_RATE=(float, 0.0), # Fraction of requests profiled; 0 disables the profiler
+    DISCOURSE_PROFILER_URL_NAMES=(list, []), # e.g. discourse:discourse_sso_callback; empty profiles every view
+    DISCOURSE_PROFILER_DIR=(str, ''), # Where the collapsed-stack files are written
 
     # Add other settings you might need
 )
@@ -76,6 +94,7 @@ INSTALLED_APPS = [
     'django.contrib.messages',
     'django.contrib.staticfiles',
     'discourse_integration', # Your reusable app
+    'users',
     'django_extensions', # For runserver_plus etc.
     # 'django_celery_beat', # Commented out for basic setup
     # 'django_celery_results', # Commented out for basic setup
@@ -83,6 +102,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # Outermost, so sampled requests include the session save and other middleware work.
+    # Removed at startup unless DISCOURSE_PROFILER_RATE and DISCOURSE_PROFILER_DIR are set.
+    'discourse_integration.profiling.SamplingProfilerMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -118,6 +140,15 @@ DATABASES = {
     'default': env.db('DATABASE_URL')
 }
 
+# Cache Configuration using CACHE_URL
+# env.cache() parses the CACHE_URL string the same way env.db() parses DATABASE_URL
+CACHES = {
+    'default': env.cache('CACHE_URL')
+}
+
+# Sessions; production.py switches to cached_db so page views read sessions from the cache
+SESSION_ENGINE = env('SESSION_ENGINE')
+
 # Password validation
 AUTH_PASSWORD_VALIDATORS = [
     {
@@ -154,6 +185,18 @@ DISCOURSE_API_KEY = env('DISCOURSE_API_KEY')
 DISCOURSE_API_USERNAME = env('DISCOURSE_API_USERNAME')
 DISCOURSE_SSO_LOGIN_URL = f'{DISCOURSE_BASE_URL}/session/sso_provider'
 DISCOURSE_SSO_CALLBACK_URL = env('DISCOURSE_SSO_CALLBACK_URL') # Must be accessible by Discourse
+DISCOURSE_HTTP_POOL_SIZE = env('DISCOURSE_HTTP_POOL_SIZE')
+DISCOURSE_CONNECT_TIMEOUT = env('DISCOURSE_CONNECT_TIMEOUT')
+DISCOURSE_READ_TIMEOUT = env('DISCOURSE_READ_TIMEOUT')
+DISCOURSE_ASYNC_POOL_SIZE = env('DISCOURSE_ASYNC_POOL_SIZE')
+DISCOURSE_ASYNC_CONCURRENCY = env('DISCOURSE_ASYNC_CONCURRENCY')
+DISCOURSE_RATE_LIMIT_CACHE = env('DISCOURSE_RATE_LIMIT_CACHE') or None
+DISCOURSE_SSO_REPLAY_CACHE = env('DISCOURSE_SSO_REPLAY_CACHE') or None
+DISCOURSE_LOOKUP_CACHE_ALIAS = env('DISCOURSE_LOOKUP_CACHE_ALIAS') or None
+DISCOURSE_METRICS_TOKEN = env('DISCOURSE_METRICS_TOKEN') or None
+DISCOURSE_PROFILER_RATE = env('DISCOURSE_PROFILER_RATE')
+DISCOURSE_PROFILER_URL_NAMES = env('DISCOURSE_PROFILER_URL_NAMES')
+DISCOURSE_PROFILER_DIR = env('DISCOURSE_PROFILER_DIR') or None
 
 # --- Email settings (for Mailpit/SMTP) ---
 EMAIL_BACKEND = env('EMAIL_BACKEND')
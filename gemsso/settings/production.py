@@ -34,6 +34,18 @@ DEBUG = False # Explicitly set DEBUG to False for production
 # DISCOURSE_API_USERNAME = env('DISCOURSE_API_USERNAME')
 # DISCOURSE_SSO_CALLBACK_URL = env('DISCOURSE_SSO_CALLBACK_URL') # Should match your production external URL
 
+# --- Cache and sessions ---
+# CACHE_URL should point at a shared cache (Redis or memcached) in production,
+# e.g. CACHE_URL=rediscache://127.0.0.1:6379/1. It backs sessions, so logged-in
+# page views read the session from the cache instead of the session table, and
+# gives the Discourse rate limiter and SSO replay cache one view across processes.
+# CACHES itself is built from CACHE_URL by base.py.
+SESSION_ENGINE = env('SESSION_ENGINE', default='django.contrib.sessions.backends.cached_db')
+DISCOURSE_RATE_LIMIT_CACHE = env('DISCOURSE_RATE_LIMIT_CACHE') or 'default'
+DISCOURSE_SSO_REPLAY_CACHE = env('DISCOURSE_SSO_REPLAY_CACHE') or 'default'
+# Lookups stay in-process unless DISCOURSE_LOOKUP_CACHE_ALIAS is set; the per-process
+# TTL cache is faster and a few minutes of staleness is harmless there.
+
 # --- Production Security Settings ---
 # Configure these appropriately for your production environment
 # SECURE_SSL_REDIRECT = env.bool('SECURE_SSL_REDIRECT', default=True)
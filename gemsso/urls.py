@@ -21,4 +21,5 @@ urlpatterns = [
     path('admin/', admin.site.urls),
     path('users/', include('users.urls')), # Include your new users app's URLs
     path('accounts/', include('django.contrib.auth.urls')), # Optional: Includes built-in login/logout views
+    path('discourse/', include('discourse_integration.urls', namespace='discourse')),
 ]
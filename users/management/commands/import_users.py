@@ -0,0 +1,161 @@
+# users/management/commands/import_users.py
+import csv
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+import django
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models.functions import Lower
+from discourse_integration.models import DiscourseProfile
+from discourse_integration.tasks import enqueue_creates, provisions_on_first_visit
+from users.forms import ImportUserForm
+
+User = get_user_model()
+
+FIELDS = ('username', 'email', 'first_name', 'last_name')
+
+def read_csv(stream):
+    for row in csv.DictReader(stream):
+        yield row
+
+def read_jsonl(stream):
+    for line in stream:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+READERS = {'csv': read_csv, 'jsonl': read_jsonl}
+
+def detect_format(path):
+    return 'jsonl' if os.path.splitext(path)[1].lower() in ('.jsonl', '.ndjson') else 'csv'
+
+class Command(BaseCommand):
+    help = (
+        "Imports users from a CSV or JSONL file (or '-' for stdin) with columns "
+        "username, email, first_name, last_name and an optional password. Rows are "
+        "streamed and validated with the sign-up form's rules, passwords are hashed "
+        "in a process pool, and users are inserted with bulk_create in chunks. "
+        "Each chunk's Discourse creates are queued in the same transaction, for "
+        "process_discourse_outbox to send at the Discourse rate limit."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="File to import, or '-' to read standard input.")
+        parser.add_argument('--format', choices=sorted(READERS), help="Input format. Defaults to the file extension (.jsonl/.ndjson, else csv).")
+        parser.add_argument('--batch-size', type=int, default=1000, help="Rows validated, hashed and inserted per chunk.")
+        parser.add_argument('--hash-workers', type=int, default=os.cpu_count() or 1, help="Processes hashing passwords; 1 hashes in this process.")
+        parser.add_argument('--no-sync', action='store_true', help="Insert users without queueing them for Discourse.")
+        parser.add_argument('--dry-run', action='store_true', help="Validate the input without hashing or inserting anything.")
+
+    def handle(self, *args, **options):
+        path = options['path']
+        fmt = options['format'] or ('csv' if path == '-' else detect_format(path))
+        batch_size = max(1, options['batch_size'])
+        hash_workers = max(1, options['hash_workers'])
+        self.dry_run = options['dry_run']
+        # With first-visit provisioning accounts are created on the first SSO, as for sign-ups
+        self.sync = not (options['no_sync'] or self.dry_run or provisions_on_first_visit())
+        self.imported = self.rejected = self.queued = 0
+
+        try:
+            stream = sys.stdin if path == '-' else open(path, newline='', encoding='utf-8')
+        except OSError as e:
+            raise CommandError(f"Cannot read {path}: {e}")
+
+        executor = None
+        if hash_workers > 1 and not self.dry_run:
+            executor = ProcessPoolExecutor(max_workers=hash_workers, initializer=django.setup)
+        try:
+            rows = enumerate(READERS[fmt](stream), start=1)
+            pending = None
+            while True:
+                chunk = list(islice(rows, batch_size))
+                if not chunk and pending is None:
+                    break
+                users, passwords = self.validate_chunk(chunk)
+                hashed = None
+                if users and not self.dry_run:
+                    # Submit this chunk's hashing before inserting the previous
+                    # chunk, so validation and inserts overlap with the pool's work
+                    hashed = executor.map(make_password, passwords, chunksize=max(1, len(passwords) // hash_workers)) if executor else None
+                if pending is not None:
+                    self.insert_chunk(*pending)
+                pending = (users, passwords, hashed) if users and not self.dry_run else None
+                if not chunk:
+                    break
+        except (csv.Error, json.JSONDecodeError, UnicodeDecodeError) as e:
+            raise CommandError(f"Unreadable {fmt} input: {e}")
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=True, cancel_futures=True)
+            if stream is not sys.stdin:
+                stream.close()
+
+        verb = "Validated" if self.dry_run else "Imported"
+        self.stdout.write(f"{verb} {self.imported} users, rejected {self.rejected}.")
+        if self.sync:
+            self.stdout.write(f"Queued {self.queued} Discourse creates for the outbox worker.")
+
+    def validate_chunk(self, chunk):
+        """
+        Validates a chunk of (line, row) pairs. Returns the unsaved users and
+        their raw passwords (None for rows without one).
+        """
+        forms = []
+        for line, row in chunk:
+            if not isinstance(row, dict):
+                self.reject(line, "not an object")
+                continue
+            password = str(row.get('password') or '')
+            data = {field: str(row.get(field) or '').strip() for field in FIELDS}
+            data['password1'] = data['password2'] = password
+            form = ImportUserForm(data)
+            if form.is_valid():
+                forms.append((line, form))
+            else:
+                errors = '; '.join(f"{field}: {' '.join(messages)}" for field, messages in form.errors.items())
+                self.reject(line, errors)
+
+        # One query per chunk replaces the form's per-row username check
+        lowered = {form.cleaned_data['username'].lower() for _, form in forms}
+        taken = set(
+            User.objects.annotate(username_lower=Lower('username'))
+            .filter(username_lower__in=lowered)
+            .values_list('username_lower', flat=True)
+        )
+        users, passwords = [], []
+        for line, form in forms:
+            username = form.cleaned_data['username']
+            if username.lower() in taken:
+                self.reject(line, f"username: {username} already exists.")
+                continue
+            taken.add(username.lower())
+            users.append(User(**{field: form.cleaned_data[field] for field in FIELDS}))
+            passwords.append(form.cleaned_data['password1'] or None)
+        if self.dry_run:
+            self.imported += len(users)
+        return users, passwords
+
+    def insert_chunk(self, users, passwords, hashed):
+        if hashed is None:
+            hashed = map(make_password, passwords)
+        for user, encoded in zip(users, hashed):
+            user.password = encoded # make_password(None) is an unusable password
+        with transaction.atomic():
+            User.objects.bulk_create(users)
+            if users[0].pk is None: # Backends that cannot return primary keys from bulk inserts
+                users = list(User.objects.filter(username__in=[user.username for user in users]))
+            # What post_save would have written for each user: a profile, and a queued create
+            DiscourseProfile.objects.bulk_create([DiscourseProfile(user=user) for user in users])
+            if self.sync:
+                self.queued += enqueue_creates([user.pk for user in users if user.is_active])
+        self.imported += len(users)
+
+    def reject(self, line, reason):
+        self.rejected += 1
+        self.stderr.write(f"Row {line}: {reason}")
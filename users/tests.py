@@ -1,3 +1,97 @@
-from django.test import TestCase
+import json
+import os
+import tempfile
+from io import StringIO
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from unittest.mock import patch
+from discourse_integration.models import DiscourseOutbox, DiscourseProfile
+from discourse_integration.tasks import drain_outbox
 
-# Create your tests here.
+User = get_user_model()
+
+@override_settings(
+    DISCOURSE_BASE_URL='https://testdiscourse.com/',
+    DISCOURSE_API_KEY='test_api_key',
+    DISCOURSE_API_USERNAME='test_api_username',
+    PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'],
+)
+class ImportUsersCommandTests(TestCase):
+    """
+    Tests for the import_users bulk importer.
+    """
+
+    def write_input(self, suffix, content):
+        handle, path = tempfile.mkstemp(suffix=suffix)
+        with os.fdopen(handle, 'w', newline='') as f:
+            f.write(content)
+        self.addCleanup(os.remove, path)
+        return path
+
+    def run_command(self, *args):
+        out, err = StringIO(), StringIO()
+        call_command('import_users', '--hash-workers=1', *args, stdout=out, stderr=err)
+        return out.getvalue(), err.getvalue()
+
+    @patch('discourse_integration.api.requests.Session.request')
+    def test_imports_csv_and_queues_creates(self, mock_requests_request):
+        mock_requests_request.return_value.json.side_effect = [{'success': True, 'id': 700}, {'success': True, 'id': 701}]
+        path = self.write_input('.csv', (
+            "username,email,first_name,last_name,password\n"
+            "ada,ada@example.com,Ada,Lovelace,analytical-engine-1843\n"
+            "alan,alan@example.com,Alan,Turing,\n"
+        ))
+        out, err = self.run_command(path, '--batch-size=1')
+        self.assertIn("Imported 2 users, rejected 0.", out)
+        self.assertIn("Queued 2 Discourse creates", out)
+        ada = User.objects.get(username='ada')
+        self.assertTrue(ada.check_password('analytical-engine-1843'))
+        self.assertEqual(ada.get_full_name(), 'Ada Lovelace')
+        self.assertFalse(User.objects.get(username='alan').has_usable_password())
+
+        # Discourse is only called by the outbox worker
+        mock_requests_request.assert_not_called()
+        self.assertEqual(DiscourseOutbox.objects.filter(action=DiscourseOutbox.CREATE).count(), 2)
+        drain_outbox()
+        self.assertEqual(DiscourseProfile.objects.filter(discourse_user_id__in=[700, 701]).count(), 2)
+        self.assertFalse(DiscourseOutbox.objects.exists())
+
+    def test_hashes_passwords_in_a_process_pool(self):
+        rows = [
+            {'username': f'pooled{i}', 'email': f'pooled{i}@example.com', 'first_name': 'P', 'last_name': str(i), 'password': f'pool-password-{i}-x'}
+            for i in range(6)
+        ]
+        path = self.write_input('.jsonl', '\n'.join(json.dumps(row) for row in rows) + '\n')
+        out, err = self.run_command(path, '--hash-workers=2', '--batch-size=4', '--no-sync')
+        self.assertIn("Imported 6 users, rejected 0.", out)
+        for i in range(6):
+            self.assertTrue(User.objects.get(username=f'pooled{i}').check_password(f'pool-password-{i}-x'))
+        self.assertEqual(DiscourseProfile.objects.filter(user__username__startswith='pooled').count(), 6)
+        self.assertFalse(DiscourseOutbox.objects.exists())
+
+    @patch('discourse_integration.api.requests.Session.request')
+    def test_rejects_invalid_and_duplicate_rows(self, mock_requests_request):
+        User.objects.create_user(username='Existing', email='existing@example.com')
+        rows = [
+            {'username': 'existing', 'email': 'e2@example.com', 'first_name': 'E', 'last_name': 'X'},
+            {'username': 'grace', 'email': 'not-an-email', 'first_name': 'Grace', 'last_name': 'Hopper'},
+            {'username': 'linus', 'email': 'linus@example.com', 'first_name': 'Linus', 'last_name': 'T'},
+            {'username': 'LINUS', 'email': 'linus2@example.com', 'first_name': 'Linus', 'last_name': 'T'},
+            {'username': 'weak', 'email': 'weak@example.com', 'first_name': 'W', 'last_name': 'P', 'password': 'weak'},
+        ]
+        path = self.write_input('.jsonl', '\n'.join(json.dumps(row) for row in rows) + '\n')
+        out, err = self.run_command(path, '--no-sync')
+        mock_requests_request.assert_not_called()
+        self.assertIn("Imported 1 users, rejected 4.", out)
+        self.assertIn("Row 1: username:", err)
+        self.assertIn("Row 2: email:", err)
+        self.assertIn("Row 4: username:", err)
+        self.assertIn("Row 5: password2:", err)
+        self.assertTrue(User.objects.filter(username='linus').exists())
+
+    def test_dry_run_inserts_nothing(self):
+        path = self.write_input('.csv', "username,email,first_name,last_name\nbob,bob@example.com,Bob,B\n")
+        out, err = self.run_command(path, '--dry-run')
+        self.assertIn("Validated 1 users, rejected 0.", out)
+        self.assertFalse(User.objects.filter(username='bob').exists())